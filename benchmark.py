@@ -0,0 +1,389 @@
+from main import Buffer, close, compressionExtensions, connect, countPrimaryKeys, createJoinedTemporaryTable, default, getCursor, localjoinRowsQuery, openExportFile, peakMemoryUsage, run, runPreparedQuery, runQuery, setupAddPrimaryTable, setupAddSecondaryTable, tableInfo, writeRows
+from progress.bar import Bar
+import time
+import os
+import getpass
+import tempfile
+import decimal
+import datetime
+import sys
+import json
+import multiprocessing
+import concurrent.futures
+import psycopg2
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# The database to benchmark, read from the same environment variables as psql (PGUSER, PGPASSWORD, PGDATABASE, and PGHOST)
+dbuser = os.environ.get("PGUSER", getpass.getuser())
+dbpass = os.environ.get("PGPASSWORD", "")
+dbname = os.environ.get("PGDATABASE", "ckd")
+dbhost = os.environ.get("PGHOST", "localhost")
+
+# The database the synthetic data is generated in (see generateSyntheticDatabase), created if it doesn't exist, read from BENCHMARK_DATABASE - never point this at a real database, since its tables are replaced
+syntheticDbname = os.environ.get("BENCHMARK_DATABASE", "ckd_benchmark")
+
+#
+# Benchmark functions
+#
+
+def benchmarkBuffer(table = default, size = 10000, prefetch = True):
+    """
+    Streams a table's temporary table through Buffer and prints how long each page took to fetch, so it's easy to check that pages near the end of the table cost the same as those near the start, along with how long reading the table waited on pages.
+
+    Takes the table as a table object (default the primary table), the number of rows per page, int (default 10000), and whether Buffer should prefetch pages, boolean (default True). The temporary table needs to exist already. Returns the list of page times in seconds.
+    """
+    if table == default:
+        table = tableInfo[0]
+
+    pageTimes = []
+    rows = 0
+    table.stallTime = 0
+    start = time.time()
+    for entry in Buffer(table, size, pageTimes, prefetch = prefetch):
+        if not entry == None:
+            rows += 1
+    elapsed = time.time() - start
+
+    # The final page is the empty fetch that ends the stream, and the first one includes running the query itself
+    pages = pageTimes[1:-1]
+    print("Table {t}: {r} rows in {p} pages, {s:.2f} seconds total".format(t = table.name, r = rows, p = len(pageTimes) - 1, s = elapsed))
+    print("    First page (includes query execution): {f:.2f} ms".format(f = pageTimes[0] * 1000))
+    print("    Waited on pages for {w:.2f} seconds{p}".format(w = table.stallTime, p = " (prefetching)" if prefetch else ""))
+    if len(pages) > 0:
+        tenth = max(1, len(pages) // 10)
+        print("    Later pages: mean {m:.2f} ms, min {mn:.2f} ms, max {mx:.2f} ms".format(m = sum(pages) / len(pages) * 1000, mn = min(pages) * 1000, mx = max(pages) * 1000))
+        print("    First 10% of pages: mean {f:.2f} ms, last 10% of pages: mean {l:.2f} ms".format(f = sum(pages[:tenth]) / tenth * 1000, l = sum(pages[-tenth:]) / tenth * 1000))
+    return pageTimes
+
+# Values used for every synthetic export row - a handful of primary table values, and a child entry of mixed types (including a value with a comma) repeated up to syntheticMaxEntries times
+syntheticPrimary = ["1950-01-01", "F", "white", None, 0]
+syntheticEntry = [1234567, datetime.date(2015, 6, 1), decimal.Decimal("12.50"), "comment, with a comma"]
+syntheticMaxEntries = 10
+
+def syntheticEntries(rows):
+    """
+    Generator function that returns the primary values and child entries for each of the given number of synthetic primary keys, as tuples of the key and a list holding the primary values and the list of entries.
+    """
+    for i in range(rows):
+        yield (i, [syntheticPrimary, [syntheticEntry] * (i % syntheticMaxEntries)])
+
+def syntheticRows(rows):
+    """
+    Generator function that returns synthetic export rows the way assembleBufferedRows does, padded to syntheticMaxEntries entries. Takes the number of rows as an int.
+    """
+    padding = [None] * len(syntheticEntry)
+    for primaryKey, (primaryEntry, entries) in syntheticEntries(rows):
+        row = list(primaryEntry)
+        for childEntry in entries:
+            row.extend(childEntry)
+        row.extend(padding * (syntheticMaxEntries - len(entries)))
+        yield (primaryKey, row)
+
+def benchmarkWriter(rows = 1000000, filename = default):
+    """
+    Times writing a synthetic export with the csv writer (writeRows) against the old loop that wrote one cell at a time, without needing a database.
+
+    Takes the number of rows to write, int (default 1000000), and optionally the file to write to (default a temporary file that is removed afterwards). Each row has a handful of primary table values followed by a few child entries of mixed types and padding, including values that contain commas. Returns a tuple with the old and new times in seconds.
+    """
+    if filename == default:
+        handle, filename = tempfile.mkstemp(suffix = ".csv")
+        os.close(handle)
+        remove = True
+    else:
+        remove = False
+
+    print("Writing {r} rows with the old per-cell loop...".format(r = rows))
+    start = time.time()
+    with open(filename, "w+") as file:
+        for primaryKey, (primaryEntry, entries) in syntheticEntries(rows):
+            for value in primaryEntry:
+                file.write(str(value) + ",")
+            for childEntry in entries:
+                for value in childEntry:
+                    file.write(str(value) + ",")
+            file.write("," * ((syntheticMaxEntries - len(entries)) * len(syntheticEntry)))
+            file.seek(file.tell() - 1)
+            file.write("\n")
+    oldTime = time.time() - start
+    oldSize = os.path.getsize(filename)
+
+    print("Writing {r} rows with the csv writer...".format(r = rows))
+    start = time.time()
+    with openExportFile(filename) as file:
+        writeRows(file, syntheticRows(rows))
+    newTime = time.time() - start
+    newSize = os.path.getsize(filename)
+
+    if remove:
+        os.remove(filename)
+
+    print("Old loop: {t:.2f} seconds ({r:.0f} rows/sec, {s} bytes)".format(t = oldTime, r = rows / oldTime, s = oldSize))
+    print("csv writer: {t:.2f} seconds ({r:.0f} rows/sec, {s} bytes)".format(t = newTime, r = rows / newTime, s = newSize))
+    print("Speedup: {x:.2f}x".format(x = oldTime / newTime))
+    return (oldTime, newTime)
+
+def benchmarkCompression(rows = 1000000, levels = default):
+    """
+    Times writing a synthetic export (see syntheticRows) uncompressed and with each compression codec and level, without needing a database, and prints the throughput and file size of each.
+    
+    Takes the number of rows to write, int (default 1000000), and optionally a dictionary of the levels to try for each codec (default gzip levels 1, 6, and 9, and zstd levels 1, 3, 9, and 19 if the zstandard module is installed). Returns a list of tuples with the codec, level, time in seconds, and file size in bytes.
+    """
+    import main
+    if levels == default:
+        levels = {"gzip": [1, 6, 9]}
+        if not main.zstandard == None:
+            levels["zstd"] = [1, 3, 9, 19]
+    
+    directory = tempfile.mkdtemp()
+    results = []
+    for compression, level in [(None, None)] + [(compression, level) for compression in levels for level in levels[compression]]:
+        filename = os.path.join(directory, "export.csv" + (compressionExtensions[compression] if not compression == None else ""))
+        main.exportCompressionLevel = level
+        print("Writing {r} rows {c}...".format(r = rows, c = "with {c} level {l}".format(c = compression, l = level) if not compression == None else "uncompressed"))
+        start = time.time()
+        with openExportFile(filename) as file:
+            writeRows(file, syntheticRows(rows))
+        elapsed = time.time() - start
+        results.append((compression, level, elapsed, os.path.getsize(filename)))
+        os.remove(filename)
+    main.exportCompressionLevel = None
+    os.rmdir(directory)
+    
+    uncompressedSize = results[0][3]
+    for compression, level, elapsed, size in results:
+        print("{c:<6} {l:>5}: {t:6.2f} seconds ({r:.0f} rows/sec, {m:.1f} MB/sec of csv), {s:.1f} MB ({p:.1f}% of uncompressed)".format(c = compression or "none", l = level if not level == None else "-", t = elapsed, r = rows / elapsed, m = uncompressedSize / elapsed / 1048576, s = size / 1048576, p = size / uncompressedSize * 100))
+    return results
+
+def benchmarkStatementOverhead(table = default, statements = 1000, keysPerStatement = (1, 100)):
+    """
+    Times the repeated key lookups of the \"slow\" mode run as plain queries with bound parameters (parsed and planned every time) against prepared statements (see runPreparedQuery), and prints the average time per statement of each, so the per-statement overhead saved by preparing them can be seen.
+    
+    Takes the table as a table object (default the last table in tableInfo), the number of statements to run for each test, int (default 1000), and a list of how many keys to look up per statement (default 1 and 100). Keys are taken from the table itself. Returns a list of tuples with the number of keys and the plain and prepared times per statement in seconds.
+    """
+    if table == default:
+        table = tableInfo[-1]
+    
+    runQuery("select distinct {k} from {t} where {k} is not null limit {n}".format(k = table.keyColumn.name, t = table.name, n = max(keysPerStatement) * 10))
+    keys = [row[0] for row in getCursor().fetchall()]
+    
+    results = []
+    for count in keysPerStatement:
+        batches = [[keys[(i * count + j) % len(keys)] for j in range(count)] for i in range(statements)]
+        
+        print("Running {s} plain lookups of {k} keys from table {t}...".format(s = statements, k = count, t = table.name))
+        query, parameters = localjoinRowsQuery(table, batches[0])
+        start = time.time()
+        for batch in batches:
+            runQuery(query, (batch,))
+            getCursor().fetchall()
+        plainTime = (time.time() - start) / statements
+        
+        print("Running {s} prepared lookups of {k} keys from table {t}...".format(s = statements, k = count, t = table.name))
+        query, parameters = localjoinRowsQuery(table, batches[0], prepared = True)
+        start = time.time()
+        for batch in batches:
+            runPreparedQuery(query, (batch,))
+            getCursor().fetchall()
+        preparedTime = (time.time() - start) / statements
+        
+        print("    {k} keys per statement: plain {p:.3f} ms, prepared {r:.3f} ms per statement ({x:.2f}x)".format(k = count, p = plainTime * 1000, r = preparedTime * 1000, x = plainTime / preparedTime))
+        results.append((count, plainTime, preparedTime))
+    return results
+
+def generateSyntheticDatabase(dbuser, dbpass, dbname, dbhost, patients = 10000, encounters = 20, labs = 5, skew = 1.5, socialHistoryFraction = 0.3, diagnosisFraction = 0.2, kidneyFailureFraction = 0.1, seed = 0.5, replace = False):
+    """
+    Fills a database with synthetic data shaped like the clinical database run.py expects - patient, encounter, diagnosis, social_history, and lab tables with the same columns and indexes on their key columns - so every export mode can be timed without access to real patient data.
+    
+    The number of encounters per patient follows a pareto distribution, so most patients have a few encounters and a handful have hundreds (capped at 50 times the mean), like a real clinic, and the secondary tables get very uneven maximum entries. Each encounter has around the given number of labs, a social history entry and a diagnosis some of the time, and a share of the diagnoses are acute kidney failure codes so the kidney failure marker in run.py matches some patients. The data is generated with a fixed random seed inside postgres, so the same arguments always give the same tables. The database is created if it doesn't exist, and the tables are only rebuilt if they were generated with different arguments (stored as a comment on the patient table) or replace is True.
+    
+    Takes the database user, password, name, and host as strings, the number of patients, the mean number of encounters per patient, and the mean number of labs per encounter as ints, the pareto shape of the encounter counts as a float above 1 (smaller is more skewed), the share of encounters with a social history entry, a diagnosis, and the share of diagnoses that are kidney failure as floats, the random seed as a float between -1 and 1, and replace as a boolean. Returns True if the tables were rebuilt.
+    """
+    parameters = {"patients": patients, "encounters": encounters, "labs": labs, "skew": skew, "socialHistoryFraction": socialHistoryFraction, "diagnosisFraction": diagnosisFraction, "kidneyFailureFraction": kidneyFailureFraction, "seed": seed}
+    
+    maintenanceConnection = psycopg2.connect("dbname='postgres' user='{user}' host='{host}' password='{password}'".format(user = dbuser, password = dbpass, host = dbhost))
+    maintenanceConnection.autocommit = True
+    maintenanceCursor = maintenanceConnection.cursor()
+    maintenanceCursor.execute("select 1 from pg_database where datname = %s", (dbname,))
+    if len(maintenanceCursor.fetchall()) == 0:
+        print("Creating database {d}...".format(d = dbname))
+        maintenanceCursor.execute("create database \"{d}\"".format(d = dbname))
+    maintenanceConnection.close()
+    
+    syntheticConnection = psycopg2.connect("dbname='{name}' user='{user}' host='{host}' password='{password}'".format(user = dbuser, password = dbpass, name = dbname, host = dbhost))
+    syntheticCursor = syntheticConnection.cursor()
+    syntheticCursor.execute("select obj_description(to_regclass('patient'), 'pg_class')")
+    if not replace and syntheticCursor.fetchall()[0][0] == json.dumps(parameters, sort_keys = True):
+        print("Synthetic tables in {d} are already up to date.".format(d = dbname))
+        syntheticConnection.close()
+        return False
+    
+    # The pareto scale that gives the requested mean encounter count for the given shape
+    scale = encounters * (skew - 1) / skew
+    statements = [("Setting up...", "set local max_parallel_workers_per_gather = 0; select setseed({seed})"), 
+                  ("Dropping old tables...", "drop table if exists patient, encounter, diagnosis, social_history, lab"), 
+                  ("Generating patients...", "create table patient as select g as patient_id, date '1930-01-01' + (random() * 27000)::int as date_of_birth, (array['F', 'M'])[1 + (random() < 0.48)::int] as gender, (array['White', 'Black', 'Asian', 'Other', null])[1 + floor(random() * 5)::int] as race1, case when random() < 0.05 then 'Other' end as race2, (array['White', 'Black', 'Asian', 'Other'])[1 + floor(random() * 4)::int] as mapped_race, (array['Not Hispanic', 'Hispanic', null])[1 + floor(random() * 3)::int] as ethnicity, (array['Not Hispanic', 'Hispanic'])[1 + floor(random() * 2)::int] as mapped_ethnicity, 'United States' as country, (array['NY', 'NJ', 'CT', 'PA'])[1 + floor(random() * 4)::int] as state from generate_series(1, {patients}) as g"), 
+                  ("Generating encounters...", "create table encounter as select (row_number() over ())::int as encounter_id, p.patient_id, date '2010-01-01' + (random() * 3650)::int as encounter_date, floor(random() * 40)::int as department_id from (select patient_id, least({cap}, floor({scale} * power(1 - random(), -1.0 / {skew})))::int as n from patient) as p cross join lateral generate_series(1, p.n)"), 
+                  ("Generating diagnoses...", "create table diagnosis as select (row_number() over ())::int as diagnosis_id, e.encounter_id, case when random() < {kidneyFailure} then (array['N17.0', 'N17.9', '584.9'])[1 + floor(random() * 3)::int] else (array['E11.9', 'I10', 'N18.3', 'E78.5', '401.9', 'J45.909'])[1 + floor(random() * 6)::int] end as icd_code, 0 as icd_type from encounter as e cross join lateral generate_series(1, 1 + floor(random() * 3)::int) where random() < {diagnosis}"), 
+                  ("Setting icd types...", "update diagnosis set icd_type = case when icd_code ~ '^[0-9]' then 9 else 10 end"), 
+                  ("Generating social histories...", "create table social_history as select e.encounter_id, (array['Yes', 'No', null])[1 + floor(random() * 3)::int] as sexually_active, (array['Y', null])[1 + floor(random() * 2)::int] as female_partner, (array['Y', null])[1 + floor(random() * 2)::int] as male_partner, (array['Never Smoker', 'Former Smoker', 'Current Every Day Smoker'])[1 + floor(random() * 3)::int] as smoking_status, round((random() * 2)::numeric, 1) as tobacco_pack_per_day, round((random() * 40)::numeric, 0) as tobacco_use_years, (array['Never', 'Quit', 'Yes'])[1 + floor(random() * 3)::int] as tobacco_user, (array['Cigarettes', 'Cigars', null])[1 + floor(random() * 3)::int] as tobacco_type, e.encounter_date - (random() * 10000)::int as smoke_start_date, case when random() < 0.5 then e.encounter_date - (random() * 1000)::int end as smoke_end_date, (array['Yes', 'No', 'Not Currently'])[1 + floor(random() * 3)::int] as alcohol_user, round((random() * 10)::numeric, 1) as alcohol_ounce_per_week, case when random() < 0.2 then 'wine, beer on weekends' end as alcohol_comment, (array['Wine', 'Beer', 'Liquor', null])[1 + floor(random() * 4)::int] as alcohol_type, (array['No', 'Never', null])[1 + floor(random() * 3)::int] as iv_drug_user, null::text as illicit_drug_frequency, null::text as illicit_drug_comment from encounter as e cross join lateral generate_series(1, 1 + (random() < 0.1)::int) where random() < {socialHistory}"), 
+                  ("Generating labs...", "create table lab as select e.encounter_id, (array['CREATININE', 'GFR ESTIMATED', 'BUN', 'POTASSIUM', 'SODIUM', 'HEMOGLOBIN', 'GLUCOSE', 'URINE PROTEIN'])[1 + floor(random() * 8)::int] as component_name, case when random() < 0.05 then 'see comment, result pending' end as text_results, round((random() * 150)::numeric, 2) as numeric_results from encounter as e cross join lateral generate_series(1, floor(random() * (2 * {labs} + 1))::int)"), 
+                  ("Creating indexes...", "alter table patient add primary key (patient_id); alter table encounter add primary key (encounter_id); create index on encounter (patient_id); create index on diagnosis (encounter_id); create index on social_history (encounter_id); create index on lab (encounter_id)"), 
+                  ("Analyzing tables...", "analyze patient; analyze encounter; analyze diagnosis; analyze social_history; analyze lab"), 
+                  ("Saving parameters...", "comment on table patient is {comment}")]
+    
+    bar = Bar("Statements    ", max = len(statements))
+    start = time.time()
+    for message, statement in statements:
+        bar.next()
+        syntheticCursor.execute(statement.format(seed = seed, 
+                                                 patients = int(patients), 
+                                                 cap = int(encounters * 50), 
+                                                 scale = scale, 
+                                                 skew = skew, 
+                                                 kidneyFailure = kidneyFailureFraction, 
+                                                 diagnosis = diagnosisFraction, 
+                                                 socialHistory = socialHistoryFraction, 
+                                                 labs = int(labs), 
+                                                 comment = "'" + json.dumps(parameters, sort_keys = True) + "'"))
+    syntheticConnection.commit()
+    bar.finish()
+    
+    syntheticCursor.execute("select (select count(*) from patient), (select count(*) from encounter), (select count(*) from diagnosis), (select count(*) from social_history), (select count(*) from lab), (select max(c) from (select count(*) as c from encounter group by patient_id) as z)")
+    counts = syntheticCursor.fetchall()[0]
+    print("Generated {p} patients, {e} encounters (up to {m} per patient), {d} diagnoses, {s} social histories, and {l} labs in {t:.2f} seconds.".format(p = counts[0], e = counts[1], d = counts[2], s = counts[3], l = counts[4], m = counts[5], t = time.time() - start))
+    syntheticConnection.close()
+    return True
+
+def setupSyntheticTables():
+    """
+    Replaces the tables in tableInfo with the configuration from run.py (the patient table with the kidney failure marker, and the encounter, social history, and lab tables), which the synthetic database from generateSyntheticDatabase is shaped for.
+    """
+    del tableInfo[:]
+    primaryTableWhereStatement = "exists (select 1 from encounter e1 where {alias}patient_id = e1.patient_id and exists (select 1 from diagnosis d1 where d1.encounter_id = e1.encounter_id and ((d1.icd_code like 'N17%' and d1.icd_type = 10) or (d1.icd_code like '584%' and d1.icd_type = 9))))"
+    setupAddPrimaryTable("patient", columnNames = ["date_of_birth", "gender", "race1", "race2", "mapped_race", "ethnicity", "mapped_ethnicity", "country", "state"], keyColumnName = "patient_id", whereMarkers = [("is_kidney_failure", primaryTableWhereStatement)])
+    setupAddSecondaryTable("encounter", columnNames = ["encounter_id", "encounter_date"], keyColumnName = "patient_id", parentTableName = "patient", parentKeyColumnName = "patient_id", orderBy = [("encounter_date", False)], limit = 200)
+    setupAddSecondaryTable("social_history", columnNames = ["encounter_id", "sexually_active", "female_partner", "male_partner", "smoking_status", "tobacco_pack_per_day", "tobacco_use_years", "tobacco_user", "tobacco_type", "smoke_start_date", "smoke_end_date", "alcohol_user", "alcohol_ounce_per_week", "alcohol_comment", "alcohol_type", "iv_drug_user", "illicit_drug_frequency", "illicit_drug_comment"], keyColumnName = "encounter_id", parentTableName = "encounter", parentKeyColumnName = "encounter_id", limit = 1)
+    setupAddSecondaryTable("lab", columnNames = ["encounter_id", "component_name", "text_results", "numeric_results"], keyColumnName = "encounter_id", parentTableName = "encounter", parentKeyColumnName = "encounter_id", limit = 5)
+
+def benchmarkModePart(arguments):
+    """
+    Runs one export for benchmarkModes in a separate process, so its peak memory use and query statistics only cover that export.
+    
+    Takes a tuple containing the tableInfo list, the connection string, the name of the file to write, and the dictionary of arguments to pass to run. Opens its own database connection. Returns a dictionary with the wall time in seconds, the peak resident memory in bytes of the process or the largest process it started (None if it can't be measured), the number of queries run, and the size of the file in bytes.
+    """
+    import main
+    tables, partConnectionString, filename, runArguments = arguments
+    tableInfo[:] = tables
+    for table in tableInfo:
+        table.maxEntriesCounted = False
+    
+    main.conn = psycopg2.connect(partConnectionString)
+    main.cursor = main.conn.cursor()
+    try:
+        start = time.time()
+        run(filename = filename, **runArguments)
+        elapsed = time.time() - start
+        queries = sum(statistics["count"] for statistics in main.queryStatistics.values())
+    finally:
+        main.cursor.close()
+        main.conn.close()
+    
+    peakMemory = peakMemoryUsage()
+    if not resource == None:
+        # Worker processes started by the export (such as the buffered mode's writers) count too, so the largest of them is taken if it's bigger
+        peakMemory = max(peakMemory, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * (1 if sys.platform == "darwin" else 1024))
+    size = sum(os.path.getsize(os.path.join(os.path.dirname(filename), name)) for name in os.listdir(os.path.dirname(filename)) if name.startswith(os.path.basename(filename)))
+    return {"seconds": elapsed, "peakMemory": peakMemory, "queries": queries, "bytes": size}
+
+def benchmarkModes(modes = default, resultsFile = None):
+    """
+    Times a full export with each of the given modes on the tables in tableInfo, and prints the wall time, primary rows per second, peak memory use, number of queries, and size of the file for each.
+    
+    Each export runs in its own process with a fresh connection (see benchmarkModePart), so one mode's memory use or cached maximum entries can't affect the next, and writes to a temporary directory that is removed afterwards. Meant to be used with the synthetic database from generateSyntheticDatabase, so the numbers can be compared between changes to main.py. Exports that fail are reported and skipped. Takes a list of modes (default buffered, copy, localjoin, slow, and pivot), where each is either a mode name or a dictionary of arguments for run that includes the mode, and optionally the name of a json file to append the results to. Returns the list of results.
+    """
+    import main
+    if modes == default:
+        modes = ["buffered", "copy", "localjoin", "slow", "pivot"]
+    
+    print("Counting primary keys...")
+    rows = countPrimaryKeys()
+    
+    directory = tempfile.mkdtemp()
+    context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+    results = []
+    for i, runArguments in enumerate(modes):
+        if not isinstance(runArguments, dict):
+            runArguments = {"mode": runArguments}
+        label = ", ".join("{k} = {v}".format(k = key, v = value) for key, value in runArguments.items())
+        print("Benchmarking export with {l}...".format(l = label))
+        # An executor's worker isn't a daemon process, so the buffered mode can still start processes of its own inside it
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context = context) as executor:
+            try:
+                result = executor.submit(benchmarkModePart, (list(tableInfo), main.connectionString, os.path.join(directory, "export{i}.csv".format(i = i)), runArguments)).result()
+                result["rowsPerSecond"] = rows / result["seconds"]
+            except Exception as e:
+                # A mode that fails on some shape of data is worth recording rather than stopping the other benchmarks
+                print("Export with {l} failed: {e}".format(l = label, e = str(e).strip()))
+                result = {"error": str(e).strip()}
+        result.update({"arguments": runArguments, "label": label, "rows": rows})
+        results.append(result)
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    
+    print("{l:<60} {t:>9} {r:>11} {m:>10} {q:>8} {s:>10}".format(l = "Export", t = "Seconds", r = "Rows/sec", m = "Peak MB", q = "Queries", s = "File MB"))
+    for result in results:
+        if "error" in result:
+            print("{l:<60} failed".format(l = result["label"]))
+            continue
+        print("{l:<60} {t:>9.2f} {r:>11.0f} {m:>10} {q:>8} {s:>10.1f}".format(l = result["label"], t = result["seconds"], r = result["rowsPerSecond"], m = "{m:.0f}".format(m = result["peakMemory"] / 1048576) if not result["peakMemory"] == None else "-", q = result["queries"], s = result["bytes"] / 1048576))
+    
+    if not resultsFile == None:
+        with open(resultsFile, "a") as file:
+            file.write(json.dumps({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}, default = str) + "\n")
+        print("Results appended to {f}.".format(f = resultsFile))
+    return results
+
+if __name__ == "__main__":
+
+    if "modes" in sys.argv[1:]:
+        # Generates the synthetic database and times every export mode on it
+        generateSyntheticDatabase(dbuser, dbpass, syntheticDbname, dbhost)
+        cursor = connect(dbuser, dbpass, syntheticDbname, dbhost)
+        setupSyntheticTables()
+        benchmarkModes(resultsFile = "benchmark_results.jsonl")
+        close()
+        sys.exit()
+
+
+    # Attempts to connect to the database
+    cursor = connect(dbuser, dbpass, dbname, dbhost)
+
+    # Supply information for the tables you'd like to benchmark here, the same way as in run.py
+    setupAddPrimaryTable("patient", keyColumnName = "patient_id")
+    setupAddSecondaryTable("encounter", columnNames = ["encounter_id", "encounter_date"], keyColumnName = "patient_id", parentTableName = "patient", parentKeyColumnName = "patient_id", orderBy = [("encounter_date", False)], limit = 200)
+    setupAddSecondaryTable("lab", columnNames = ["encounter_id", "component_name", "text_results", "numeric_results"], keyColumnName = "encounter_id", parentTableName = "encounter", parentKeyColumnName = "encounter_id", limit = 5)
+
+    print("Setting up temporary tables...")
+    for table in tableInfo:
+        createJoinedTemporaryTable(table, tableInfo[0])
+
+    print("Benchmarking buffer reads...")
+    for table in tableInfo:
+        benchmarkBuffer(table, prefetch = False)
+        benchmarkBuffer(table)
+
+    print("Benchmarking statement overhead...")
+    benchmarkStatementOverhead()
+
+    print("Benchmarking the csv writer...")
+    benchmarkWriter()
+
+    print("Benchmarking compression...")
+    benchmarkCompression()
+
+    # Closes the database connection
+    close()
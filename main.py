@@ -1,141 +1,348 @@
 import psycopg2
+import psycopg2.pool
 import sys
+import os
+import time
+import shutil
+import csv
+import json
+import hashlib
+import tempfile
+import multiprocessing
+import threading
+import uuid
+import gzip
+import io
+import queue
+import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from progress.bar import Bar
 from collections import deque
 
+# pyarrow is only needed for parquet and arrow output files (see openExportWriter)
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# zstandard is only needed for zstd compressed export files (see CompressedExportFile)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
 # Default sentinel value for function default checking
 default = object()
 
 # Contains the Table instances used to store export information. tableInfo[0] contains the primary table. Order matters in some cases - child tables should always come after their parents!
 tableInfo = []
 
+# Contains the Cohort instances for exports that write several cohorts of the same tables at once (see setupAddCohort)
+cohortInfo = []
+
+# Kind of table used for the buffered export's staging tables, and the suffix added to their names. Temporary tables can only be seen by the connection that made them, so parallel staging switches to unlogged tables with a suffix unique to the run.
+stagingTableType = "temporary"
+stagingTableSuffix = ""
+
+# Column, key, index, and row estimate information for every table in the schemas on the search path, loaded with one catalog query the first time it's needed (see loadSchemaMetadata), and the file it is cached in between runs, or None if it isn't cached (see setupSchemaCache)
+schemaMetadata = None
+schemaCacheFile = None
+
+# Table names that were still missing after the schema metadata was loaded again for them, so looking them up again doesn't reload it (see getTableMetadata)
+schemaMetadataMisses = set()
+
+# The version of the schema metadata stored in the cache file, raised whenever its contents change so older files are read from the catalog again
+schemaCacheVersion = 2
+
+# Settings for the cache of staging tables kept between runs (see setupStagingCache), or None if staging tables aren't cached
+stagingCache = None
+
+# Whether staging tables get covering indexes holding every exported column, so they can be read with index-only scans (see setupCoveringIndexes)
+coveringIndexes = False
+
+# Compression codec for parquet and arrow export files, and compression level for every compressed export file, or None for the defaults (set by run)
+exportCompression = None
+exportCompressionLevel = None
+
+# File name extensions of the compression codecs for csv export files
+compressionExtensions = {"gzip": ".gz", "zstd": ".zst"}
+
+# Statistics for each sql template run through runQuery, the timings of each phase, and the plans of explained queries for the current run (see writeRunReport)
+queryStatistics = {}
+phaseTimings = []
+queryPlans = []
+runStart = time.time()
+instrumentationLock = threading.Lock()
+
+# The prepared statements created so far on each connection, as (backend process id, connection id, statement name) tuples (see runPreparedQuery)
+preparedStatements = set()
+
+# Holds the connection and cursor used by the current thread when it isn't using the global ones (see getCursor)
+threadConnection = threading.local()
+
 #
 # Run.py functions
 #
 
-def run(mode = "buffered", filename = "export.csv", buffer = 10000):
+def run(mode = "buffered", filename = "export.csv", buffer = 10000, workers = 1, processes = 1, memoryBudget = 0, batch = 1000, dumpQuery = False, widthFile = None, checkpoint = None, since = None, outputFormat = default, layout = "wide", compression = default, compressionLevel = None, report = None, explainSlowest = 0):
     """
     Attempts to run the export using the inforamtion given in tableInfo.
     
     Keyword Arguments:
     mode -- Tells the script how to behave, string (default "temptable")
-        "slow" - Performs many small queries. Likely to be noticeably slower than any of the other options, but uses minimal memory and requires no table creation priveleges.
-        "localjoin" - Queries whole tables and joins/builds the export before writing the file. Uses a lot more memory than "slow", but it should take less time and still requires no table creation priveleges.
+        "slow" - Queries each table for one batch of primary keys at a time. Likely to be noticeably slower than any of the other options, but uses minimal memory and requires no table creation priveleges.
+        "localjoin" - Queries each whole table once and joins/builds the export in memory with hash indexes before writing the file. Uses a lot more memory than "slow", but it should take less time and still requires no table creation priveleges.
         "buffered" - Creates export-specific sorted temporary tables in the database instead of joining in python, then queries portions of those. Requires temporary table creation priveleges.
+        "pivot" - Generates one sql query that builds the finished export rows in the database, using array_agg to spread each table's entries across columns. Requires no table creation priveleges.
+        "copy" - Creates the same temporary tables as "buffered", but streams them out of the database as raw csv with copy commands. When every secondary table has at most one entry per primary key, the whole export is a single copied query. Requires temporary table creation priveleges.
+        "delta" - Re-exports only the primary keys with rows that changed since the last checkpointed export (see checkpoint and since) and merges them into that export's file. Requires temporary table creation priveleges.
     filename -- String value that denotes the name of the file the export will write to, string (default "export.csv")
-    buffer -- Defines the size of each table's buffer for the \"buffered\" mode with no effect on other modes, int (default 10000)
+    buffer -- Defines the size of each table's buffer for the \"buffered\" mode, or the number of rows fetched at once for the \"pivot\" mode, with no effect on other modes, int (default 10000)
+    workers -- The number of database connections used to build temporary tables at the same time in the \"buffered\" mode, int (default 1)
+    processes -- The number of processes that write ranges of the export at the same time in the \"buffered\" mode, int (default 1)
+    memoryBudget -- The most memory in megabytes the \"localjoin\" mode may expect to use before it refuses to run, or the memory the \"buffered\" mode sizes its pages to stay within instead of using a fixed buffer size (see assembleBufferedRows), where 0 is no limit, int (default 0)
+    batch -- The number of primary keys the \"slow\" mode fetches entries for at once, int (default 1000)
+    dumpQuery -- If true, the \"pivot\" mode writes its generated sql to the file instead of running the export, boolean (default False)
+    widthFile -- Optionally the name of a json file the maximum entries for each table are saved to, and loaded from on later runs with the same table configuration so the \"slow\" and \"pivot\" modes can skip counting them, string (default None)
+    checkpoint -- Optionally the name of a json file the \"buffered\" mode records its progress in, so an interrupted export carries on where it stopped when run again with the same arguments. The \"delta\" mode reads and updates the checkpoint of the export it merges into, string (default None)
+    since -- The watermark value the \"delta\" mode looks for changes after, defaulting to the time the checkpointed export last started, any type comparable with the watermark columns (default None)
+    outputFormat -- The format of the export file, either "csv", "parquet", or "arrow", with parquet and arrow files only written by the \"buffered\", \"slow\", \"localjoin\", and \"pivot\" modes, string (default from the file name's extension, otherwise "csv")
+    layout -- Either "wide" for one row per primary key with each table's entries spread across numbered columns, "long" for one row per entry (see longLayoutRows and assembleBufferedLongRows), or "tables" for one file per table with one row per entry, named after the export file (see writeBufferedTableExports), where only the "buffered" mode writes one file per table, string (default "wide")
+    compression -- Either "gzip" or "zstd" to compress the export file as it is written, or None to leave it uncompressed. Csv files get the codec's extension added if they don't have it already, while parquet and arrow files use it as their internal codec, string (default from the file name's extension, otherwise None)
+    compressionLevel -- The compression level to use, where higher levels give smaller files but take longer, int (default 6 for gzip and 3 for zstd)
+    report -- Optionally the name of a json file to write the run report to, with the time taken by each phase and statistics for every query (see writeRunReport), string (default None)
+    explainSlowest -- The number of slowest queries to run again with explain (analyze, buffers) for the report, int (default 0)
     """
     print("Starting export with mode \"{m}\"...".format(m = mode))
+    resetInstrumentation()
+    
+    global exportCompression
+    global exportCompressionLevel
+    if compression == default:
+        compression = exportCompressionFromFilename(filename)
+    if outputFormat == default:
+        outputFormat = exportFormatFromFilename(filename)
+    if not compression == None and (mode == "delta" or not checkpoint == None):
+        raise OutputFormatException("The {m} mode{c} can't write compressed files.".format(m = mode, c = " with a checkpoint" if mode == "buffered" else ""))
+    if outputFormat == "csv" and not compression == None and not exportCompressionFromFilename(filename) == compression:
+        filename += compressionExtensions[compression]
+    exportCompression = compression
+    exportCompressionLevel = compressionLevel
+    if not outputFormat == "csv" and (mode in ("copy", "delta") or not checkpoint == None):
+        raise OutputFormatException("Only csv files can be written by the {m} mode{c}.".format(m = mode, c = " with a checkpoint" if mode == "buffered" else ""))
+    if not layout == "wide" and (mode in ("copy", "delta") or not checkpoint == None):
+        raise OutputFormatException("Only the wide layout can be written by the {m} mode{c}.".format(m = mode, c = " with a checkpoint" if mode == "buffered" else ""))
+    if len(cohortInfo) > 0 and (not mode == "buffered" or not checkpoint == None):
+        raise CohortException("Cohorts can only be exported by the buffered mode without a checkpoint.")
+    if layout == "tables" and (not mode == "buffered" or not checkpoint == None or len(cohortInfo) > 0):
+        raise OutputFormatException("A file per table can only be written by the buffered mode without a checkpoint or cohorts.")
+    
+    if not widthFile == None and not mode in ("buffered", "copy", "localjoin"):
+        loadMaxEntries(widthFile)
     
-    if mode == "buffered":
+    if mode == "buffered" and not checkpoint == None:
+        writeCheckpointedExport(filename, buffer, checkpoint, memoryBudget)
+    
+    elif mode == "buffered" or mode == "copy":
         
+        if len(cohortInfo) > 0 and processes > 1:
+            print("Cohorts are written by one process, writing with one process instead.")
+            processes = 1
         print("Setting up temporary tables...")
-        for table in tableInfo:
-            createJoinedTemporaryTable(table, tableInfo[0])
+        if len(cohortInfo) > 0:
+            primaryFilter = addCohortFilters()
+        try:
+            start = time.time()
+            success = createJoinedTemporaryTables(workers, shared = processes > 1 and mode == "buffered", cache = not stagingCache == None)
+            recordPhase("staging", start)
+            if success:
+                start = time.time()
+                if mode == "copy":
+                    writeCopyExport(filename)
+                elif len(cohortInfo) > 0:
+                    writeCohortExports(filename, buffer, outputFormat, layout, memoryBudget)
+                else:
+                    writeBufferedExport(filename, buffer, processes, outputFormat, layout, memoryBudget)
+                recordPhase("export", start)
+                # Explained before the staging tables are dropped, since most of the slow queries read them
+                explainSlowestQueries(explainSlowest)
+        finally:
+            if not stagingCache == None:
+                print("Evicting old staging tables from the cache...")
+                releaseCachedStagingTables()
+            elif stagingTableType == "unlogged":
+                print("Dropping staging tables...")
+                dropJoinedTemporaryTables()
+            if len(cohortInfo) > 0:
+                removeCohortFilters(primaryFilter)
+
+    elif mode == "localjoin":
+        writeLocaljoinExport(filename, memoryBudget, outputFormat, layout)
         
-        print("Counting maximum entries for secondary tables...")
-        bar = Bar("Tables        ", max = len(tableInfo) - 1)
-        for i in range(1, len(tableInfo)):
-            if not tableInfo[i].forceOneToOne:
-                bar.next()
-                runQuery("select max(a.c) from (select count(z.{c}) as c from {t} as z group by {c}) as a".format(c = "export_primary", t = temporaryTableName(table)))
-                tableInfo[i].maxEntries = cursor.fetchall()[0][0]
-        for i in range(1, len(tableInfo)):
-            if tableInfo[i].forceOneToOne:
-                bar.next()
-                tableInfo[i].maxEntries = tableInfo[i].parentTable.maxEntries
-        bar.finish()
+    elif mode == "slow" or mode == "pivot":
+        try:
+            if mode == "slow":
+                writeSlowExport(filename, batch, outputFormat, layout)
+            else:
+                writePivotExport(filename, buffer, dumpQuery, outputFormat, layout)
+        except WidthException as e:
+            # Maximum entries loaded from the width file are out of date once the data has grown, so they're counted again rather than losing entries
+            if widthFile == None:
+                raise
+            print("{e} The maximum entries in {f} are out of date, counting them again...".format(e = str(e), f = widthFile))
+            for table in tableInfo[1:]:
+                table.maxEntriesCounted = False
+            if mode == "slow":
+                writeSlowExport(filename, batch, outputFormat, layout)
+            else:
+                writePivotExport(filename, buffer, dumpQuery, outputFormat, layout)
+        
+    elif mode == "delta":
+        writeDeltaExport(filename, buffer, checkpoint, since)
         
-        with open(filename, "w+") as file:
-            
-            print("Writing columns...")
-            writeColumnHeaders(file)
-            
-            print("Writing entries...")
-            bufferList = {table:Buffer(table, buffer) for table in tableInfo}
-            nextEntry = {table:next(bufferList[table]) for table in tableInfo}
-            runQuery("select count(*) from {t}".format(t = temporaryTableName(tableInfo[0])))
-            bar = LargerDequeBar("Rows          ", max = cursor.fetchall()[0][0], suffix = "%(index)d/%(max)d - ETA: %(eta_td)s - Elapsed: %(elapsed_td)s        ")
-            
-            while not nextEntry[tableInfo[0]] == None:
-                
-                bar.next()
-                primaryKey = nextEntry[tableInfo[0]][0]
-                
-                for table in tableInfo:
-                    
-                    entryCount = 0
-                    
-                    while not nextEntry[table] == None and nextEntry[table][0] == primaryKey:
-                        
-                        entryCount += 1
-                        
-                        for i in range(1, len(nextEntry[table])):
-                            
-                            file.write(str(nextEntry[table][i]) + ",")
-                            
-                        nextEntry[table] = next(bufferList[table])
-                        
-                    file.write("," * ((table.maxEntries - entryCount) * len([column for column in table.columns if column.include == 2])))
-                    
-                file.seek(file.tell() - 1)
-                file.write("\n")
-                
-            bar.finish()
-            
-            print("Export to file {f} completed, exiting.".format(f = filename))
-            
     else:
-        print("Counting maximum entries for each table...")
-        updateMaxEntries()
-        print("Querying primary table keys...")
-        primaryKeys = queryPrimaryKeys()
-        if mode == "localjoin":
-            """with open(filename, "w+") as file:
-                print("Writing columns...")
-                writeColumnHeaders(file)
-                print("Creating dictionaries...")
-                exportWidth = 0
-                for table in tableInfo:
-                    exportWidth += table.maxEntries * (len(table.columns) - (0 if table.displayKeyColumn else 1))
-                exportData = {key:[None for j in range(exportWidth)] for key in primaryKeys}
-                keyDict = {table.parentTable:dict() for table in tableInfo if not (table.parentTable == None or table.parentTable == tableInfo[0])}
-                tableDataStartingIndex = 0
-                print("Querying tables...")
-                barQuery = Bar("Tables Queried", max = len(tableInfo))
-                for table in tableInfo:
-                    barQuery.next()
-                    tableData = {key:tableDataStartingIndex for key in exportData.keys()}
-                    tableDataStartingIndex += table.maxEntries * len(table.columns)
-                    keyColumnIndex = table.columns.index(table.keyColumn)
-                    if table == tableInfo[0]:
-                        entryData = entryTableExportData(mode, table, None)
-                    elif table.parentTable == tableInfo[0]:
-                        entryData = entryTableExportData(mode, table, primaryKeys)
-                    else:
-                        entryData = entryTableExportData(mode, table, keyDict[table.parentTable].keys())
-                    for 
-                    if table in keyDict.keys():
-                        pass"""
-        elif mode == "slow":
-            with open("export.csv", "w+") as file:
-                print("Writing columns...")
-                writeColumnHeaders(file)
-                print("Writing entries...")
-                bar = Bar("Row", max = len(primaryKeys))
-                for primaryKey in primaryKeys:
-                    bar.next()
-                    for table in tableInfo:
-                        tableData = entryTableExportData(mode, table, primaryKey)
-                        for entryData in tableData:
-                            for data in entryData:
-                                file.write(str(data) + ",")
-                        file.write("," * ((table.maxEntries - len(tableData)) * len(tableData[0])))
-                    file.seek(file.tell() - 1)
-                    file.write("\n")
-                bar.finish()
-
-def setupAddPrimaryTable(tableName, columnNames = default, keyColumnName = default, displayKeyColumn = True, whereInclude = "", whereMarkers = []):
+        print("Unknown export mode \"{m}\".".format(m = mode))
+        return
+    
+    if not mode in ("buffered", "copy") or not checkpoint == None:
+        explainSlowestQueries(explainSlowest)
+    
+    # The widths of a multiple cohort export only cover the patients in the cohorts, so they aren't saved for the whole table setup
+    if not widthFile == None and not dumpQuery and len(cohortInfo) == 0:
+        saveMaxEntries(widthFile)
+    
+    if not report == None:
+        writeRunReport(report, mode)
+
+def previewExport(sample = 1000, filename = "preview.csv", modes = ("buffered",), method = "keys", seed = 0, buffer = 10000, batch = 1000, outputFormat = default, layout = "wide", report = None):
+    """
+    Runs the export on a sample of the primary keys and estimates how wide and large the whole export will be and how long each mode would take, see readme.md.
+    
+    Keyword Arguments:
+    sample -- The number of primary keys to sample, int (default 1000)
+    filename -- The name of the file to write the first mode's sample export to, string (default "preview.csv")
+    modes -- The modes to run on the sample, any of "buffered", "copy", "localjoin", "slow", and "pivot" (see run), tuple of strings (default ("buffered",))
+    method -- Either "keys" to sample exactly that many keys, or "tablesample" to sample about that many with tablesample bernoulli, string (default "keys")
+    seed -- The seed that picks the sample, int (default 0)
+    buffer -- The buffer size passed to run, int (default 10000)
+    batch -- The batch size passed to run, int (default 1000)
+    outputFormat -- The format of the sample export, see run, string (default from the file name's extension)
+    layout -- The layout of the sample export, see run, string (default "wide")
+    report -- Optionally the name of a json file to write the preview to, string (default None)
+    
+    Returns the preview as a dictionary, or None if the sample couldn't be taken.
+    """
+    for mode in modes:
+        if not mode in ("buffered", "copy", "localjoin", "slow", "pivot"):
+            print("Mode \"{m}\" can't be previewed.".format(m = mode))
+            return None
+    primaryTable = tableInfo[0]
+    whereInclude = primaryTable.whereInclude
+    hasWhere = not (whereInclude == None or whereInclude == "")
+    
+    print("Estimating the number of primary keys...")
+    estimatedKeys = explainEstimate(primaryJoinedTemporaryTableSelectQuery(primaryTable))
+    
+    print("Sampling {n} primary keys...".format(n = sample))
+    # Literal percent signs in the whereInclude statement need doubling since the sample size and seed are bound as parameters
+    where = (" where " + whereInclude.format(alias = countKeyColumnAlias() + ".").replace("%", "%%")) if hasWhere else ""
+    if method == "tablesample":
+        percentage = min(100.0, 100.0 * sample / estimatedKeys) if estimatedKeys > 0 else 100.0
+        success = runQuery("select {alias}.{key} from {table} as {alias} tablesample bernoulli (%s) repeatable (%s){where}".format(alias = countKeyColumnAlias(), key = primaryTable.keyColumn.name, table = primaryTable.name, where = where), (percentage, seed))
+    else:
+        success = runQuery("select {alias}.{key} from {table} as {alias}{where} order by md5({alias}.{key}::text || %s) limit %s".format(alias = countKeyColumnAlias(), key = primaryTable.keyColumn.name, table = primaryTable.name, where = where), (str(seed), sample))
+    if not success:
+        getConnection().rollback()
+        return None
+    keys = sorted(row[0] for row in getCursor().fetchall())
+    if len(keys) == 0:
+        print("The sample is empty, so there is nothing to preview.")
+        return None
+    # A keys sample smaller than asked for holds every key, so the count is exact
+    totalKeys = len(keys) if method == "keys" and len(keys) < sample else max(estimatedKeys, len(keys))
+    scale = totalKeys / len(keys)
+    
+    global stagingCache
+    previousStagingCache = stagingCache
+    stagingCache = None
+    widths = [(table, table.maxEntries, table.maxEntriesCounted) for table in tableInfo]
+    def useSample(sampleKeys):
+        # The sampled keys are written into the condition as literals, so every query of every mode sees the same sample without evaluating the sampling again. Braces are doubled since the condition is formatted with the alias later
+        sampleCondition = "{alias}" + primaryTable.keyColumn.name + " in " + getCursor().mogrify("%s", (tuple(sampleKeys),)).decode("utf-8").replace("{", "{{").replace("}", "}}")
+        primaryTable.whereInclude = "(" + whereInclude + ") and " + sampleCondition if hasWhere else sampleCondition
+        for table, maxEntries, maxEntriesCounted in widths:
+            table.maxEntries = maxEntries
+            table.maxEntriesCounted = maxEntriesCounted
+    
+    useSample(keys)
+    preview = {"sampledKeys": len(keys), "estimatedKeys": totalKeys, "tables": {}, "modes": {}}
+    try:
+        print("Counting entries per primary key in the sample...")
+        queries = stagingSelectQueries()
+        for table in tableInfo[1:]:
+            if not table in queries:
+                continue
+            query = "select percentile_disc(0.5) within group (order by coalesce({c}.n, 0)), percentile_disc(0.99) within group (order by coalesce({c}.n, 0)), coalesce(max({c}.n), 0), coalesce(sum({c}.n), 0)::bigint from (select distinct export_primary from ({primary}) as {p}) as {k} left join (select export_primary, count(*) as n from ({select}) as {s} group by export_primary) as {c} on {k}.export_primary = {c}.export_primary"
+            query = query.format(primary = queries[primaryTable], select = queries[table], p = countKeyColumnAlias(3), k = countKeyColumnAlias(4), s = countKeyColumnAlias(5), c = countKeyColumnAlias(6))
+            if not runQuery(query):
+                getConnection().rollback()
+                continue
+            p50, p99, maximum, entries = getCursor().fetchall()[0]
+            preview["tables"][table.name] = {"p50": p50, "p99": p99, "max": maximum, "sampleRows": entries, "estimatedRows": int(entries * scale)}
+        preview["estimatedColumns"] = sum(len([column for column in table.columns if column.include == 2]) * (preview["tables"][table.name]["max"] if table.name in preview["tables"] else 1) for table in tableInfo)
+        
+        temporaryDirectory = tempfile.mkdtemp(prefix = "export_preview_")
+        try:
+            for i, mode in enumerate(modes):
+                # Every other sampled key is run first, so the time can be split into a fixed part and a part per primary key
+                timings = []
+                for sampleKeys in ([keys[::2]] if len(keys) > 1 else []) + [keys]:
+                    useSample(sampleKeys)
+                    modeFilename = filename if i == 0 and sampleKeys == keys else os.path.join(temporaryDirectory, os.path.basename(filename))
+                    start = time.time()
+                    run(mode = mode, filename = modeFilename, buffer = buffer, batch = batch, outputFormat = outputFormat, layout = layout)
+                    timings.append((len(sampleKeys), time.time() - start))
+                    # Temporary staging tables are kept until the connection closes, so they're dropped before the next run builds them again
+                    if mode in ("buffered", "copy"):
+                        dropJoinedTemporaryTables()
+                # Compression and the tables layout can write the export under other names, so every file written since the run started is counted
+                names = [modeFilename] + [suffixedFilename(modeFilename, table.name) for table in tableInfo]
+                names = [name + extension for name in names for extension in [""] + list(compressionExtensions.values())]
+                outputBytes = sum(os.path.getsize(name) for name in set(names) if os.path.exists(name) and os.path.getmtime(name) >= start - 1)
+                seconds = timings[-1][1]
+                perKey = max(0.0, (timings[-1][1] - timings[0][1]) / (timings[-1][0] - timings[0][0])) if len(timings) > 1 else seconds / len(keys)
+                fixedSeconds = max(0.0, seconds - perKey * len(keys))
+                preview["modes"][mode] = {"sampleSeconds": seconds, "sampleBytes": outputBytes, "fixedSeconds": fixedSeconds, "secondsPerKey": perKey, "estimatedSeconds": fixedSeconds + perKey * totalKeys, "estimatedBytes": int(outputBytes * scale)}
+        finally:
+            shutil.rmtree(temporaryDirectory, ignore_errors = True)
+    finally:
+        stagingCache = previousStagingCache
+        primaryTable.whereInclude = whereInclude
+        for table, maxEntries, maxEntriesCounted in widths:
+            table.maxEntries = maxEntries
+            table.maxEntriesCounted = maxEntriesCounted
+    
+    print("\nPreview from a sample of {n} of ~{t} primary keys ({p:.1%}), written to {f}:".format(n = len(keys), t = int(totalKeys), p = len(keys) / totalKeys, f = filename))
+    for name, statistics in preview["tables"].items():
+        print("  {t}: entries per primary key p50 {p50}, p99 {p99}, max {max} (~{r} rows in total)".format(t = name, p50 = statistics["p50"], p99 = statistics["p99"], max = statistics["max"], r = statistics["estimatedRows"]))
+    print("  At least {c} columns in the wide layout".format(c = preview["estimatedColumns"]))
+    for mode, statistics in preview["modes"].items():
+        print("  {m}: ~{s:.1f} seconds and ~{b:.1f} MB for the whole export ({ss:.2f} seconds and {sb:.1f} KB for the sample)".format(m = mode, s = statistics["estimatedSeconds"], b = statistics["estimatedBytes"] / 1048576, ss = statistics["sampleSeconds"], sb = statistics["sampleBytes"] / 1024))
+    
+    if not report == None:
+        with open(report, "w") as file:
+            json.dump(preview, file, indent = 4, default = str)
+        print("Preview written to {f}.".format(f = report))
+    
+    return preview
+
+def setupAddPrimaryTable(tableName, columnNames = default, keyColumnName = default, displayKeyColumn = True, whereInclude = "", whereMarkers = [], watermarkColumnName = None):
     """
     Stores the export settings for the primary table.
     
@@ -146,6 +353,7 @@ def setupAddPrimaryTable(tableName, columnNames = default, keyColumnName = defau
     displayKeyColumn -- If false, this will prevent the export from writing the table's key column, boolean (default True)
     whereInclude -- Optionally the statement in a where query used to limit the rows that are expored, string (default "")
     whereMarkers -- Optionally adds new columns that contain either one or zero for each row based on a where clause provided, list of tuples (default [])
+    watermarkColumnName -- Optionally the name of a column that records when each row last changed, used by the \"delta\" mode to find changed patients, string (default None)
     """
     if columnNames == default:
         columnNames = [col[0] for col in getAllColumnNamesFromTableName(tableName)]
@@ -158,9 +366,11 @@ def setupAddPrimaryTable(tableName, columnNames = default, keyColumnName = defau
     for marker in whereMarkers:
         columns.append(Column("(case when " + marker[1] + " then 1 else 0 end) as " + marker[0], marker[0], "integer"))
     table = Table(tableName, columns, keyColumn)
+    addTableMetadata(table)
     table.displayKeyColumn = displayKeyColumn
     table.whereInclude = whereInclude
     table.whereMarkers = whereMarkers
+    table.watermarkColumn = watermarkColumnName
     
     if len(tableInfo) == 0:
         tableInfo.append(table)
@@ -170,27 +380,33 @@ def setupAddPrimaryTable(tableName, columnNames = default, keyColumnName = defau
     print("Primary table {t} added.".format(t = tableName))
     return table
 
-def setupAddSecondaryTable(tableName, columnNames = default, keyColumnName = default, parentTableName = default, parentKeyColumnName = default, displayKeyColumn = True, forceOneToOne = False, orderBy = [], limit = 0):
+def setupAddSecondaryTable(tableName, columnNames = default, keyColumnName = default, parentTableName = default, parentKeyColumnName = default, displayKeyColumn = True, forceOneToOne = False, orderBy = [], limit = 0, watermarkColumnName = None):
     """
     Stores the export settings for a table with a one-to-one relationship to the parent table.
     
     Keyword arguments:
     tableName -- The name of the table, string
     columnNames -- The names of the columns that should be imported, string[] (default all column names in table)
-    keyColumnName -- The name of the column used to reference the parent table, string (default columnNames[0])
-    parentTableName -- The name of the table that the key links to, string (default primary table name)
-    parentKeyColumnName -- The name of the column in the parent table that contains the foreign keys, string (default keyColumnName)
+    keyColumnName -- The name of the column used to reference the parent table, string (default from a foreign key to or from a table already set up, see suggestTableLink, otherwise columnNames[0])
+    parentTableName -- The name of the table that the key links to, string (default from a foreign key like keyColumnName, otherwise primary table name)
+    parentKeyColumnName -- The name of the column in the parent table that contains the foreign keys, string (default from a foreign key like keyColumnName, otherwise keyColumnName)
     displayKeyColumn -- If false, this will prevent the export from writing the table's key column, boolean (default True)
     forceOneToOne -- If trie, this will set the maximum number of entries to be that of its parent table, boolean (default False)
     orderBy -- Optionally provides additional ordering instructions, list of tuples (default [])
     limit -- Limits the number of entries included for a specific parent key where 0 is no limit, integer (default 0)
+    watermarkColumnName -- Optionally the name of a column that records when each row last changed, used by the \"delta\" mode to find changed patients, string (default None)
     """
     if columnNames == default:
         columnNames = [col[0] for col in getAllColumnNamesFromTableName(tableName)]
+    if keyColumnName == default or parentKeyColumnName == default:
+        link = suggestTableLink(tableName, None if parentTableName == default else parentTableName, None if keyColumnName == default else keyColumnName, None if parentKeyColumnName == default else parentKeyColumnName)
+        if not link == None:
+            keyColumnName, parentTableName, parentKeyColumnName = [value if not value == default else suggested for value, suggested in zip((keyColumnName, parentTableName, parentKeyColumnName), link)]
+            print("Linking {t}.{k} to {p}.{pk} from a foreign key.".format(t = tableName, k = keyColumnName, p = parentTableName, pk = parentKeyColumnName))
     if keyColumnName == default:
         keyColumnName = columnNames[0]
     if parentTableName == default:
-        parentTableName = tableInfo[0].table.name
+        parentTableName = tableInfo[0].name
     if parentKeyColumnName == default:
         parentKeyColumnName = keyColumnName
     
@@ -202,12 +418,17 @@ def setupAddSecondaryTable(tableName, columnNames = default, keyColumnName = def
         parentTable = getTableFromName(parentTableName)
         parentKeyColumn = getColumnFromName(parentKeyColumnName, parentTable.columns)
         if parentKeyColumn.include == 0:
-            parentKeyColumn.include == 1
+            parentKeyColumn.include = 1
         table = Table(tableName, columns, keyColumn, parentTable, parentKeyColumn)
+        addTableMetadata(table)
         table.displayKeyColumn = displayKeyColumn
         table.forceOneToOne = forceOneToOne
         table.orderBy = orderBy
         table.limit = limit
+        table.watermarkColumn = watermarkColumnName
+        
+        if not keyColumn == None and not keyColumn.indexed and table.rowEstimate > 0:
+            print("Warning: {t}.{k} has no index, so loading {t} will scan all of its ~{r} rows. Consider adding one with: create index on {t} ({k});".format(t = tableName, k = keyColumnName, r = table.rowEstimate))
         
         tableInfo.append(table)
         
@@ -217,6 +438,75 @@ def setupAddSecondaryTable(tableName, columnNames = default, keyColumnName = def
         raise NoPrimaryTableException()
         return None
 
+def setupAddCohort(name, whereInclude = "", markerName = None, filename = default):
+    """
+    Adds a cohort to write its own export file for, so several groups of patients can be exported from the same table setup in one run. The \"buffered\" mode then builds its staging tables once for every patient in any cohort and writes each cohort's rows to its own file in one pass over them (see writeCohortExports).
+    
+    Keyword arguments:
+    name -- The name of the cohort, used in the default file name, string
+    whereInclude -- Optionally the statement in a where query that picks the primary table rows in the cohort, using {alias} like the primary table's whereInclude, which still applies to every cohort, string (default "", every row)
+    markerName -- Optionally the name of one of the primary table's whereMarkers to use as the cohort's where statement instead, string (default None)
+    filename -- The name of the file to write the cohort to, string (default the export file name with the cohort name added before the extension)
+    """
+    cohortInfo.append(Cohort(name, whereInclude, markerName, filename))
+    print("Cohort {c} added.".format(c = name))
+
+def setupSchemaCache(filename = "schema_cache.json"):
+    """
+    Turns on the cache of schema metadata (see loadSchemaMetadata), so the columns, keys, and indexes of every table are read from a file instead of the database catalog while the schema hasn't changed. Whether it has changed is checked with one small catalog query each run, which also brings the row estimates up to date. Call this before setting up any tables.
+    
+    Keyword arguments:
+    filename -- The name of the json file the metadata is cached in, string (default "schema_cache.json")
+    """
+    global schemaCacheFile
+    global schemaMetadata
+    schemaCacheFile = filename
+    schemaMetadata = None
+    schemaMetadataMisses.clear()
+    print("Schema metadata cache turned on.")
+
+def setupStagingCache(tableType = "unlogged", maxAge = 7, maxSize = 0):
+    """
+    Turns on the cache of staging tables for the \"buffered\" and \"copy\" modes, so staging tables are kept after an export and reused by later runs with the same table setup and unchanged source tables.
+    
+    Keyword arguments:
+    tableType -- The kind of table to keep cached staging tables in, either "unlogged" (faster to build, but emptied if the database crashes) or "regular", string (default "unlogged")
+    maxAge -- The number of days a cached table is kept after it was last used, where 0 is no limit, int (default 7)
+    maxSize -- The most disk space in megabytes the cached tables can use together, where 0 is no limit, int (default 0)
+    """
+    global stagingCache
+    stagingCache = {"tableType": "unlogged" if tableType == "unlogged" else "", "maxAge": maxAge, "maxSize": maxSize}
+    print("Staging table cache turned on.")
+
+def setupCoveringIndexes(covering = True):
+    """
+    Turns covering indexes on or off for the staging tables of the "buffered", "copy", and "delta" modes, so they can be read with index-only scans (see readme.md). Takes whether to use covering indexes as a boolean, defaulting to True.
+    """
+    global coveringIndexes
+    coveringIndexes = covering
+    print("Covering indexes for staging tables turned {s}.".format(s = "on" if covering else "off"))
+
+def listCachedStagingTables():
+    """
+    Prints every staging table in the cache along with its size and when it was built and last used. Returns a list with one tuple per table (name, size in bytes, built time, last used time), or an empty list if there is no cache.
+    """
+    runQuery("select to_regclass('export_staging_cache') is not null")
+    if not cursor.fetchall()[0][0]:
+        print("There are no cached staging tables.")
+        return []
+    runQuery("select table_name, bytes, created_at, used_at from export_staging_cache order by used_at desc")
+    entries = cursor.fetchall()
+    for name, size, created, used in entries:
+        print("{t}: {s:.1f} MB, built {c:%Y-%m-%d %H:%M}, last used {u:%Y-%m-%d %H:%M}".format(t = name, s = size / 1048576, c = created, u = used))
+    print("{n} cached staging tables using {s:.1f} MB.".format(n = len(entries), s = sum(entry[1] for entry in entries) / 1048576))
+    return entries
+
+def purgeCachedStagingTables(maxAge = 0):
+    """
+    Drops cached staging tables, by default all of them. Optionally takes the number of days since a table was last used that it should be kept for, int (default 0, dropping every table).
+    """
+    evictCachedStagingTables(maxAge, 0, everything = maxAge <= 0)
+
 #
 # Classes and generators
 #
@@ -229,6 +519,8 @@ class Column:
     displayName -- The name used in the exported CSV file, string (default name)
     type -- The SQL column type, string (default "variable character")
     include -- The extent to which the column should be included with 0 = not included, 1 = included in temp table but not exported, 2 = included and exported, int (default 2)
+    
+    Columns of a source table also record whether they are part of its primary key and whether an index leads with them (see addTableMetadata).
     """
     def __init__(self, n = "", dispn = default, t = "variable character", inc = 2):
         if dispn == default:
@@ -237,10 +529,14 @@ class Column:
         self.displayName = dispn
         self.type = t
         self.include = inc
+        self.primaryKey = False
+        self.indexed = False
 
 class Table:
     """
     Stores information about a table that is needed to export it.
+    
+    Along with the export settings, each table keeps what the database catalog says about it (see addTableMetadata) - the names of its primary key columns, its foreign keys as (columns, referenced table, referenced columns) tuples, its indexes as dictionaries with the name, key columns, included columns, uniqueness, and definition, and the planner's row estimate (-1 if it has never been analyzed).
     """
     def __init__(self, n = "", col = [], key = None, ref = None, refKey = None):
         self.name = n
@@ -250,11 +546,31 @@ class Table:
         self.parentKeyColumn = refKey
         self.displayKeyColumn = True
         self.maxEntries = 1
+        self.maxEntriesCounted = False
         self.orderBy = []
         self.whereInclude = None
         self.whereMarkers = []
         self.forceOneToOne = False
         self.limit = 0
+        self.watermarkColumn = None
+        self.stagingName = None
+        self.stallTime = 0
+        self.pageSizes = []
+        self.primaryKey = []
+        self.foreignKeys = []
+        self.indexes = []
+        self.rowEstimate = -1
+
+class Cohort:
+    """
+    Stores information about a cohort written to its own file by a multiple cohort export (see setupAddCohort).
+    """
+    def __init__(self, n = "", where = "", marker = None, fn = default):
+        self.name = n
+        self.whereInclude = where
+        self.markerName = marker
+        self.filename = fn
+        self.rows = 0
 
 class LargerDequeBar(Bar):
         def __init__(self, *args, **kwargs):
@@ -265,27 +581,107 @@ class LargerDequeBar(Bar):
                 self._xput.append(dt / n)
                 self.avg = sum(self._xput) / len(self._xput)
 
-def Buffer(table, size):
+def Buffer(table, size, pageTimes = None, lower = None, upper = None, prefetch = True, pageBytes = None):
     """
-    Generator function that returns the next entry to write and queries the database to refill the buffer when needed
+    Generator function that returns the next entry to write, reading the temporary table once in export order and fetching a new page of rows from a server-side cursor whenever the current one runs out.
+    
+    With prefetch (the default), the next page is fetched by a background thread while the current one is being used (see prefetchPages), so the database and the merge work at the same time. The time spent waiting for pages is added to the table's stallTime, and the number of rows in each page to its pageSizes. Optionally takes a list that the time spent fetching each page (in seconds) is appended to, the inclusive lower and exclusive upper bounds of the export primary keys to read, whether to prefetch as a boolean, and the memory in bytes a page may take up, which sizes each page from the measured width of the rows before it instead of using the fixed size (see fetchPages).
     """
-    buffer = queryNextBuffer(table, size, 0)
-    index = 0
-    offset = size
-    while True:
-        if index < len(buffer):
-            index += 1
-            yield buffer[index - 1]
-        else:
-            index = 0
-            buffer = queryNextBuffer(table, size, offset)
-            if len(buffer) > 0 and not buffer == None:
-                yield buffer[index]
-                offset += size
-            else:
+    bufferCursor = queryBufferCursor(table, size, lower, upper)
+    if not bufferCursor == None:
+        pages = prefetchPages(bufferCursor, size, pageTimes, pageBytes, table.pageSizes) if prefetch else fetchPages(bufferCursor, size, pageTimes, pageBytes, table.pageSizes)
+        while True:
+            start = time.time()
+            buffer = next(pages)
+            table.stallTime += time.time() - start
+            if len(buffer) == 0:
                 break
+            for entry in buffer:
+                yield entry
     yield None
-            
+
+def fetchPages(bufferCursor, size, pageTimes = None, pageBytes = None, pageSizes = None):
+    """
+    Generator function that fetches pages of rows from a cursor until it runs out, returning each page as a list and finally an empty list, closing the cursor just before it.
+    
+    Takes the cursor, the number of rows per page, and optionally a list that the time spent fetching each page (in seconds) is appended to. If the memory in bytes a page may take up is given, the first page is a small sample of rows, and each page after it holds as many rows as fit in that memory going by the average width of the rows in the page before it (see measureRowBytes), so wide tables get short pages and narrow ones long pages. The number of rows fetched for each page can be appended to a list given as pageSizes.
+    """
+    if not pageBytes == None:
+        size = min(size, 100)
+    while True:
+        start = time.time()
+        page = bufferCursor.fetchmany(size)
+        if not pageTimes == None:
+            pageTimes.append(time.time() - start)
+        if not pageSizes == None:
+            pageSizes.append(size)
+        if len(page) == 0:
+            bufferCursor.close()
+            yield page
+            return
+        if not pageBytes == None:
+            size = max(1, int(pageBytes // measureRowBytes(page)))
+        yield page
+
+def measureRowBytes(rows, sample = 100):
+    """
+    Estimates the memory each row of a page takes up in python, in bytes, from the size of the tuples and the values in up to sample rows spread through the page. Values shared between rows (such as None and small numbers) are counted for every row, so the estimate errs on the high side.
+    """
+    step = max(1, len(rows) // sample)
+    measured = rows[::step]
+    return sum(sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row) for row in measured) / len(measured)
+
+def currentMemoryUsage():
+    """
+    Returns the resident memory of this process in bytes, or None if it can't be measured. Read from /proc where it exists, otherwise the peak so far is the best available (see peakMemoryUsage).
+    """
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return peakMemoryUsage()
+
+def peakMemoryUsage():
+    """
+    Returns the most resident memory this process has used so far in bytes, or None if it can't be measured (the resource module isn't available on Windows).
+    """
+    if resource == None:
+        return None
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+def prefetchPages(bufferCursor, size, pageTimes = None, pageBytes = None, pageSizes = None):
+    """
+    Generator function that returns the same pages as fetchPages, but fetches the next one on a background thread while the current one is used. Takes the same arguments as fetchPages.
+    """
+    pages = queue.Queue()
+    slots = threading.Semaphore(1)
+    stop = threading.Event()
+    
+    def fetch():
+        try:
+            for page in fetchPages(bufferCursor, size, pageTimes, pageBytes, pageSizes):
+                pages.put(page)
+                while not slots.acquire(timeout = 0.1):
+                    if stop.is_set():
+                        return
+        except Exception as e:
+            pages.put(e)
+    
+    thread = threading.Thread(target = fetch, daemon = True)
+    thread.start()
+    try:
+        while True:
+            page = pages.get()
+            if isinstance(page, Exception):
+                raise page
+            yield page
+            slots.release()
+            if len(page) == 0:
+                return
+    finally:
+        stop.set()
+        thread.join()
 
 #
 # Database functions
@@ -298,8 +694,10 @@ def connect(dbuser, dbpass, dbname, dbhost):
     Accepts the username and password along with the host and database name (all as strings). Returns the cursor object if the connection succeeds, or attempts to exit the script (and returns None) if an exception is thrown.
     """
     try:
+        global connectionString
+        connectionString = "dbname='{name}' user='{user}' host='{host}' password='{password}'".format(user = dbuser, password = dbpass, name = dbname, host = dbhost)
         global conn
-        conn = psycopg2.connect("dbname='{name}' user='{user}' host='{host}' password='{password}'".format(user = dbuser, password = dbpass, name = dbname, host = dbhost))
+        conn = psycopg2.connect(connectionString)
         global cursor
         cursor = conn.cursor()
         return cursor
@@ -321,23 +719,97 @@ def close():
     except:
         print("Failed to close database connection.")
 
-def runQuery(query):
+def getConnection():
+    """
+    Returns the connection the current thread should use - the thread's own connection if it was given one, otherwise the global connection.
+    """
+    return getattr(threadConnection, "conn", conn)
+
+def getCursor():
+    """
+    Returns the cursor the current thread should use - the thread's own cursor if it was given one, otherwise the global cursor. runQuery always goes through this cursor.
+    """
+    return getattr(threadConnection, "cursor", cursor)
+
+def runQuery(query, parameters = None):
     """
     Tries to run the query passed to the function.
     
-    Accepts a string as the sql query (sans semicolon). Returns true if the query execution does not throw an exception, or false if an exception is thrown.
+    Accepts a string as the sql query (sans semicolon), optionally with a tuple or dictionary of parameters to bind to %s style placeholders in the query (literal percent signs then need to be doubled). Returns true if the query execution does not throw an exception, or false if an exception is thrown.
     """
     try:
-        cursor.execute("{q}".format(q = query))
+        start = time.time()
+        getCursor().execute("{q}".format(q = query), parameters)
+        recordQuery(query, parameters, time.time() - start, getCursor().rowcount)
         return True
     except Exception as e:
         print("\nQuery execution failed for query:\n" + query + "\n" + str(e))
         return False
 
+def runPreparedQuery(query, parameters = ()):
+    """
+    Tries to run a query with $1, $2, ... placeholders as a server-side prepared statement, which is prepared the first time it runs on a connection so later runs aren't parsed and planned again.
+    
+    Accepts the query as a string and a tuple of parameters. Returns true if the query execution does not throw an exception, or false if an exception is thrown.
+    """
+    name = "export_prepared_" + hashlib.sha1(query.encode("utf-8")).hexdigest()[:16]
+    key = (getConnection().get_backend_pid(), id(getConnection()), name)
+    if not key in preparedStatements:
+        if not runQuery("prepare {n} as {q}".format(n = name, q = query)):
+            return False
+        with instrumentationLock:
+            preparedStatements.add(key)
+    return runQuery("execute {n}{p}".format(n = name, p = "(" + ", ".join(["%s"] * len(parameters)) + ")" if len(parameters) > 0 else ""), parameters)
+
 #
 # Setup helper functions
 #
 
+def queryTemplate(query):
+    """
+    Returns the template of an sql query as a string - the query with quoted strings and numbers replaced by question marks and whitespace collapsed - so repeated queries that only differ in their values are grouped together.
+    """
+    template = re.sub(r"'(?:[^']|'')*'", "?", query)
+    template = re.sub(r"\b\d+(?:\.\d+)?\b", "?", template)
+    # Lists of values (such as the keys bound to a prepared statement) are grouped no matter how long they are
+    template = re.sub(r"\?(?:\s*,\s*\?)+", "?", template)
+    return re.sub(r"\s+", " ", template).strip()
+
+def recordQuery(query, parameters, elapsed, rows):
+    """
+    Adds a query that was run to the statistics for its template (see queryTemplate) - the number of times it ran, the total time and rows, and the slowest single run along with its query and parameters. Safe to call from several threads.
+    
+    Takes the query as a string, its parameters, the time it took in seconds, and the number of rows it returned or changed (-1 if unknown).
+    """
+    template = queryTemplate(query)
+    with instrumentationLock:
+        statistics = queryStatistics.setdefault(template, {"count": 0, "seconds": 0.0, "rows": 0, "slowestSeconds": 0.0, "slowestQuery": None, "slowestParameters": None})
+        statistics["count"] += 1
+        statistics["seconds"] += elapsed
+        statistics["rows"] += max(rows, 0)
+        if elapsed >= statistics["slowestSeconds"]:
+            statistics["slowestSeconds"] = elapsed
+            statistics["slowestQuery"] = query
+            statistics["slowestParameters"] = parameters
+
+def recordPhase(name, start):
+    """
+    Records the time taken by a phase of the run for the run report. Takes the name of the phase as a string and the time it started (from time.time()). Safe to call from several threads.
+    """
+    with instrumentationLock:
+        phaseTimings.append({"phase": name, "start": start - runStart, "seconds": time.time() - start})
+
+def resetInstrumentation():
+    """
+    Clears the query statistics, phase timings, and query plans gathered so far, and starts timing a new run.
+    """
+    global runStart
+    with instrumentationLock:
+        queryStatistics.clear()
+        del phaseTimings[:]
+        del queryPlans[:]
+        runStart = time.time()
+
 def getTableFromName(name, collection = tableInfo):
     """
     Searches the collection for a table with the specified name.
@@ -363,300 +835,2177 @@ def getColumnFromName(name, collection):
     else:
         return None
 
+def tableConfigurationHash(table):
+    """
+    Returns a hash of a table's export configuration as a hex string - its columns, key columns, whereInclude, whereMarkers, orderBy and tiebreak columns, limit, and forceOneToOne settings and whether it has a covering index, along with those of every table above it in the parent chain. Two tables with the same hash produce the same temporary table from the same data.
+    """
+    configuration = [table.name, 
+                     [(column.name, column.include) for column in table.columns], 
+                     table.keyColumn.name if not table.keyColumn == None else None, 
+                     table.parentKeyColumn.name if not table.parentKeyColumn == None else None, 
+                     table.whereInclude, 
+                     [list(marker) for marker in table.whereMarkers], 
+                     [list(order) for order in table.orderBy], 
+                     [column.name for column in tiebreakColumns(table)] if not table == tableInfo[0] else [], 
+                     table.limit, 
+                     table.forceOneToOne, 
+                     coveringIndexes, 
+                     tableConfigurationHash(table.parentTable) if not table.parentTable == None else None]
+    return hashlib.sha1(json.dumps(configuration).encode("utf-8")).hexdigest()
+
 def countKeyColumnAlias(count = 0):
     """
     Returns an SQL table alias as a string for a given integer.
     """
     return "z" * (count + 1)
 
-def entryTableExportData(mode, table, key):
+def getAllColumnNamesFromTableName(tableName):
     """
-    Returns a list containing the entries for a table to be written to the exported csv file.
+    Returns a tuble containing all the column names and data types in a table.
     
-    Accepts the exported table as a table object and the primary key in the primary table. Returns a list of tuples (one tuple for each matching entry) if the query succeeds, or None if the query fails.
+    Accepts the table name as a string, optionally qualified with its schema. Returns a tuple with one tuple entry per column (each containing the name and data type as strings), or an empty tuple if the table can't be found. Tables on the search path are read from the schema metadata (see getTableMetadata), and other tables from information_schema.
     """
-    if mode == "localjoin":
-        success = runQuery(entryTableExportDataLocaljoinQueryConstructor(table, key))
-    elif mode == "slow":
-        success = runQuery(entryTableExportDataSlowQueryConstructor(table, key))
-    if success:
-        return cursor.fetchall()
-    else:
-        return None
+    metadata = getTableMetadata(tableName)
+    if metadata == None:
+        # The schema metadata only covers the search path, so tables in other schemas are looked up directly
+        schemaName, name = tableName.rsplit(".", 1) if "." in tableName else (None, tableName)
+        if runQuery("select column_name, data_type from information_schema.columns where table_name = %(t)s and (%(s)s::text is null or table_schema = %(s)s) order by table_schema, ordinal_position", {"t": name, "s": schemaName}):
+            return tuple(getCursor().fetchall())
+        return tuple()
+    return tuple(tuple(column) for column in metadata["columns"])
 
-def entryTableExportDataLocaljoinQueryConstructor(table, keys):
-    if keys == None or table == tableInfo[0]:
-        return "select t1.{c} from {t} as t1{q}".format(c = ", ".join(column.name for column in table.columns), t = table.name, q = " {w".format(w = table.whereInclude) if not (table.whereInclude == "" or table.whereInclude == None) else "")
-    else:
-        return "select t1.{c} from {t} as t1 where exists (select 1 from values(({keys})) as t2 where t2.column1 = t1.{key})".format(c = ", ".join(column.name for column in table.columns), t = table.name, key = table.keyColumn.name, keys = "), (".join(keys))
-
-def entryTableExportDataSlowQueryConstructor(table, primaryKey, count = 0):
-    """
-    Recursive helper function used to construct the query for entryTableExportData.
-    """
-    if count == 0:
-        columns = table.columns
-        if not table.displayKeyColumn:
-            try:
-                columns.remove(table.keyColumn)
-            except:
-                print("Key column {c} not found in table {t}.".format(c = table.keyColumn.name, t = table.name))
-        return "select {c} from {t} as {ta} where {q}".format(t = table.name, c = ", ".join(countKeyColumnAlias() + "." + column.name for column in columns), ta = countKeyColumnAlias(), q = entryTableExportDataSlowQueryConstructor(table, primaryKey, count + 1))
-    elif (table == tableInfo[0] or table.parentTable == None):
-        return "{ta}.{c} = {value}".format(ta = countKeyColumnAlias(count - 1), c = table.keyColumn.name, value = "{quotes}{v}{quotes}".format(v = primaryKey, quotes = '"' if table.keyColumn.type == "variable character" else ""))
-    else:
-        return "exists(select 1 from {ref} as {refa} where {ta}.{c} = {refa}.{refc} and {q})".format(ref = table.parentTable.name, refa = countKeyColumnAlias(count), ta = countKeyColumnAlias(count - 1), c = table.keyColumn.name, refc = table.parentKeyColumn.name, q = entryTableExportDataSlowQueryConstructor(table.parentTable, primaryKey, count + 1))
+def getTableMetadata(tableName):
+    """
+    Returns the schema metadata for a table as a dictionary (see loadSchemaMetadata), or None if there's no such table. Takes the table name as a string, optionally qualified with its schema. The metadata is loaded the first time it's needed, and loaded again if the table isn't in it, in case the table was created since. A name that is still missing after that is remembered, so the metadata is loaded again at most once per missing name.
+    """
+    global schemaMetadata
+    if schemaMetadata == None:
+        schemaMetadata = loadSchemaMetadata()
+    if not tableName in schemaMetadata and not tableName in schemaMetadataMisses:
+        schemaMetadata = loadSchemaMetadata()
+        if not tableName in schemaMetadata:
+            schemaMetadataMisses.add(tableName)
+    return schemaMetadata.get(tableName)
 
-def countMaxEntriesWithKeyColumn(table):
+def addTableMetadata(table):
     """
-    Counts the maximum number of rows that link to the same key in the primary table.
-    
-    Accepts the table as a table object. Returns the number of lines as an int if the query succeeds, or zero if the query fails.
+    Copies the schema metadata for a table (see getTableMetadata) onto its table object - its primary key, foreign keys, indexes, and row estimate - and marks its columns that are part of the primary key or lead an index. Takes the table as a table object.
     """
-    success = runQuery(countMaxEntriesWithKeyColumnQueryConstructor(table))
-    if success:
-        return int(cursor.fetchone()[0])
-    else:
-        return 0
+    metadata = getTableMetadata(table.name)
+    if metadata == None:
+        return
+    table.primaryKey = metadata["primaryKey"]
+    table.foreignKeys = [tuple(foreignKey) for foreignKey in metadata["foreignKeys"]]
+    table.indexes = metadata["indexes"]
+    table.rowEstimate = metadata["rowEstimate"]
+    for column in table.columns:
+        column.primaryKey = column.name in table.primaryKey
+        column.indexed = any(len(index["columns"]) > 0 and index["columns"][0] == column.name for index in table.indexes)
 
-def countMaxEntriesWithKeyColumnQueryConstructor(table, originalTable = default, count = 0):
+def suggestTableLink(tableName, parentTableName = None, keyColumnName = None, parentKeyColumnName = None):
     """
-    Helper function used to construct the query for countMaxEntriesWithKeyColumn.
+    Suggests how a table links to the tables already in tableInfo from single column foreign keys in either direction, preferring keys from the table to a parent and then parents set up later.
+    
+    Keyword arguments:
+    tableName -- The name of the table, string
+    parentTableName -- Optionally the parent table to limit the suggestions to, string (default None)
+    keyColumnName -- Optionally the table's key column to limit the suggestions to, string (default None)
+    parentKeyColumnName -- Optionally the parent's key column to limit the suggestions to, string (default None)
+    
+    Returns a tuple of the key column name, parent table name, and parent key column name, or None if there's no suitable foreign key.
     """
-    if originalTable == default:
-        originalTable = table
-    if count == 0:
-        return "select max({outera}.c) from (select count({ta}.{c}) as c from {t} as {ta}".format(t = table.name, c = table.keyColumn.name, ta = countKeyColumnAlias(count + 1), outera = countKeyColumnAlias()) + countMaxEntriesWithKeyColumnQueryConstructor(table, originalTable, count + 1)
-    elif (table == tableInfo[0] or table.parentTable == None):
-        return " group by {ta}.{c}) as {outera}".format(ta = countKeyColumnAlias(count), c = table.keyColumn.name, origta = countKeyColumnAlias(count + 1), origc = originalTable.keyColumn.name, outera = countKeyColumnAlias())
-    else:
-        return "{w} inner join {ref} as {refa} on {ta}.{c} = {refa}.{refc}".format(w = " where {q}".format(q = table.whereInclude) if not (table.whereInclude == "" or table.whereInclude == None) else "", ref = table.parentTable.name, c = table.keyColumn.name, refc = table.parentKeyColumn.name, refa = countKeyColumnAlias(count + 1), ta = countKeyColumnAlias(count)) + countMaxEntriesWithKeyColumnQueryConstructor(table.parentTable, originalTable, count + 1)
+    metadata = getTableMetadata(tableName)
+    if metadata == None:
+        return None
+    qualifiedNames = {}
+    for table in tableInfo:
+        tableMetadata = getTableMetadata(table.name)
+        if not tableMetadata == None:
+            qualifiedNames[tableMetadata["qualifiedName"]] = table
+    
+    links = []
+    for columns, referencedTable, referencedColumns in metadata["foreignKeys"]:
+        referencedMetadata = getTableMetadata(referencedTable)
+        if len(columns) == 1 and not referencedMetadata == None and referencedMetadata["qualifiedName"] in qualifiedNames:
+            links.append((0, -tableInfo.index(qualifiedNames[referencedMetadata["qualifiedName"]]), (columns[0], qualifiedNames[referencedMetadata["qualifiedName"]].name, referencedColumns[0])))
+    for i, table in enumerate(tableInfo):
+        tableMetadata = getTableMetadata(table.name)
+        for columns, referencedTable, referencedColumns in (tableMetadata["foreignKeys"] if not tableMetadata == None else []):
+            referencedMetadata = getTableMetadata(referencedTable)
+            if len(columns) == 1 and not referencedMetadata == None and referencedMetadata["qualifiedName"] == metadata["qualifiedName"]:
+                links.append((1, -i, (referencedColumns[0], table.name, columns[0])))
+    
+    links = [link for order, position, link in sorted(links, key = lambda link: link[:2]) if (parentTableName == None or link[1] == parentTableName) and (keyColumnName == None or link[0] == keyColumnName) and (parentKeyColumnName == None or link[2] == parentKeyColumnName)]
+    return links[0] if len(links) > 0 else None
 
-def getAllColumnNamesFromTableName(tableName):
+def loadSchemaMetadata():
     """
-    Returns a tuble containing all the column names and data types in a table.
+    Loads the metadata of every table and view on the search path with one catalog query (see schemaMetadataQuery), or from the schema cache file if the schema hasn't changed since it was written (see setupSchemaCache).
     
-    Accepts the table name as a string. Returns a tuple with one tuple entry per column (each containing the name and data type as strings), or an empty tuple if the query fails.
+    Returns a dictionary keyed by table name and by schema-qualified name of dictionaries with the table's qualifiedName, columns, primaryKey, foreignKeys, indexes, and rowEstimate (see Table).
     """
-    success = runQuery("select column_name, data_type from information_schema.columns where table_name = '{t}'".format(t = tableName))
-    if success:
-        return cursor.fetchall()
-    else:
-        return tuple()
+    start = time.time()
+    if not schemaCacheFile == None:
+        runQuery(schemaFingerprintQuery())
+        fingerprint, rowEstimates = getCursor().fetchall()[0]
+        if os.path.exists(schemaCacheFile):
+            with open(schemaCacheFile, "r") as file:
+                cached = json.load(file)
+            if cached["fingerprint"] == fingerprint and cached.get("version") == schemaCacheVersion:
+                metadata = cached["tables"]
+                for name, table in metadata.items():
+                    table["rowEstimate"] = (rowEstimates or {}).get(table["qualifiedName"], table["rowEstimate"])
+                print("Loaded schema metadata for {n} tables from {f} in {s:.3f} seconds.".format(n = len(set(table["qualifiedName"] for table in metadata.values())), f = schemaCacheFile, s = time.time() - start))
+                return metadata
+    
+    metadata = {}
+    if runQuery(schemaMetadataQuery()):
+        for schema, name, rowEstimate, columns, constraints, indexes in getCursor().fetchall():
+            table = {"qualifiedName": schema + "." + name, 
+                     "columns": columns or [], 
+                     "primaryKey": next((keyColumns for kind, keyColumns, referencedTable, referencedColumns in constraints or [] if kind == "p"), []), 
+                     "foreignKeys": [[keyColumns, referencedTable, referencedColumns] for kind, keyColumns, referencedTable, referencedColumns in constraints or [] if kind == "f"], 
+                     "indexes": [{"name": indexName, "columns": indexColumns[:keyCount], "include": indexColumns[keyCount:], "unique": unique, "definition": definition} for indexName, indexColumns, keyCount, unique, definition in indexes or []], 
+                     "rowEstimate": rowEstimate}
+            metadata[table["qualifiedName"]] = table
+            # Rows come in search path order, so the first schema with a table name keeps the unqualified name
+            metadata.setdefault(name, table)
+    print("Loaded schema metadata for {n} tables in {s:.3f} seconds.".format(n = len(set(table["qualifiedName"] for table in metadata.values())), s = time.time() - start))
+    
+    if not schemaCacheFile == None:
+        with open(schemaCacheFile + ".tmp", "w") as file:
+            json.dump({"fingerprint": fingerprint, "version": schemaCacheVersion, "tables": metadata}, file)
+        os.replace(schemaCacheFile + ".tmp", schemaCacheFile)
+    return metadata
+
+def schemaRelationsQuery():
+    """
+    Helper function that returns the body of a query for the tables the schema metadata covers - tables, views, materialized views, and foreign tables in the schemas on the search path, leaving out the export's own staging tables and staging cache registry.
+    """
+    return "select c.oid, c.xmin, c.relname, c.reltuples, n.nspname from pg_class as c join pg_namespace as n on n.oid = c.relnamespace where c.relkind in ('r', 'p', 'v', 'm', 'f') and n.nspname = any(current_schemas(false)) and c.relname !~ '_export_(temp|cache_)' and c.relname <> 'export_staging_cache'"
+
+def schemaMetadataQuery():
+    """
+    Helper function used to construct the query for loadSchemaMetadata, with one row per table holding its schema, name, row estimate, and its columns, constraints, and indexes as json arrays. Index columns that are expressions are listed as the expression's text, so every index column keeps its position.
+    """
+    query = "with export_relations as ({relations}) select r.nspname, r.relname, r.reltuples::bigint, " \
+            "(select json_agg(json_build_array(a.attname, format_type(a.atttypid, null)) order by a.attnum) from pg_attribute as a where a.attrelid = r.oid and a.attnum > 0 and not a.attisdropped), " \
+            "(select json_agg(json_build_array(o.contype, (select json_agg(a.attname order by k.i) from unnest(o.conkey) with ordinality as k(n, i) join pg_attribute as a on a.attrelid = o.conrelid and a.attnum = k.n), o.confrelid::regclass::text, (select json_agg(a.attname order by k.i) from unnest(o.confkey) with ordinality as k(n, i) join pg_attribute as a on a.attrelid = o.confrelid and a.attnum = k.n))) from pg_constraint as o where o.conrelid = r.oid and o.contype in ('p', 'f')), " \
+            "(select json_agg(json_build_array(i.relname, (select coalesce(json_agg(case when x.indkey[k.i] = 0 then pg_get_indexdef(x.indexrelid, k.i + 1, true) else a.attname end order by k.i), '[]') from generate_subscripts(x.indkey, 1) as k(i) left join pg_attribute as a on a.attrelid = x.indrelid and a.attnum = x.indkey[k.i]), x.indnkeyatts, x.indisunique, pg_get_indexdef(x.indexrelid)) order by i.relname) from pg_index as x join pg_class as i on i.oid = x.indexrelid where x.indrelid = r.oid) " \
+            "from export_relations as r order by array_position(current_schemas(false), r.nspname::text) asc, r.relname asc"
+    return query.format(relations = schemaRelationsQuery())
+
+def schemaFingerprintQuery():
+    """
+    Helper function that returns a query for a hash of the catalog rows behind the schema metadata, which changes when a table, column, constraint, or index changes but not when a table is analyzed, along with each table's current row estimate.
+    """
+    query = "with export_relations as ({relations}) select md5(coalesce(string_agg(e.entry, ',' order by e.entry), '')), (select json_object_agg(r.nspname || '.' || r.relname, r.reltuples::bigint) from export_relations as r) from (" \
+            "select r.oid::text || ':' || r.xmin::text as entry from export_relations as r " \
+            "union all select a.attrelid::text || ':' || a.attnum::text || ':' || a.xmin::text from pg_attribute as a join export_relations as r on r.oid = a.attrelid " \
+            "union all select o.oid::text || ':' || o.xmin::text from pg_constraint as o join export_relations as r on r.oid = o.conrelid " \
+            "union all select x.indexrelid::text || ':' || x.xmin::text from pg_index as x join export_relations as r on r.oid = x.indrelid) as e"
+    return query.format(relations = schemaRelationsQuery())
 
 #
 # Run function helper methods
 #
 
-def createJoinedTemporaryTable(table = default, primaryTable = default):
+def explainSlowestQueries(count):
     """
-    Creates a sorted temporary table for a database table that is used to speed up the export process.
+    Runs the slowest queries of the current run again with explain (analyze, buffers) and keeps their plans for the run report.
     
-    Takes the table that you want to make a temp table for and the primary table as table objects, both of which default to the first entry in the tableInfo list.
+    The slowest run of each query template is ranked, and each of the top few is explained inside a transaction that is rolled back, so inserts and table creation don't leave anything behind. Queries that create a table from a select have only the select explained, since the table already exists. Statements that can't be explained (such as creating indexes) are skipped. Takes the number of queries to explain as an int.
     """
-    if table == default:
-        table = tableInfo[0]
-    if primaryTable == default:
-        primaryTable = tableInfo[0]
-    
-    print("Creating temporary table for{primary} table {table}...".format(primary = " primary" if table == tableInfo[0] else "", table = table.name))
-    if table == primaryTable or table.parentTable == None:
-        success = createPrimaryJoinedTemporaryTable(table)
-        
-        if success:
-            print("Adding unique identifier column...")
-            success = runQuery("alter table {table} add column export_id serial primary key".format(table = temporaryTableName(table)))
-            
-        else:
-            print("Error creating primary key column for temporary table {t}.".format(t = temporaryTableName(table)))
-            
-    else:
-        success = createSecondaryJoinedTemporaryTable(table, primaryTable)
+    if count <= 0:
+        return
     
-    if success:
-        print("Creating index on export primary key...")
-        
-        query = "create index {index} on {table} (export_primary asc nulls last{order})"
-        query = query.format(index = temporaryTableName(table) + "_primary_index",
-                    table = temporaryTableName(table),
-                    order = (", " + ", ".join(order[0] + " " + ("asc" if order[1] == True else "desc") for order in table.orderBy)) if not (table.orderBy == None or len(table.orderBy) == 0) else "")
-        
-        success = runQuery(query)
-        
-        if success:
-            print("Analyzing temp table...")
-            runQuery("analyze {t}".format(t = temporaryTableName(table)))
-            conn.commit()
-            return True
+    conn.commit()
+    slowest = sorted(queryStatistics.items(), key = lambda item: -item[1]["slowestSeconds"])
+    for template, statistics in slowest:
+        if len(queryPlans) >= count:
+            break
+        query = statistics["slowestQuery"]
+        created = re.match(r"^\s*create\s+(?:\w+\s+)?table\s+\S+\s+as\s+(.*)$", query, re.IGNORECASE | re.DOTALL)
+        if not created == None:
+            query = created.group(1)
+        if not re.match(r"^\s*(select|with|insert|update|delete|execute)\b", query, re.IGNORECASE):
+            continue
         
-        else:
-            print("Error creating indexes for temporary table {t}.".format(t = temporaryTableName(table)))
-            return None
-        
-    else:
-        print("Error creating temporary table {t}.".format(t = temporaryTableName(table)))
-        return None
+        print("Explaining query that took {s:.2f} seconds...".format(s = statistics["slowestSeconds"]))
+        try:
+            cursor.execute("explain (analyze, buffers, format json) " + query, statistics["slowestParameters"])
+            queryPlans.append({"template": template, "seconds": statistics["slowestSeconds"], "plan": cursor.fetchall()[0][0]})
+        except Exception as e:
+            queryPlans.append({"template": template, "seconds": statistics["slowestSeconds"], "error": str(e)})
+        conn.rollback()
 
-def createPrimaryJoinedTemporaryTable(table = default):
+def writeRunReport(filename, mode):
     """
-    Sets up and then loads data into a new temporary table used later in the export process.
+    Writes a json report of the current run, so runs can be compared with each other.
     
-    Loads the primary table with a single query, filtering out/adding marker columns for included where statements. Takes the primary table as a table object, defaulting to the first table in the tableInfo list.
+    The report holds the mode, the total time, the peak memory use of the process in bytes (see peakMemoryUsage), the time taken by each phase (see recordPhase), statistics for each query template sorted by total time (see recordQuery), and the plans of any explained queries (see explainSlowestQueries). Queries run on worker processes and server-side cursors aren't included. Takes the name of the file as a string and the mode as a string.
     """
-    if table == default:
-        table = tableInfo[0]
-    
-    query = "select {tableAlias}.{primaryKeyColumn} as export_primary, {columns} into temporary table {tempTable} from {table} as {tableAlias}{whereInclude} order by export_primary asc{order}"
-    query = query.format(tableAlias = countKeyColumnAlias(), 
-                 primaryKeyColumn = table.keyColumn.name, 
-                 columns = ", ".join((countKeyColumnAlias() + "." if column.name in getAllColumnNamesFromTableName(table) else "") + column.name.format(alias = countKeyColumnAlias() + ".") for column in table.columns if column.include > 0), 
-                 tempTable = temporaryTableName(table), 
-                 table = table.name, 
-                 whereInclude = " where " + table.whereInclude.format(alias = countKeyColumnAlias() + ".") if not (table.whereInclude == "" or table.whereInclude == None) else "", 
-                 order = (", " + ", ".join(order[0] + " " + ("asc" if order[1] == True else "desc") for order in table.orderBy)) if not (table.orderBy == None or len(table.orderBy) == 0) else "", 
-                 alias = countKeyColumnAlias() + ".")
+    with instrumentationLock:
+        queries = [{"template": template, 
+                    "count": statistics["count"], 
+                    "seconds": statistics["seconds"], 
+                    "rows": statistics["rows"], 
+                    "slowestSeconds": statistics["slowestSeconds"], 
+                    "slowestQuery": statistics["slowestQuery"]} for template, statistics in sorted(queryStatistics.items(), key = lambda item: -item[1]["seconds"])]
+        report = {"mode": mode, 
+                  "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(runStart)), 
+                  "seconds": time.time() - runStart, 
+                  "peakMemory": peakMemoryUsage(), 
+                  "phases": list(phaseTimings), 
+                  "queries": queries, 
+                  "plans": list(queryPlans)}
     
-    return runQuery(query)
+    with open(filename, "w") as file:
+        json.dump(report, file, indent = 4, default = str)
+    print("Run report written to {f}.".format(f = filename))
 
-def createSecondaryJoinedTemporaryTable(table, primaryTable = default, fetchSize = 10000):
+def writeBufferedExport(filename, buffer, processes = 1, outputFormat = "csv", layout = "wide", memoryBudget = 0):
     """
-    Sets up and then loads data into a new temporary table used later in the export process.
+    Writes the export file for the \"buffered\" mode from the temporary tables, which need to exist already, splitting the primary keys between several processes if asked (see writeBufferedExportPart).
     
-    Builds the table and runs one query for each parent key, keeping track of progress and limiting entries/ordering as needed. Takes the secondary table to load and the primary table as table objects, defaulting the primary table to the first table in the tableInfo list. Also takes the cursor fetch size as an int, defaulting to 10000.
+    Takes the name of the file to write as a string, the buffer size as an int, the number of processes as an int (default 1), the output format and layout as strings (see openExportWriter), and the memory budget in megabytes as an int, which is split evenly between the processes.
     """
-    if primaryTable == default:
-        primaryTable = tableInfo[0]
-    success = True
+    if layout == "tables":
+        if processes > 1:
+            print("Only one process can write a file per table, writing with one process instead.")
+        writeBufferedTableExports(filename, buffer, outputFormat, memoryBudget)
+        return
     
-    print("Setting up table structure...")
+    if layout == "wide":
+        print("Counting maximum entries for secondary tables...")
+        start = time.time()
+        updateBufferedMaxEntries()
+        recordPhase("count maximum entries", start)
     
-    query = "select {parentTableAlias}.export_primary, {columns} into temporary table {tempTable} from {table} as {tableAlias} cross join {parentTable} as {parentTableAlias} limit 0"
-    query = query.format(parentTableAlias = countKeyColumnAlias(0), 
-                 columns = ", ".join(countKeyColumnAlias(1) + "." + column.name for column in table.columns if column.include > 0), 
-                 tempTable = temporaryTableName(table), 
-                 table = table.name, 
-                 tableAlias = countKeyColumnAlias(1), 
-                 parentTable = temporaryTableName(table.parentTable))
+    if processes > 1 and not outputFormat == "csv":
+        print("Only csv files can be written by several processes, writing {f} with one process instead.".format(f = outputFormat))
+        processes = 1
     
-    success = runQuery(query) and success
+    with openExportWriter(filename, outputFormat, layout) as writer:
+        
+        print("Writing columns...")
+        writer.writeHeaders()
+        
+        if processes <= 1:
+            print("Writing entries...")
+            runQuery("select count(*) from {t}".format(t = temporaryTableName(tableInfo[0])))
+            bar = LargerDequeBar("Rows          ", max = cursor.fetchall()[0][0], suffix = "%(index)d/%(max)d - ETA: %(eta_td)s - Elapsed: %(elapsed_td)s        ")
+            start = time.time()
+            if layout == "long":
+                writer.writeRows(assembleBufferedLongRows(buffer, memoryBudget = memoryBudget, bar = bar), converted = True)
+            else:
+                writer.writeRows(assembleBufferedRows(buffer, memoryBudget = memoryBudget), bar)
+            recordPhase("write rows", start)
+            bar.finish()
+            printStallTimes()
+            printMemoryUsage(memoryBudget)
+            
+        else:
+            print("Splitting primary keys into {p} ranges...".format(p = processes))
+            bounds = queryPrimaryKeyRangeBounds(processes)
+            ranges = [(bounds[i] if i > 0 else None, bounds[i + 1] if i + 1 < len(bounds) else None) for i in range(len(bounds))]
+            arguments = [(list(tableInfo), connectionString, stagingTableSuffix, "{f}.part{i}".format(f = filename, i = i), buffer, lower, upper, layout, memoryBudget / len(ranges)) for i, (lower, upper) in enumerate(ranges)]
+            
+            print("Writing entries with {p} processes...".format(p = len(ranges)))
+            bar = Bar("Parts         ", max = len(ranges))
+            context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+            with context.Pool(len(ranges)) as pool:
+                writer.file.flush()
+                # imap hands back the parts in range order, so each one can be appended as soon as it and the ones before it are done
+                for partFilename in pool.imap(writeBufferedExportPart, arguments):
+                    with open(partFilename, "r", newline = "") as part:
+                        shutil.copyfileobj(part, writer.file)
+                    os.remove(partFilename)
+                    bar.next()
+            bar.finish()
+        
+        print("Export to file {f} completed, exiting.".format(f = filename))
+
+def writeBufferedTableExports(filename, buffer, outputFormat = "csv", memoryBudget = 0):
+    """
+    Writes each table's temporary table to its own file for the "buffered" mode's tables layout, which need to exist already.
+    
+    Each file is named after the export file with the table name added (see suffixedFilename) and holds the export primary key, the entry's slot, and the table's exported columns, sorted by export primary key so a primary key's entries are together in each file (see assembleBufferedTableRows). Takes the name of the export file as a string, the buffer size as an int, the output format as a string (see openExportWriter), and the memory budget in megabytes as an int.
+    """
+    for table in tableInfo:
+        tableFilename = suffixedFilename(filename, table.name)
+        with openExportWriter(tableFilename, outputFormat, "tables", table) as writer:
+            print("Writing {t} to {f}...".format(t = table.name, f = tableFilename))
+            writer.writeHeaders()
+            runQuery("select count(*) from {t}".format(t = temporaryTableName(table)))
+            bar = LargerDequeBar("Rows          ", max = cursor.fetchall()[0][0], suffix = "%(index)d/%(max)d - ETA: %(eta_td)s - Elapsed: %(elapsed_td)s        ")
+            start = time.time()
+            writer.writeRows(assembleBufferedTableRows(table, buffer, memoryBudget, bar))
+            recordPhase("write rows " + table.name, start)
+            bar.finish()
+    
+    printStallTimes()
+    printMemoryUsage(memoryBudget)
+    print("Export to files {f} completed, exiting.".format(f = suffixedFilename(filename, "<table>")))
+
+def addCohortFilters():
+    """
+    Changes the primary table so its staging table holds every patient in any cohort (see setupAddCohort), with a marker column for each cohort recording which cohorts the patient is in.
+    
+    The cohorts' where statements are joined with or and added to the primary table's whereInclude, and one column per cohort (export_cohort_0, export_cohort_1, ...) is added that is kept in the staging table but not exported. Returns the primary table's previous whereInclude and columns as a tuple, to be put back by removeCohortFilters once the export is done. Raises CohortException if a cohort names a where marker the primary table doesn't have.
+    """
+    primaryTable = tableInfo[0]
+    markers = dict(primaryTable.whereMarkers)
+    conditions = []
+    for cohort in cohortInfo:
+        if not cohort.markerName == None:
+            if not cohort.markerName in markers:
+                raise CohortException("Cohort {c} uses where marker {m}, which the primary table doesn't have.".format(c = cohort.name, m = cohort.markerName))
+            conditions.append(markers[cohort.markerName])
+        else:
+            conditions.append(cohort.whereInclude if not (cohort.whereInclude == None or cohort.whereInclude == "") else "true")
+    
+    previous = (primaryTable.whereInclude, primaryTable.columns)
+    union = " or ".join("(" + condition + ")" for condition in conditions)
+    primaryTable.whereInclude = union if primaryTable.whereInclude == None or primaryTable.whereInclude == "" else "(" + primaryTable.whereInclude + ") and (" + union + ")"
+    primaryTable.columns = primaryTable.columns + [Column("(case when " + condition + " then 1 else 0 end) as export_cohort_{i}".format(i = i), "export_cohort_{i}".format(i = i), "integer", 1) for i, condition in enumerate(conditions)]
+    return previous
+
+def removeCohortFilters(previous):
+    """
+    Puts back the primary table's whereInclude and columns from before addCohortFilters, taking the tuple it returned.
+    """
+    tableInfo[0].whereInclude, tableInfo[0].columns = previous
+
+def cohortFilename(filename, cohort):
+    """
+    Returns the name of the file a cohort is written to - its own file name if it was given one, otherwise the export file name with the cohort name added before the extension (and before any compression extension), such as export_kidney_failure.csv.gz.
+    """
+    if not cohort.filename == default:
+        return cohort.filename
+    return suffixedFilename(filename, cohort.name)
+
+def suffixedFilename(filename, suffix):
+    """
+    Returns a file name with a suffix added before its extension (and before any compression extension) after an underscore, such as export_encounter.csv.gz for export.csv.gz and encounter. Used for the files of cohorts and of tables written to their own files.
+    """
+    base, extension = os.path.splitext(filename)
+    if extension in compressionExtensions.values():
+        base, formatExtension = os.path.splitext(base)
+        extension = formatExtension + extension
+    return "{b}_{s}{e}".format(b = base, s = suffix, e = extension)
+
+def writeCohortExports(filename, buffer, outputFormat = "csv", layout = "wide", memoryBudget = 0):
+    """
+    Writes the export files for every cohort (see setupAddCohort) from the temporary tables, which need to exist already and hold the patients of every cohort (see addCohortFilters).
+    
+    The temporary tables are merged once, the same way as writeBufferedExport, while a server-side cursor reads the cohort marker columns of the primary table's temporary table in the same order. Each row is then handed to the writer of every cohort the patient is in, so the work depends on the number of patients in any cohort rather than the total of every cohort. Every cohort file has the same columns, sized for the widest patient in any cohort. Takes the name of the export file as a string (see cohortFilename), the buffer size as an int, the output format and layout as strings (see openExportWriter), and the memory budget in megabytes as an int (see assembleBufferedRows).
+    """
+    print("Counting maximum entries for secondary tables...")
+    start = time.time()
+    updateBufferedMaxEntries()
+    recordPhase("count maximum entries", start)
+    
+    writers = []
+    try:
+        print("Writing columns...")
+        for cohort in cohortInfo:
+            cohort.rows = 0
+            writers.append(openExportWriter(cohortFilename(filename, cohort), outputFormat, layout))
+            writers[-1].writeHeaders()
+        
+        print("Writing entries for {c} cohorts...".format(c = len(cohortInfo)))
+        runQuery("select count(*) from {t}".format(t = temporaryTableName(tableInfo[0])))
+        bar = LargerDequeBar("Rows          ", max = cursor.fetchall()[0][0], suffix = "%(index)d/%(max)d - ETA: %(eta_td)s - Elapsed: %(elapsed_td)s        ")
+        markerCursor = getConnection().cursor(name = "cursor_export_cohorts")
+        markerCursor.itersize = buffer
+        markerCursor.execute("select export_primary, {m} from {t} order by export_primary asc".format(m = ", ".join("export_cohort_{i}".format(i = i) for i in range(len(cohortInfo))), t = temporaryTableName(tableInfo[0])))
+        
+        # Rows are handed to each writer in batches, and parquet and arrow writers make a row group from each batch
+        batchSize = 1000 if outputFormat == "csv" else 10000
+        batches = [[] for cohort in cohortInfo]
+        start = time.time()
+        for (primaryKey, row), markers in zip(assembleBufferedRows(buffer, memoryBudget = memoryBudget), markerCursor):
+            bar.next()
+            for i in range(len(cohortInfo)):
+                if markers[i + 1] == 1:
+                    batches[i].append((primaryKey, row))
+                    if len(batches[i]) >= batchSize:
+                        writers[i].writeRows(batches[i])
+                        cohortInfo[i].rows += len(batches[i])
+                        batches[i] = []
+        for i in range(len(cohortInfo)):
+            writers[i].writeRows(batches[i])
+            cohortInfo[i].rows += len(batches[i])
+        recordPhase("write rows", start)
+        markerCursor.close()
+        bar.finish()
+        printStallTimes()
+        printMemoryUsage(memoryBudget)
+    finally:
+        for writer in writers:
+            writer.__exit__(None, None, None)
+    
+    for cohort in cohortInfo:
+        print("Cohort {c}: {r} rows written to {f}.".format(c = cohort.name, r = cohort.rows, f = cohortFilename(filename, cohort)))
+    print("Export of {c} cohorts completed, exiting.".format(c = len(cohortInfo)))
+
+def updateBufferedMaxEntries():
+    """
+    Updates the maxEntries variable for each table in the tableInfo list. Tables are normally counted while their temporary tables are loaded, so this only counts the rows per export primary key in temporary tables that weren't, which need to exist already.
+    """
+    bar = Bar("Tables        ", max = len(tableInfo) - 1)
+    for i in range(1, len(tableInfo)):
+        if not tableInfo[i].forceOneToOne:
+            bar.next()
+            if not tableInfo[i].maxEntriesCounted:
+                runQuery("select max(a.c) from (select count(z.{c}) as c from {t} as z group by {c}) as a".format(c = "export_primary", t = temporaryTableName(tableInfo[i])))
+                tableInfo[i].maxEntries = cursor.fetchall()[0][0] or 0
+                tableInfo[i].maxEntriesCounted = True
+    for i in range(1, len(tableInfo)):
+        if tableInfo[i].forceOneToOne:
+            bar.next()
+            tableInfo[i].maxEntries = tableInfo[i].parentTable.maxEntries
+    bar.finish()
+
+def writeCopyExport(filename):
+    """
+    Writes the export file for the \"copy\" mode from the temporary tables, which need to exist already.
+    
+    Each temporary table is streamed out of postgres as raw csv with copy ... to stdout instead of being fetched as python tuples. If no secondary table has more than one entry per primary key, the whole export is a single query joining the temporary tables, copied straight into the file. Otherwise each table is copied in export order to a local spool file and the spool files are merged into wide rows, comparing export primary keys as text. Values are written the way postgres formats them in csv (so booleans come out as t and f). Takes the name of the file to write as a string.
+    """
+    print("Counting maximum entries for secondary tables...")
+    start = time.time()
+    updateBufferedMaxEntries()
+    recordPhase("count maximum entries", start)
+    
+    with openExportFile(filename) as file:
+        
+        print("Writing columns...")
+        writeColumnHeaders(file)
+        file.flush()
+        
+        if all(table.maxEntries <= 1 for table in tableInfo[1:]):
+            print("Copying entries with a single query...")
+            cursor.copy_expert("copy ({q}) to stdout with csv".format(q = oneToOneExportQuery()), file)
+            
+        else:
+            print("Copying temporary tables...")
+            bar = Bar("Tables        ", max = len(tableInfo))
+            spoolFiles = {}
+            for table in tableInfo:
+                bar.next()
+                spoolFiles[table] = tempfile.TemporaryFile("w+", newline = "")
+                cursor.copy_expert("copy ({q}) to stdout with csv".format(q = bufferQuery(table)), spoolFiles[table])
+                spoolFiles[table].seek(0)
+            bar.finish()
+            
+            print("Writing entries...")
+            runQuery("select count(*) from {t}".format(t = temporaryTableName(tableInfo[0])))
+            bar = LargerDequeBar("Rows          ", max = cursor.fetchall()[0][0], suffix = "%(index)d/%(max)d - ETA: %(eta_td)s - Elapsed: %(elapsed_td)s        ")
+            readers = {table:csv.reader(spoolFiles[table]) for table in tableInfo}
+            start = time.time()
+            writeRows(file, assembleBufferedRows(readers = readers), bar)
+            recordPhase("write rows", start)
+            bar.finish()
+            
+            for spoolFile in spoolFiles.values():
+                spoolFile.close()
+        
+        print("Export to file {f} completed, exiting.".format(f = filename))
+
+def oneToOneExportQuery():
+    """
+    Returns a query that builds every export row in one statement by joining each temporary table to the primary table's on export primary key. Only gives the right result when no secondary table has more than one entry per primary key.
+    """
+    query = "select {columns} from {primaryTable} as {primaryAlias}{joins} order by {primaryAlias}.export_primary asc, {primaryAlias}.export_id asc"
+    query = query.format(columns = ", ".join(countKeyColumnAlias(i) + "." + temporaryColumnName(column) for i, table in enumerate(tableInfo) if table == tableInfo[0] or table.maxEntries > 0 for column in table.columns if column.include == 2), 
+                 primaryTable = temporaryTableName(tableInfo[0]), 
+                 primaryAlias = countKeyColumnAlias(0), 
+                 joins = "".join(" left join {t} as {a} on {a}.export_primary = {p}.export_primary".format(t = temporaryTableName(table), a = countKeyColumnAlias(i), p = countKeyColumnAlias(0)) for i, table in enumerate(tableInfo) if i > 0 and table.maxEntries > 0))
+    
+    return query
+
+def assembleBufferedRows(buffer = 10000, lower = None, upper = None, readers = None, memoryBudget = 0):
+    """
+    Generator function that merges the sorted temporary tables and returns one export row at a time.
+    
+    Takes the buffer size as an int, optionally the inclusive lower and exclusive upper bounds of the export primary keys to read, a dictionary of iterators over each table's rows in export order to read instead of the temporary tables (such as csv readers), and the memory budget in megabytes as an int (see openBuffers). Each row is returned as a tuple of the export primary key and a list of values, with None filling the slots of missing entries.
+    """
+    if readers == None:
+        bufferList = openBuffers(buffer, lower, upper, memoryBudget)
+    else:
+        bufferList = {table:iter(readers[table]) for table in tableInfo}
+    nextEntry = {table:next(bufferList[table], None) for table in tableInfo}
+    padding = {table:[None] * len([column for column in table.columns if column.include == 2]) for table in tableInfo}
+    
+    while not nextEntry[tableInfo[0]] == None:
+        
+        primaryKey = nextEntry[tableInfo[0]][0]
+        row = []
+        
+        for table in tableInfo:
+            
+            entryCount = 0
+            
+            while not nextEntry[table] == None and nextEntry[table][0] == primaryKey:
+                
+                entryCount += 1
+                row.extend(nextEntry[table][1:])
+                nextEntry[table] = next(bufferList[table], None)
+                
+            row.extend(padding[table] * (table.maxEntries - entryCount))
+            
+        yield (primaryKey, row)
+
+def openBuffers(buffer = 10000, lower = None, upper = None, memoryBudget = 0, tables = default):
+    """
+    Opens a Buffer over the temporary table of each table, sizing the pages by the memory budget if there is one (see fetchPages).
+    
+    Takes the buffer size as an int, optionally the inclusive lower and exclusive upper bounds of the export primary keys to read, the memory budget in megabytes as an int, and the tables to open buffers for as a list, defaulting to every table in tableInfo. Returns a dictionary of the buffers keyed by table object. Raises MemoryBudgetException if the process already uses more than the budget.
+    """
+    if tables == default:
+        tables = tableInfo
+    pageBytes = None
+    if memoryBudget > 0:
+        available = memoryBudget * 1048576 - (currentMemoryUsage() or 0)
+        if available <= 0:
+            raise MemoryBudgetException("The export already uses about {u:.0f} MB, more than the {m} MB budget.".format(u = (currentMemoryUsage() or 0) / 1048576, m = memoryBudget))
+        pageBytes = available / 2 / (3 * len(tables))
+    for table in tables:
+        table.stallTime = 0
+        table.pageSizes = []
+    return {table:Buffer(table, buffer, lower = lower, upper = upper, pageBytes = pageBytes) for table in tables}
+
+def assembleBufferedLongRows(buffer = 10000, lower = None, upper = None, memoryBudget = 0, bar = None):
+    """
+    Generator function that merges the sorted temporary tables like assembleBufferedRows, but returns rows in the long layout (see exportColumns) straight from the entries instead of building padded wide rows first.
+    
+    Each primary key's rows stay together - one for the primary table's values followed by one for each entry of each secondary table, in the order the entries would be written in the wide layout, with each entry's slot counting from 0. Since no row is padded out to the maximum entries, the maximum entries don't need counting, and the time taken only depends on the number of entries. Unlike longLayoutRows, entries whose exported values are all empty are kept. Takes the same arguments as assembleBufferedRows apart from readers, and optionally a progress bar to advance once per primary key. Returns (export primary key, list of values) tuples.
+    """
+    bufferList = openBuffers(buffer, lower, upper, memoryBudget)
+    nextEntry = {table:next(bufferList[table], None) for table in tableInfo}
+    widths = [len([column for column in table.columns if column.include == 2]) for table in tableInfo]
+    offsets = [sum(widths[:i]) for i in range(len(widths))]
+    totalWidth = sum(widths)
+    
+    while not nextEntry[tableInfo[0]] == None:
+        
+        primaryKey = nextEntry[tableInfo[0]][0]
+        if not bar == None:
+            bar.next()
+        
+        for table, offset, width in zip(tableInfo, offsets, widths):
+            
+            slot = 0
+            
+            while not nextEntry[table] == None and nextEntry[table][0] == primaryKey:
+                
+                yield (primaryKey, [primaryKey, table.name, slot] + [None] * offset + list(nextEntry[table][1:]) + [None] * (totalWidth - offset - width))
+                slot += 1
+                nextEntry[table] = next(bufferList[table], None)
+
+def assembleBufferedTableRows(table, buffer = 10000, memoryBudget = 0, bar = None):
+    """
+    Generator function that reads one table's temporary table in export order and returns its rows in the layout of that table's file when each table is written to its own file (see exportColumns) - the export primary key, the entry's slot counting from 0 for each primary key, and the entry's values.
+    
+    Takes the table as a table object, the buffer size as an int, the memory budget in megabytes as an int (see assembleBufferedRows), and optionally a progress bar to advance once per row, which is advanced a thousand rows at a time since the tables can have many more rows than there are primary keys. Returns (export primary key, list of values) tuples.
+    """
+    previousKey = None
+    slot = 0
+    count = 0
+    for entry in openBuffers(buffer, memoryBudget = memoryBudget, tables = [table])[table]:
+        if entry == None:
+            break
+        slot = slot + 1 if entry[0] == previousKey else 0
+        previousKey = entry[0]
+        count += 1
+        if not bar == None and count % 1000 == 0:
+            bar.next(1000)
+        yield (entry[0], [entry[0], slot] + list(entry[1:]))
+    if not bar == None:
+        bar.next(count % 1000)
+
+def printStallTimes():
+    """
+    Prints how long the last buffered merge spent waiting for each table's pages (see Buffer), which shows the tables that are holding the export back.
+    """
+    print("Time spent waiting for pages: " + ", ".join("{t} {s:.2f} seconds".format(t = table.name, s = table.stallTime) for table in sorted(tableInfo, key = lambda table: -table.stallTime)))
+
+def printMemoryUsage(memoryBudget = 0):
+    """
+    Prints the most memory the process has used so far (see peakMemoryUsage) and the budget if there is one, along with the average number of rows per page each table was read with, so it can be checked that a memory budget held.
+    """
+    peak = peakMemoryUsage()
+    print("Peak memory use: {p}{b}".format(p = "{m:.0f} MB".format(m = peak / 1048576) if not peak == None else "unknown", b = " (budget {m} MB)".format(m = memoryBudget) if memoryBudget > 0 else ""))
+    if memoryBudget > 0:
+        print("Average rows per page: " + ", ".join("{t} {r:.0f}".format(t = table.name, r = sum(table.pageSizes) / len(table.pageSizes)) for table in tableInfo if len(table.pageSizes) > 0))
+
+def writeRows(file, rows, bar = None, batch = 1000, afterBatch = None):
+    """
+    Writes export rows to the file as csv, quoting values where needed and passing them to the csv writer in batches.
+    
+    Takes the open file (see openExportFile), an iterable of (export primary key, list of values) tuples such as assembleBufferedRows returns, optionally a progress bar to advance once per row, the number of rows per batch as an int (default 1000), and optionally a function to call after each full batch is written, with the export primary key of the next row. None values are written as empty cells.
+    """
+    writer = csv.writer(file, lineterminator = "\n")
+    rowBatch = []
+    for primaryKey, row in rows:
+        if len(rowBatch) >= batch:
+            writer.writerows(rowBatch)
+            rowBatch = []
+            if not afterBatch == None:
+                afterBatch(primaryKey)
+        if not bar == None:
+            bar.next()
+        rowBatch.append(row)
+    writer.writerows(rowBatch)
+
+def writeBufferedExportPart(arguments):
+    """
+    Writes the rows for one range of export primary keys to a part file, run by the worker processes of writeBufferedExport.
+    
+    Takes a tuple containing the tableInfo list, the connection string, the staging table suffix, the part file name, the buffer size, the lower and upper key bounds, the layout, and the process's memory budget in megabytes. Opens its own database connection rather than touching the one inherited from the parent process. Returns the name of the part file.
+    """
+    tables, partConnectionString, suffix, partFilename, buffer, lower, upper, layout, memoryBudget = arguments
+    
+    global stagingTableType
+    global stagingTableSuffix
+    tableInfo[:] = tables
+    stagingTableType = "unlogged"
+    stagingTableSuffix = suffix
+    
+    threadConnection.conn = psycopg2.connect(partConnectionString)
+    threadConnection.cursor = threadConnection.conn.cursor()
+    try:
+        with CsvExportWriter(partFilename, layout) as writer:
+            if layout == "long":
+                writer.writeRows(assembleBufferedLongRows(buffer, lower, upper, memoryBudget = memoryBudget), converted = True)
+            else:
+                writer.writeRows(assembleBufferedRows(buffer, lower, upper, memoryBudget = memoryBudget))
+    finally:
+        threadConnection.cursor.close()
+        threadConnection.conn.close()
+        del threadConnection.cursor
+        del threadConnection.conn
+    
+    return partFilename
+
+def queryPrimaryKeyRangeBounds(count):
+    """
+    Splits the export primary keys in the primary table's temporary table into contiguous ranges of roughly equal size.
+    
+    Takes the number of ranges as an int. Returns a sorted list with the smallest export primary key of each range, which may be shorter than the count if there are fewer keys than ranges.
+    """
+    query = "select min({alias}.export_primary) from (select export_primary, ntile({count}) over (order by export_primary asc) as export_tile from {table}) as {alias} group by {alias}.export_tile order by 1 asc"
+    query = query.format(alias = countKeyColumnAlias(), 
+                 count = count, 
+                 table = temporaryTableName(tableInfo[0]))
+    
+    if runQuery(query):
+        return [row[0] for row in cursor.fetchall()]
+    else:
+        raise PrimaryKeyFetchException()
+
+def writeCheckpointedExport(filename, buffer, checkpoint, memoryBudget = 0):
+    """
+    Writes the export file for the \"buffered\" mode while recording its progress in a checkpoint file (see saveCheckpoint), resuming from the checkpoint if an earlier run of the same export was interrupted.
+    
+    Takes the name of the file to write as a string, the buffer size as an int, the name of the checkpoint file as a string, and the memory budget in megabytes as an int (see assembleBufferedRows). Returns True if the export was completed.
+    """
+    global stagingTableType
+    global stagingTableSuffix
+    
+    state = loadCheckpoint(checkpoint)
+    if state == None or state["complete"] or not state["configuration"] == exportConfigurationHash() or not state["filename"] == filename:
+        if not state == None and not state["complete"]:
+            print("Dropping staging tables left by an earlier export...")
+            for name in state["tables"]:
+                runQuery("drop table if exists {t}".format(t = name + "_export_temp" + state["suffix"]))
+            conn.commit()
+        runQuery("select now()::text")
+        state = {"configuration": exportConfigurationHash(), 
+                 "filename": filename, 
+                 "suffix": "_" + uuid.uuid4().hex[:8], 
+                 "tables": {}, 
+                 "written": None, 
+                 "nextPrimary": None, 
+                 "watermark": cursor.fetchall()[0][0], 
+                 "complete": False}
+        saveCheckpoint(checkpoint, state)
+    else:
+        print("Resuming export from checkpoint {c}...".format(c = checkpoint))
+    
+    previousStaging = (stagingTableType, stagingTableSuffix)
+    stagingTableType = "unlogged"
+    stagingTableSuffix = state["suffix"]
+    try:
+        print("Setting up temporary tables...")
+        for table in tableInfo:
+            if table.name in state["tables"]:
+                print("Temporary table for table {t} was already built, skipping.".format(t = table.name))
+                table.maxEntries = state["tables"][table.name]
+                table.maxEntriesCounted = True
+                continue
+            # Clears out a table left half built by an interrupted run
+            runQuery("drop table if exists {t}".format(t = temporaryTableName(table)))
+            if not createJoinedTemporaryTable(table, tableInfo[0]):
+                return False
+            state["tables"][table.name] = table.maxEntries
+            saveCheckpoint(checkpoint, state)
+        
+        print("Counting maximum entries for secondary tables...")
+        start = time.time()
+        updateBufferedMaxEntries()
+        recordPhase("count maximum entries", start)
+        state["tables"] = {table.name:table.maxEntries for table in tableInfo}
+        
+        if state["written"] == None:
+            with openExportFile(filename) as file:
+                print("Writing columns...")
+                writeColumnHeaders(file)
+                state["written"] = file.tell()
+            saveCheckpoint(checkpoint, state)
+        else:
+            os.truncate(filename, state["written"])
+        
+        with openExportFile(filename, "a") as file:
+        
+            print("Writing entries...")
+            runQuery("select count(*) from {t} where %(lower)s is null or export_primary >= %(lower)s".format(t = temporaryTableName(tableInfo[0])), {"lower": state["nextPrimary"]})
+            bar = LargerDequeBar("Rows          ", max = cursor.fetchall()[0][0], suffix = "%(index)d/%(max)d - ETA: %(eta_td)s - Elapsed: %(elapsed_td)s        ")
+            
+            def recordProgress(nextPrimary):
+                file.flush()
+                os.fsync(file.fileno())
+                state["written"] = file.tell()
+                state["nextPrimary"] = str(nextPrimary)
+                saveCheckpoint(checkpoint, state)
+            
+            writeRows(file, assembleBufferedRows(buffer, lower = state["nextPrimary"], memoryBudget = memoryBudget), bar, batch = buffer, afterBatch = recordProgress)
+            bar.finish()
+            printStallTimes()
+            printMemoryUsage(memoryBudget)
+        
+        state["complete"] = True
+        saveCheckpoint(checkpoint, state)
+        
+        print("Dropping staging tables...")
+        dropJoinedTemporaryTables()
+        
+        print("Export to file {f} completed, exiting.".format(f = filename))
+        return True
+    finally:
+        # A failed or interrupted export mustn't leave its staging settings behind, or the next export would build (and then drop) tables under the checkpoint's suffix
+        stagingTableType, stagingTableSuffix = previousStaging
+
+def writeDeltaExport(filename, buffer, checkpoint, since = None):
+    """
+    Writes the export file for the \"delta\" mode, merging the rows of the primary keys that changed since a checkpointed export (see saveCheckpoint) into its file.
+    
+    Takes the name of the previous export file as a string, the buffer size as an int, the name of the checkpoint file written by the previous export as a string, and optionally the watermark to look for changes after (default the time the previous export started). Returns True if the file was updated.
+    """
+    state = loadCheckpoint(checkpoint)
+    if state == None or not state["complete"] or not state["configuration"] == exportConfigurationHash() or not state["filename"] == filename:
+        raise DeltaExportException("The delta mode needs the checkpoint of a completed export of {f} with the same table setup.".format(f = filename))
+    if not tableInfo[0].keyColumn.include == 2:
+        raise DeltaExportException("The delta mode needs the primary key column {c} to be exported.".format(c = tableInfo[0].keyColumn.name))
+    if since == None:
+        since = state["watermark"]
+    
+    # Taken before looking for changes so that rows changed during the export are found again next time
+    runQuery("select now()::text")
+    watermark = cursor.fetchall()[0][0]
+    
+    print("Finding primary keys changed since {s}...".format(s = since))
+    queries = [deltaKeysQuery(table) for table in tableInfo if not table.watermarkColumn == None]
+    if len(queries) == 0:
+        raise DeltaExportException("No table has a watermark column to find changes with.")
+    runQuery("drop table if exists export_delta_keys")
+    if not runQuery("create temporary table export_delta_keys as " + " union ".join(queries), {"since": since}):
+        raise PrimaryKeyFetchException()
+    runQuery("select export_primary from export_delta_keys")
+    changedKeys = set(str(row[0]) for row in cursor.fetchall())
+    print("Found {c} changed primary keys.".format(c = len(changedKeys)))
+    
+    previousMaxEntries = state["tables"]
+    whereInclude = tableInfo[0].whereInclude
+    deltaCondition = "{alias}" + tableInfo[0].keyColumn.name + " in (select export_primary from export_delta_keys)"
+    tableInfo[0].whereInclude = deltaCondition if whereInclude == None or whereInclude == "" else "(" + whereInclude + ") and " + deltaCondition
+    try:
+        print("Setting up temporary tables...")
+        if not createJoinedTemporaryTables():
+            return False
+    finally:
+        tableInfo[0].whereInclude = whereInclude
+    
+    print("Counting maximum entries for secondary tables...")
+    start = time.time()
+    updateBufferedMaxEntries()
+    recordPhase("count maximum entries", start)
+    for table in tableInfo:
+        table.maxEntries = max(table.maxEntries, previousMaxEntries.get(table.name, 0))
+    
+    keyIndex = [column for column in tableInfo[0].columns if column.include == 2].index(tableInfo[0].keyColumn)
+    mergeFilename = filename + ".delta"
+    
+    with open(filename, "r", newline = "") as previousFile, openExportFile(mergeFilename) as file:
+        
+        print("Writing columns...")
+        writeColumnHeaders(file)
+        
+        print("Merging entries...")
+        previousRows = csv.reader(previousFile)
+        next(previousRows, None)
+        previousRows = (row for row in previousRows if not row[keyIndex] in changedKeys)
+        changedRows = assembleBufferedRows(buffer)
+        nextChanged = next(changedRows, None)
+        
+        keyCursor = conn.cursor(name = "cursor_export_delta_keys")
+        keyCursor.itersize = buffer
+        keyCursor.execute(deltaCohortQuery())
+        
+        def mergedRows():
+            nonlocal nextChanged
+            for (primaryKey,) in keyCursor:
+                if str(primaryKey) in changedKeys:
+                    if not nextChanged == None and str(nextChanged[0]) == str(primaryKey):
+                        yield nextChanged
+                        nextChanged = next(changedRows, None)
+                else:
+                    previousRow = next(previousRows, None)
+                    if previousRow == None or not previousRow[keyIndex] == str(primaryKey):
+                        raise DeltaExportException("The previous export doesn't match the primary table at key {k}.".format(k = primaryKey))
+                    yield (primaryKey, repadPreviousRow(previousRow, previousMaxEntries))
+        
+        writeRows(file, mergedRows())
+        keyCursor.close()
+    
+    os.replace(mergeFilename, filename)
+    
+    state["tables"] = {table.name:table.maxEntries for table in tableInfo}
+    state["watermark"] = watermark
+    saveCheckpoint(checkpoint, state)
+    
+    print("Export to file {f} updated with {c} changed primary keys, exiting.".format(f = filename, c = len(changedKeys)))
+    return True
+
+def deltaKeysQuery(table):
+    """
+    Returns a query for the primary keys with a row in the table whose watermark column is later than the %(since)s parameter, joining up through the parent tables to the primary table.
+    
+    Rows are matched whether or not they pass the primary table's whereInclude, so primary keys that stopped matching it are found too. Takes the table as a table object.
+    """
+    chain = [table]
+    while not (chain[-1] == tableInfo[0] or chain[-1].parentTable == None):
+        chain.append(chain[-1].parentTable)
+    
+    query = "select {primaryAlias}.{primaryKeyColumn} as export_primary from {table} as {tableAlias}{joins} where {tableAlias}.{watermark} > %(since)s"
+    query = query.format(primaryAlias = countKeyColumnAlias(len(chain) - 1), 
+                 primaryKeyColumn = chain[-1].keyColumn.name, 
+                 table = table.name, 
+                 tableAlias = countKeyColumnAlias(0), 
+                 joins = "".join(" inner join {t} as {a} on {a}.{parentKey} = {childAlias}.{key}".format(t = chain[i].name, a = countKeyColumnAlias(i), parentKey = chain[i - 1].parentKeyColumn.name, childAlias = countKeyColumnAlias(i - 1), key = chain[i - 1].keyColumn.name) for i in range(1, len(chain))), 
+                 watermark = table.watermarkColumn)
+    
+    return query
+
+def deltaCohortQuery():
+    """
+    Returns a query for every primary key that passes the primary table's whereInclude, in the same order as the export.
+    """
+    table = tableInfo[0]
+    query = "select {alias}.{key} from {table} as {alias}{whereInclude} order by 1 asc"
+    query = query.format(alias = countKeyColumnAlias(), 
+                 key = table.keyColumn.name, 
+                 table = table.name, 
+                 whereInclude = " where " + table.whereInclude.format(alias = countKeyColumnAlias() + ".") if not (table.whereInclude == "" or table.whereInclude == None) else "")
+    
+    return query
+
+def repadPreviousRow(row, previousMaxEntries):
+    """
+    Widens a row read back from a previous export to the current maximum entries of each table, adding empty slots after each table's entries.
+    
+    Takes the row as a list of strings and a dictionary of each table's maximum entries when the row was written, keyed by table name. Returns the widened row as a list.
+    """
+    padded = []
+    position = 0
+    for table in tableInfo:
+        width = len([column for column in table.columns if column.include == 2])
+        previousWidth = previousMaxEntries.get(table.name, 0) * width
+        padded.extend(row[position:position + previousWidth])
+        padded.extend([None] * (table.maxEntries * width - previousWidth))
+        position += previousWidth
+    return padded
+
+def exportConfigurationHash():
+    """
+    Returns a hash of the configuration of every table in tableInfo as a hex string (see tableConfigurationHash).
+    """
+    return hashlib.sha1("".join(tableConfigurationHash(table) for table in tableInfo).encode("utf-8")).hexdigest()
+
+def loadCheckpoint(filename):
+    """
+    Loads the state recorded by saveCheckpoint. Takes the name of the checkpoint file as a string. Returns the state as a dictionary, or None if the file doesn't exist or can't be read.
+    """
+    try:
+        with open(filename, "r") as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return None
+
+def saveCheckpoint(filename, state):
+    """
+    Records the state of a checkpointed export in a json file, writing it to a new file first and swapping it into place so an interruption never leaves a half-written checkpoint. Takes the name of the checkpoint file as a string and the state as a dictionary.
+    
+    The state holds the export configuration hash (see exportConfigurationHash), the file name, the suffix of the unlogged staging tables, the maximum entries of each staging table built so far keyed by table name, the length of the finished part of the file, the next export primary key to write, the database time the export started at (the watermark the \"delta\" mode looks for changes after), and whether the export is complete.
+    """
+    with open(filename + ".tmp", "w") as file:
+        json.dump(state, file, indent = 4, sort_keys = True)
+    os.replace(filename + ".tmp", filename)
+
+def writeSlowExport(filename, batch = 1000, outputFormat = "csv", layout = "wide"):
+    """
+    Writes the export file for the \"slow\" mode.
+    
+    Counts the maximum entries for each table, then streams the primary table through a server-side cursor one batch at a time. For each batch, every secondary table is queried once for the keys its parent rows link to, and the rows are joined in python the same way as the \"localjoin\" mode, so memory use depends on the batch size rather than the size of the tables. If the export fails, the partly written file is removed. Takes the name of the file to write as a string, the number of primary keys per batch as an int, and the output format and layout as strings (see openExportWriter).
+    """
+    print("Counting maximum entries for each table...")
+    start = time.time()
+    updateMaxEntries()
+    recordPhase("count maximum entries", start)
+    
+    try:
+        with openExportWriter(filename, outputFormat, layout) as writer:
+            
+            print("Writing columns...")
+            writer.writeHeaders()
+            
+            print("Writing entries...")
+            bar = LargerDequeBar("Rows          ", max = countPrimaryKeys(), suffix = "%(index)d/%(max)d - ETA: %(eta_td)s - Elapsed: %(elapsed_td)s        ")
+            query, parameters = localjoinRowsQuery(tableInfo[0])
+            primaryCursor = conn.cursor(name = "cursor_export_slow_keys")
+            primaryCursor.itersize = batch
+            primaryCursor.execute(query)
+            
+            start = time.time()
+            primaryRows = primaryCursor.fetchmany(batch)
+            while len(primaryRows) > 0:
+                batchRows = {tableInfo[0]:primaryRows}
+                indexes = {}
+                for table in tableInfo[1:]:
+                    parentKeyIndex = localjoinColumns(table.parentTable).index(table.parentKeyColumn)
+                    keys = set(row[parentKeyIndex] for row in batchRows[table.parentTable] if not row[parentKeyIndex] == None)
+                    batchRows[table] = queryLocaljoinRows(table, keys) if len(keys) > 0 else []
+                    indexes[table] = buildLocaljoinIndex(table, batchRows[table])
+                writer.writeRows(assembleLocaljoinRows(primaryRows, indexes), bar)
+                primaryRows = primaryCursor.fetchmany(batch)
+            
+            primaryCursor.close()
+            recordPhase("write rows", start)
+            bar.finish()
+    except Exception:
+        abortExport(filename)
+        raise
+    
+    print("Export to file {f} completed, exiting.".format(f = filename))
+
+def writePivotExport(filename, buffer = 10000, dumpQuery = False, outputFormat = "csv", layout = "wide"):
+    """
+    Writes the export file for the \"pivot\" mode.
+    
+    Builds the whole export as a single query on the source tables (see pivotExportQuery), so no tables are created and each primary key's entries are sent from the database as one ordered array per column, read through a server-side cursor and spread across the entry slots in python (see pivotRows). The maximum entries for each table are counted first with one combined query, since they decide the number of slots. If dumpQuery is True, the generated queries are written to the file instead and the export query isn't run. If the export fails, the partly written file is removed. Takes the name of the file to write as a string, the number of rows to fetch at once as an int, dumpQuery as a boolean, and the output format and layout as strings (see openExportWriter).
+    """
+    print("Counting maximum entries for secondary tables...")
+    start = time.time()
+    updatePivotMaxEntries()
+    recordPhase("count maximum entries", start)
+    
+    if dumpQuery:
+        with open(filename, "w") as file:
+            file.write("-- Maximum entries\n" + pivotStatisticsQuery() + ";\n\n-- Export\n" + pivotExportQuery() + ";\n")
+        print("Export queries written to file {f}, exiting.".format(f = filename))
+        return
+    
+    try:
+        with openExportWriter(filename, outputFormat, layout) as writer:
+            
+            print("Writing columns...")
+            writer.writeHeaders()
+            
+            print("Writing entries...")
+            bar = LargerDequeBar("Rows          ", max = countPrimaryKeys(), suffix = "%(index)d/%(max)d - ETA: %(eta_td)s - Elapsed: %(elapsed_td)s        ")
+            pivotCursor = conn.cursor(name = "cursor_export_pivot")
+            pivotCursor.itersize = buffer
+            pivotCursor.execute(pivotExportQuery())
+            start = time.time()
+            writer.writeRows(pivotRows(pivotCursor), bar)
+            recordPhase("write rows", start)
+            pivotCursor.close()
+            bar.finish()
+    except Exception:
+        abortExport(filename)
+        raise
+    
+    print("Export to file {f} completed, exiting.".format(f = filename))
+
+def pivotRows(rows):
+    """
+    Generator function that turns the rows of the pivot export query (see pivotExportQuery) into export rows, spreading each secondary table's arrays across its entry slots and padding the slots past its last entry with None.
+    
+    Takes an iterable of query rows. Returns (export primary key, list of values) tuples, the same as assembleBufferedRows. Raises WidthException if a table that isn't set to forceOneToOne has more entries than its maxEntries (see assembleLocaljoinRows).
+    """
+    primaryWidth = len([column for column in tableInfo[0].columns if column.include == 2])
+    widths = [(table, len([column for column in table.columns if column.include == 2])) for table in tableInfo[1:]]
+    
+    for queryRow in rows:
+        row = list(queryRow[1:1 + primaryWidth])
+        position = 1 + primaryWidth
+        for table, width in widths:
+            arrays = [array if not array == None else [] for array in queryRow[position:position + width]]
+            position += width
+            if len(arrays) > 0 and len(arrays[0]) > table.maxEntries and not table.forceOneToOne:
+                raise WidthException("Primary key {k} has {n} entries in {t}, more than its {m} maximum entries.".format(k = queryRow[0], n = len(arrays[0]), t = table.name, m = table.maxEntries))
+            for slot in range(table.maxEntries):
+                row.extend(array[slot] if slot < len(array) else None for array in arrays)
+        yield (queryRow[0], row)
+
+def abortExport(filename):
+    """
+    Cleans up after an export fails, rolling back the transaction and removing the partly written file so it isn't mistaken for a finished one. Takes the name of the file as a string.
+    """
+    # Rolling back also closes any server-side cursor, so the export can be run again on the same connection
+    conn.rollback()
+    if os.path.exists(filename):
+        os.remove(filename)
+        print("Removed the partly written file {f}.".format(f = filename))
+
+def updatePivotMaxEntries():
+    """
+    Updates the maxEntries variable for each table in the tableInfo list that hasn't been counted yet, using the single query from pivotStatisticsQuery.
+    """
+    if all(table.maxEntriesCounted for table in tableInfo[1:]):
+        return
+    if runQuery(pivotStatisticsQuery()):
+        counts = cursor.fetchall()[0]
+        for i in range(1, len(tableInfo)):
+            if not tableInfo[i].maxEntriesCounted:
+                tableInfo[i].maxEntries = counts[i - 1] or 0
+                tableInfo[i].maxEntriesCounted = True
+    for table in tableInfo[1:]:
+        if table.forceOneToOne:
+            table.maxEntries = table.parentTable.maxEntries
+
+def pivotRelationName(table):
+    """
+    Takes a table object and returns the name of the common table expression used for it in the pivot queries as a string.
+    """
+    return table.name + "_export_pivot"
+
+def pivotCommonTableExpressions():
+    """
+    Returns the with clause shared by the pivot queries, with one common table expression per table holding the same rows its temporary table would.
+    
+    Secondary tables also keep the export_parent and export_rank columns so their entries can be put in the same order as the buffered mode.
+    """
+    expressions = [pivotRelationName(tableInfo[0]) + " as (" + primaryJoinedTemporaryTableSelectQuery(tableInfo[0]) + ")"]
+    for table in tableInfo[1:]:
+        expressions.append(pivotRelationName(table) + " as (" + secondaryJoinedTemporaryTableSelectQuery(table, pivotRelationName(table.parentTable), keepRank = True) + ")")
+    return "with " + ", ".join(expressions)
+
+def pivotStatisticsQuery():
+    """
+    Returns a single query that counts the maximum entries per export primary key for every secondary table, returning one column per table in tableInfo order.
+    """
+    query = "{expressions} select {counts}"
+    query = query.format(expressions = pivotCommonTableExpressions(), 
+                 counts = ", ".join("(select max({alias}.c) from (select count(*) as c from {relation} group by export_primary) as {alias})".format(alias = countKeyColumnAlias(), relation = pivotRelationName(table)) for table in tableInfo[1:]))
+    
+    return query
+
+def pivotExportQuery():
+    """
+    Returns a single query that produces one row per export primary key, with each secondary table's entries as arrays.
+    
+    Each secondary table's entries are gathered per export primary key with array_agg (ordered by orderBy and then the order the buffered mode would read them in), giving one array column per exported column rather than one column per slot, since postgres allows at most 1664 columns in a query. Rows start with the export primary key, followed by the primary table's values and then each secondary table's arrays in tableInfo order, which are NULL for primary keys without entries (see pivotRows).
+    """
+    tables = tableInfo[1:]
+    aggregates = []
+    for table in tables:
+        aggregate = "{aggregateRelation} as (select export_primary, {arrays} from {relation} group by export_primary)"
+        aggregate = aggregate.format(aggregateRelation = pivotRelationName(table) + "_agg", 
+                     arrays = ", ".join("array_agg({c} order by {order}export_parent asc, export_rank asc) as {c}".format(c = column.name, order = orderByColumns(table) + ", " if len(table.orderBy) > 0 else "") for column in table.columns if column.include == 2), 
+                     relation = pivotRelationName(table))
+        aggregates.append(aggregate)
+    
+    columns = [countKeyColumnAlias(0) + "." + temporaryColumnName(column) for column in tableInfo[0].columns if column.include == 2]
+    for i, table in enumerate(tables):
+        columns.extend("{alias}.{c}".format(alias = countKeyColumnAlias(i + 1), c = column.name) for column in table.columns if column.include == 2)
+    
+    query = "{expressions}{aggregates} select {primaryAlias}.export_primary{columns} from {primaryRelation} as {primaryAlias}{joins} order by {primaryAlias}.export_primary asc"
+    query = query.format(expressions = pivotCommonTableExpressions(), 
+                 aggregates = "".join(", " + aggregate for aggregate in aggregates), 
+                 primaryAlias = countKeyColumnAlias(0), 
+                 columns = "".join(", " + column for column in columns), 
+                 primaryRelation = pivotRelationName(tableInfo[0]), 
+                 joins = "".join(" left join {relation} as {alias} on {alias}.export_primary = {primaryAlias}.export_primary".format(relation = pivotRelationName(table) + "_agg", alias = countKeyColumnAlias(i + 1), primaryAlias = countKeyColumnAlias(0)) for i, table in enumerate(tables)))
+    
+    return query
+
+def writeLocaljoinExport(filename, memoryBudget = 0, outputFormat = "csv", layout = "wide"):
+    """
+    Writes the export file for the \"localjoin\" mode.
+    
+    Estimates the memory needed from the row and column counts of each table and raises MemoryBudgetException if that would exceed the budget. Otherwise queries each table once, indexes every secondary table by the key its parent links with (applying orderBy and limit per parent key the same way the buffered mode does), counts the maximum entries from the joined data, and then writes one row per primary key. Takes the name of the file to write as a string and the memory budget in megabytes as an int, where 0 is no limit.
+    """
+    print("Estimating memory use...")
+    estimate = estimateLocaljoinMemory()
+    print("Estimated memory use: {e:.0f} MB{b}".format(e = estimate / 1048576, b = " (budget {m} MB)".format(m = memoryBudget) if memoryBudget > 0 else ""))
+    if memoryBudget > 0 and estimate > memoryBudget * 1048576:
+        raise MemoryBudgetException("The localjoin export would need about {e:.0f} MB, more than the {m} MB budget. Try the \"buffered\" or \"slow\" modes instead.".format(e = estimate / 1048576, m = memoryBudget))
+    
+    print("Querying tables...")
+    bar = Bar("Tables        ", max = len(tableInfo))
+    tableRows = {}
+    for table in tableInfo:
+        bar.next()
+        tableRows[table] = queryLocaljoinRows(table)
+    bar.finish()
+    
+    print("Building indexes...")
+    indexes = {table:buildLocaljoinIndex(table, tableRows[table]) for table in tableInfo[1:]}
+    primaryRows = tableRows[tableInfo[0]]
+    del tableRows
+    
+    print("Counting maximum entries for each table...")
+    start = time.time()
+    updateLocaljoinMaxEntries(primaryRows, indexes)
+    recordPhase("count maximum entries", start)
+    
+    with openExportWriter(filename, outputFormat, layout) as writer:
+        
+        print("Writing columns...")
+        writer.writeHeaders()
+        
+        print("Writing entries...")
+        bar = LargerDequeBar("Rows          ", max = len(primaryRows), suffix = "%(index)d/%(max)d - ETA: %(eta_td)s - Elapsed: %(elapsed_td)s        ")
+        start = time.time()
+        writer.writeRows(assembleLocaljoinRows(primaryRows, indexes), bar)
+        recordPhase("write rows", start)
+        bar.finish()
+        
+        print("Export to file {f} completed, exiting.".format(f = filename))
+
+def estimateLocaljoinMemory(bytesPerValue = 64, bytesPerRow = 160):
+    """
+    Estimates how much memory the \"localjoin\" mode needs to hold every table it queries, in bytes.
+    
+    Uses the planner's row estimates from the schema metadata where the tables have been analyzed (falling back to counting the rows) and the number of columns queried from each table. Takes the rough size of a single value and the overhead of a single row (its tuple and index entry) in bytes as ints. Returns the estimate as an int.
+    """
+    estimate = 0
+    for table in tableInfo:
+        rows = table.rowEstimate
+        if rows == None or rows < 0:
+            runQuery("select count(*) from {t}".format(t = table.name))
+            rows = cursor.fetchall()[0][0]
+        estimate += int(rows) * (bytesPerRow + len(localjoinColumns(table)) * bytesPerValue)
+    return estimate
+
+def localjoinColumns(table):
+    """
+    Returns the list of columns queried from a table for the \"localjoin\" and \"slow\" modes - every column that would be in its temporary table, plus any orderBy and tiebreak columns (see tiebreakColumns) that aren't included otherwise.
+    """
+    columns = [column for column in table.columns if column.include > 0]
+    for order in table.orderBy:
+        column = getColumnFromName(order[0], table.columns)
+        if not (column == None or column in columns):
+            columns.append(column)
+    if not table == tableInfo[0]:
+        columns.extend(column for column in tiebreakColumns(table) if not column in columns)
+    return columns
+
+def queryLocaljoinRows(table, keys = None):
+    """
+    Queries the rows of a table needed for the \"localjoin\" and \"slow\" modes.
+    
+    Takes the table as a table object and optionally a list of key column values to limit the rows to (default None, meaning every row). Queries limited to keys are run as prepared statements (see runPreparedQuery), since the \"slow\" mode runs the same one for every batch. Returns a list of tuples with the values of localjoinColumns(table), or raises PrimaryKeyFetchException if the primary table can't be queried.
+    """
+    query, parameters = localjoinRowsQuery(table, keys, prepared = not keys == None)
+    if runPreparedQuery(query, parameters) if not keys == None else runQuery(query, parameters):
+        return getCursor().fetchall()
+    elif table == tableInfo[0]:
+        raise PrimaryKeyFetchException()
+    else:
+        return []
+
+def localjoinRowsQuery(table, keys = None, prepared = False):
+    """
+    Helper function used to construct the query for queryLocaljoinRows.
+    
+    The primary table is filtered with its whereInclude statement and sorted by its key column. When keys are given, rows are limited to those whose key column matches one of them through a bound array parameter - a %s placeholder for runQuery, or $1 for runPreparedQuery if prepared is True. Returns a tuple of the query string and its parameters (None when there are no keys).
+    """
+    columns = ", ".join(countKeyColumnAlias() + "." + column.name if temporaryColumnName(column) == column.name else column.name.format(alias = countKeyColumnAlias() + ".") for column in localjoinColumns(table))
+    conditions = []
+    if table == tableInfo[0] and not (table.whereInclude == "" or table.whereInclude == None):
+        conditions.append("(" + table.whereInclude.format(alias = countKeyColumnAlias() + ".") + ")")
+    if not keys == None and prepared:
+        conditions.append("{alias}.{key} = any($1)".format(alias = countKeyColumnAlias(), key = table.keyColumn.name))
+    elif not keys == None:
+        # Percent signs in where markers and whereInclude statements need to be doubled once parameters are bound
+        columns = columns.replace("%", "%%")
+        conditions = [condition.replace("%", "%%") for condition in conditions]
+        conditions.append("{alias}.{key} = any(%s)".format(alias = countKeyColumnAlias(), key = table.keyColumn.name))
+    
+    query = "select {columns} from {table} as {tableAlias}{where}{order}"
+    query = query.format(columns = columns, 
+                 table = table.name, 
+                 tableAlias = countKeyColumnAlias(), 
+                 where = " where " + " and ".join(conditions) if len(conditions) > 0 else "", 
+                 order = " order by {alias}.{key} asc".format(alias = countKeyColumnAlias(), key = table.keyColumn.name) if table == tableInfo[0] else "")
+    
+    return (query, None if keys == None else (list(keys),))
+
+def buildLocaljoinIndex(table, rows):
+    """
+    Builds a hash index from key column values to the matching rows of a secondary table.
+    
+    Each key's rows are sorted by the table's orderBy settings and tiebreak columns (see tiebreakColumns) and cut down to its limit. Takes the table as a table object and its rows as returned by queryLocaljoinRows. Returns a dictionary of lists of tuples.
+    """
+    columns = localjoinColumns(table)
+    keyIndex = columns.index(table.keyColumn)
+    index = {}
+    for row in rows:
+        if not row[keyIndex] == None:
+            index.setdefault(row[keyIndex], []).append(row)
+    if len(table.orderBy) > 0 or len(tiebreakColumns(table)) > 0:
+        for key, entries in index.items():
+            sortLocaljoinEntries(table, entries, tiebreak = True)
+            if table.limit > 0:
+                del entries[table.limit:]
+    return index
+
+def sortLocaljoinEntries(table, entries, tiebreak = False):
+    """
+    Sorts a list of a table's rows in place by its orderBy settings, and then by its tiebreak columns if tiebreak is True (see tiebreakColumns), placing nulls last when ascending and first when descending as postgres does. The sort is stable, so rows that tie keep their current order.
+    """
+    columns = localjoinColumns(table)
+    orders = table.orderBy + ([(column.name, True) for column in tiebreakColumns(table)] if tiebreak else [])
+    for order in reversed(orders):
+        orderIndex = columns.index(getColumnFromName(order[0], table.columns))
+        entries.sort(key = lambda entry: (entry[orderIndex] is None, entry[orderIndex]), reverse = not order[1] == True)
+
+def localjoinEntries(primaryRow, indexes):
+    """
+    Finds the entries in every table that belong to one row of the primary table.
+    
+    Children are gathered from each distinct parent key in ascending order and then sorted by orderBy, which is the order the buffered mode reads its temporary tables in, since each parent key's entries were put in their entry order by buildLocaljoinIndex. Takes the primary table row and the indexes built by buildLocaljoinIndex (keyed by table). Returns a dictionary from each table to its list of entries.
+    """
+    entries = {tableInfo[0]:[primaryRow]}
+    for table in tableInfo[1:]:
+        parentKeyIndex = localjoinColumns(table.parentTable).index(table.parentKeyColumn)
+        parentKeys = sorted(set(entry[parentKeyIndex] for entry in entries[table.parentTable] if not entry[parentKeyIndex] == None))
+        tableEntries = []
+        for key in parentKeys:
+            tableEntries.extend(indexes[table].get(key, []))
+        if len(table.orderBy) > 0:
+            sortLocaljoinEntries(table, tableEntries)
+        entries[table] = tableEntries
+    return entries
+
+def updateLocaljoinMaxEntries(primaryRows, indexes):
+    """
+    Updates the maxEntries variable for each table in the tableInfo list from the joined rows of the \"localjoin\" or \"slow\" modes.
+    
+    Takes the primary table rows and the indexes built by buildLocaljoinIndex. Tables set to forceOneToOne take their parent's maximum instead.
+    """
+    for table in tableInfo[1:]:
+        table.maxEntries = 0
+    for primaryRow in primaryRows:
+        entries = localjoinEntries(primaryRow, indexes)
+        for table in tableInfo[1:]:
+            if len(entries[table]) > table.maxEntries:
+                table.maxEntries = len(entries[table])
+    for table in tableInfo[1:]:
+        if table.forceOneToOne:
+            table.maxEntries = table.parentTable.maxEntries
+
+def assembleLocaljoinRows(primaryRows, indexes):
+    """
+    Generator function that joins each primary table row with its entries and returns one export row at a time.
+    
+    Takes the primary table rows and the indexes built by buildLocaljoinIndex. Each row is returned as a tuple of the primary key and a list of values, the same as assembleBufferedRows. Tables set to forceOneToOne with more entries than their maxEntries are cut down to fit, while any other table with more entries than its maxEntries raises WidthException, since its entries would otherwise be lost.
+    """
+    exportIndexes = {}
+    for table in tableInfo:
+        columns = localjoinColumns(table)
+        exportIndexes[table] = [columns.index(column) for column in table.columns if column.include == 2]
+    padding = {table:[None] * len(exportIndexes[table]) for table in tableInfo}
+    primaryKeyIndex = localjoinColumns(tableInfo[0]).index(tableInfo[0].keyColumn)
+    
+    for primaryRow in primaryRows:
+        entries = localjoinEntries(primaryRow, indexes)
+        row = []
+        for table in tableInfo:
+            tableEntries = entries[table]
+            if len(tableEntries) > table.maxEntries:
+                if not table.forceOneToOne:
+                    raise WidthException("Primary key {k} has {n} entries in {t}, more than its {m} maximum entries.".format(k = primaryRow[primaryKeyIndex], n = len(tableEntries), t = table.name, m = table.maxEntries))
+                tableEntries = tableEntries[:table.maxEntries]
+            for entry in tableEntries:
+                row.extend(entry[i] for i in exportIndexes[table])
+            row.extend(padding[table] * (table.maxEntries - len(tableEntries)))
+        yield (primaryRow[primaryKeyIndex], row)
+
+def planExport(printPlan = True):
+    """
+    Plans the order the staging tables are built in from the planner's estimates, building each table after its parent and the most selective ready tables first.
+    
+    Keyword arguments:
+    printPlan -- Whether to print the plan with each table's estimated staged and read rows, boolean (default True)
+    
+    Returns the plan as a list of dictionaries in build order, each holding the table object, its estimated source, staged, and read rows, its selectivity, and whether its key is indexed.
+    """
+    estimates = {}
+    for table, query in stagingSelectQueries().items():
+        sourceRows = table.rowEstimate if not (table.rowEstimate == None or table.rowEstimate < 0) else explainEstimate("select * from {t}".format(t = table.name))
+        # The planner's join estimates can overshoot, but a table can't stage more rows than it has or than its limit allows
+        stagedRows = min(explainEstimate(query), sourceRows)
+        if not table == tableInfo[0] and table.limit > 0:
+            stagedRows = min(stagedRows, estimates[table.parentTable]["stagedRows"] * table.limit)
+        indexed = table == tableInfo[0] or table.keyColumn.indexed
+        estimates[table] = {"table": table, 
+                            "sourceRows": sourceRows, 
+                            "stagedRows": stagedRows, 
+                            "readRows": stagedRows if indexed and not table == tableInfo[0] else sourceRows, 
+                            "selectivity": stagedRows / sourceRows if sourceRows > 0 else 1.0, 
+                            "indexed": indexed}
+    
+    plan = []
+    ready = [table for table in tableInfo if table in estimates and (table == tableInfo[0] or not table.parentTable in estimates)]
+    while len(ready) > 0:
+        table = min(ready, key = lambda table: (not table == tableInfo[0], estimates[table]["selectivity"]))
+        ready.remove(table)
+        plan.append(estimates[table])
+        ready.extend(child for child in tableInfo if child.parentTable == table and not child == tableInfo[0] and child in estimates)
+    
+    if printPlan:
+        print("Staging plan:")
+        for i, entry in enumerate(plan):
+            print("  {i}. {t}: stages ~{s} of ~{r} rows ({p:.1%}), reads ~{c} rows{w}".format(i = i + 1, t = entry["table"].name, s = int(entry["stagedRows"]), r = int(entry["sourceRows"]), p = entry["selectivity"], c = int(entry["readRows"]), w = " with a full scan, since its join key has no index" if not entry["indexed"] else " with a full scan" if entry["table"] == tableInfo[0] else ""))
+    
+    return plan
+
+def stagingSelectQueries():
+    """
+    Returns the select statement that loads each table's staging table without needing the staging tables to exist, as a dictionary keyed by table object.
+    
+    Each secondary table's statement reads from its parent's statement in place of the parent's staging table, so it follows the where conditions, join keys, and limits of every table above it. Used to plan and preview the export before anything is staged (see planExport and previewExport). Tables that aren't connected to the primary table are left out.
+    """
+    queries = {}
+    for table in tableInfo:
+        if table == tableInfo[0]:
+            queries[table] = primaryJoinedTemporaryTableSelectQuery(table)
+        elif table.parentTable in queries:
+            queries[table] = secondaryJoinedTemporaryTableSelectQuery(table, "(" + queries[table.parentTable] + ") as export_plan_parent")
+    return queries
+
+def explainEstimate(query):
+    """
+    Returns the planner's estimate of the number of rows a query returns as a float, from explain without running the query, or 0 if the query can't be explained (in which case the transaction is rolled back).
+    """
+    if not runQuery("explain (format json) " + query):
+        getConnection().rollback()
+        return 0.0
+    result = getCursor().fetchall()[0][0]
+    if isinstance(result, str):
+        result = json.loads(result)
+    return float(result[0]["Plan"]["Plan Rows"])
+
+def createJoinedTemporaryTables(workers = 1, shared = False, cache = False):
+    """
+    Creates the temporary tables for every table in tableInfo.
+    
+    Each table is built after its parent, and when more than one table is ready to be built they are built in the order from planExport, so the most selective tables are built first. With one worker the tables are built one after another on the global connection. With more, a pool of that many connections is opened and tables are scheduled from the parent links in tableInfo - a table starts as soon as its parent has been committed, so siblings are built at the same time. Since temporary tables are only visible to their own connection, parallel builds (or any build where shared is True) use unlogged tables with a name suffix unique to the run instead (see dropJoinedTemporaryTables). When cache is True the tables are kept in the staging cache instead (see setupStagingCache), and tables that are still current there are reused rather than built. Takes the number of workers as an int, defaulting to 1, whether other connections need to read the tables as a boolean, defaulting to False, and whether to use the cache as a boolean, defaulting to False. Returns True if every table was created.
+    """
+    global stagingTableType
+    global stagingTableSuffix
+    # Tables are set up after their parents, so the setup order only needs planning when a parent has more than one child
+    if any(len([child for child in tableInfo[1:] if child.parentTable == table]) > 1 for table in tableInfo):
+        order = [entry["table"] for entry in planExport()]
+        order.extend(table for table in tableInfo if not table in order)
+    else:
+        order = list(tableInfo)
+    if cache:
+        stagingTableType = stagingCache["tableType"]
+        runQuery("create table if not exists export_staging_cache (table_name text primary key, source_statistics text, max_entries integer, bytes bigint, created_at timestamp with time zone default now(), used_at timestamp with time zone default now())")
+        conn.commit()
+        for table in tableInfo:
+            table.stagingName = table.name + "_export_cache_" + tableConfigurationHash(table)[:12]
+    elif workers > 1 or shared:
+        stagingTableType = "unlogged"
+        stagingTableSuffix = "_" + uuid.uuid4().hex[:8]
+    
+    if workers <= 1:
+        success = True
+        for table in order:
+            success = createJoinedTemporaryTable(table, tableInfo[0]) and success
+        return success
+    
+    # Ends the global connection's transaction so it can see tables committed by the pool
+    conn.commit()
+    
+    children = {table:[child for child in order if child.parentTable == table and not child == tableInfo[0]] for table in tableInfo}
+    roots = [table for table in order if table == tableInfo[0] or table.parentTable == None]
+    success = True
+    
+    pool = psycopg2.pool.ThreadedConnectionPool(1, workers, connectionString)
+    try:
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            pending = {executor.submit(createJoinedTemporaryTableWithPool, pool, table):table for table in roots}
+            while len(pending) > 0:
+                done, notDone = wait(pending.keys(), return_when = FIRST_COMPLETED)
+                for future in done:
+                    table = pending.pop(future)
+                    if future.result():
+                        for child in children[table]:
+                            pending[executor.submit(createJoinedTemporaryTableWithPool, pool, child)] = child
+                    else:
+                        print("Skipping tables that depend on {t}.".format(t = table.name))
+                        success = False
+    finally:
+        pool.closeall()
+    
+    return success
+
+def explainStagingReads(filename = None):
+    """
+    Builds the staging tables without writing an export and prints the plans of reading each one through the old index and through the current one, optionally writing them to a json file.
+    
+    Takes the name of the file as a string, defaulting to None for printing only. Returns a list with one dictionary per table holding its name, read query, and both plans as strings, or None if the staging tables couldn't be built.
+    """
+    print("Setting up temporary tables...")
+    report = []
+    try:
+        if not createJoinedTemporaryTables(cache = not stagingCache == None):
+            return None
+        for table in tableInfo:
+            query = bufferQuery(table)
+            plans = {}
+            runQuery("savepoint export_explain_before")
+            runQuery("drop index {i}".format(i = temporaryTableName(table) + "_primary_index"))
+            runQuery("create index on {t} (export_primary asc nulls last{order})".format(t = temporaryTableName(table), order = (", " + orderByColumns(table)) if not (table.orderBy == None or len(table.orderBy) == 0) else ""))
+            for layout in ("before", "after"):
+                if layout == "after":
+                    runQuery("rollback to savepoint export_explain_before")
+                runQuery("explain (analyze, buffers) " + query)
+                plans[layout] = "\n".join(row[0] for row in getCursor().fetchall())
+            print("\nRead plan for {t} before:\n{b}\n\nRead plan for {t} after:\n{a}".format(t = temporaryTableName(table), b = plans["before"], a = plans["after"]))
+            report.append({"table": table.name, "query": query, "before": plans["before"], "after": plans["after"]})
+        getConnection().commit()
+    finally:
+        if not stagingCache == None:
+            releaseCachedStagingTables()
+        else:
+            # Clears out a transaction left aborted by a failed query, so the tables can be dropped and run can build them again
+            getConnection().rollback()
+            dropJoinedTemporaryTables()
+    
+    if not filename == None:
+        with open(filename, "w") as file:
+            json.dump(report, file, indent = 4)
+        print("Staging read plans written to {f}.".format(f = filename))
+    return report
+
+def createJoinedTemporaryTableWithPool(pool, table):
+    """
+    Creates a table's temporary table on a connection borrowed from the pool, for use by createJoinedTemporaryTables worker threads.
+    
+    Takes the connection pool and the table as a table object. Returns True if the table was created and committed.
+    """
+    threadConnection.conn = pool.getconn()
+    threadConnection.cursor = threadConnection.conn.cursor()
+    try:
+        return createJoinedTemporaryTable(table, tableInfo[0]) == True
+    finally:
+        threadConnection.cursor.close()
+        pool.putconn(threadConnection.conn)
+        del threadConnection.cursor
+        del threadConnection.conn
+
+def dropJoinedTemporaryTables():
+    """
+    Drops the staging tables for every table in tableInfo and switches back to temporary staging tables.
+    
+    Temporary tables are also dropped with the connection, so they only need dropping to build them again on the same connection.
+    """
+    global stagingTableType
+    global stagingTableSuffix
+    for table in tableInfo:
+        runQuery("drop table if exists {t}".format(t = temporaryTableName(table)))
+    conn.commit()
+    stagingTableType = "temporary"
+    stagingTableSuffix = ""
+
+def releaseCachedStagingTables():
+    """
+    Stops using the staging cache for the tables in tableInfo once an export is done with them, leaving the tables themselves in the cache, then evicts old entries (see evictCachedStagingTables) and switches back to temporary staging tables.
+    """
+    global stagingTableType
+    for table in tableInfo:
+        table.stagingName = None
+    # Clears out the export's transaction, which may have been left aborted by a failed query
+    conn.rollback()
+    evictCachedStagingTables(stagingCache["maxAge"], stagingCache["maxSize"])
+    stagingTableType = "temporary"
+
+def evictCachedStagingTables(maxAge = 0, maxSize = 0, everything = False):
+    """
+    Drops cached staging tables that haven't been used in more than maxAge days, then the least recently used ones until the rest fit in maxSize megabytes, where 0 is no limit for either. Takes both limits as ints, and optionally whether to drop every cached table as a boolean (default False).
+    """
+    runQuery("select to_regclass('export_staging_cache') is not null")
+    if not cursor.fetchall()[0][0]:
+        return
+    runQuery("select table_name, bytes, used_at < now() - make_interval(days => %s) from export_staging_cache order by used_at desc", (maxAge,))
     
-    print("Adding unique identifier column...")
+    total = 0
+    evicted = []
+    for name, size, expired in cursor.fetchall():
+        total += size
+        if everything or (maxAge > 0 and expired) or (maxSize > 0 and total > maxSize * 1048576):
+            evicted.append(name)
     
-    query = "alter table {tempTable} add column export_id serial primary key"
-    query = query.format(tempTable = temporaryTableName(table))
+    for name in evicted:
+        print("Dropping cached staging table {t}...".format(t = name))
+        runQuery("drop table if exists {t}".format(t = name))
+        runQuery("delete from export_staging_cache where table_name = %s", (name,))
+    conn.commit()
+
+def stagingSourceStatistics(table):
+    """
+    Returns a string describing the current state of the source tables in a table's parent chain - the storage file of each along with the number of rows inserted, updated, and deleted according to postgres' statistics - which changes whenever their data does. Used to tell whether a cached staging table is still current.
     
-    success = runQuery(query) and success
+    Tables referenced only from whereInclude or whereMarkers clauses aren't included, and postgres can take a moment to count very recent changes.
+    """
+    names = []
+    while not table == None:
+        names.append(table.name)
+        table = table.parentTable if not table == tableInfo[0] else None
+    
+    query = "select c.relname, c.relfilenode, pg_stat_get_tuples_inserted(c.oid), pg_stat_get_tuples_updated(c.oid), pg_stat_get_tuples_deleted(c.oid) from pg_class as c where c.oid = any(%s::regclass[]) order by c.relname asc"
+    if runQuery(query, (names,)):
+        return json.dumps(getCursor().fetchall())
+    else:
+        return None
+
+def loadCachedStagingTable(table):
+    """
+    Checks whether a table's cached staging table exists and its source tables haven't changed since it was built. If so, marks it used and loads its maxEntries. Otherwise the stale table is dropped so it can be built again.
     
-    print("Counting keys...")
+    Takes the table as a table object. Returns True if the cached staging table can be reused.
+    """
+    runQuery("select source_statistics, max_entries from export_staging_cache where table_name = %s and to_regclass(table_name) is not null", (table.stagingName,))
+    entries = getCursor().fetchall()
     
-    query = "select count(*) from {table}"
-    query = query.format(table = temporaryTableName(table.parentTable))
+    if len(entries) > 0 and not entries[0][0] == None and entries[0][0] == stagingSourceStatistics(table):
+        print("Reusing cached staging table {t}.".format(t = table.stagingName))
+        table.maxEntries = entries[0][1]
+        table.maxEntriesCounted = True
+        runQuery("update export_staging_cache set used_at = now() where table_name = %s", (table.stagingName,))
+        getConnection().commit()
+        return True
     
-    success = runQuery(query)
-    maxlen = cursor.fetchall()[0][0]
+    runQuery("drop table if exists {t}".format(t = table.stagingName))
+    runQuery("delete from export_staging_cache where table_name = %s", (table.stagingName,))
+    return False
+
+def saveCachedStagingTable(table, sourceStatistics):
+    """
+    Records a newly built staging table in the cache along with the source statistics (see stagingSourceStatistics) taken before it was built, its maxEntries, and its size. Takes the table as a table object and the statistics as a string.
+    """
+    query = "insert into export_staging_cache (table_name, source_statistics, max_entries, bytes) values (%s, %s, %s, pg_total_relation_size(%s))"
+    runQuery(query, (table.stagingName, sourceStatistics, table.maxEntries, table.stagingName))
+
+def createJoinedTemporaryTable(table = default, primaryTable = default):
+    """
+    Creates a sorted temporary table for a database table that is used to speed up the export process.
+    
+    Takes the table that you want to make a temp table for and the primary table as table objects, both of which default to the first entry in the tableInfo list.
+    """
+    if table == default:
+        table = tableInfo[0]
+    if primaryTable == default:
+        primaryTable = tableInfo[0]
+    
+    if not table.stagingName == None:
+        if loadCachedStagingTable(table):
+            return True
+        sourceStatistics = stagingSourceStatistics(table)
+    
+    print("Creating temporary table for{primary} table {table}...".format(primary = " primary" if table == tableInfo[0] else "", table = table.name))
+    start = time.time()
+    if table == primaryTable or table.parentTable == None:
+        success = createPrimaryJoinedTemporaryTable(table)
+        table.maxEntries = 1
+        table.maxEntriesCounted = True
+        
+        if success:
+            print("Adding unique identifier column...")
+            success = runQuery("alter table {table} add column export_id serial primary key".format(table = temporaryTableName(table)))
+            
+        else:
+            print("Error creating primary key column for temporary table {t}.".format(t = temporaryTableName(table)))
+            
+    else:
+        success = createSecondaryJoinedTemporaryTable(table, primaryTable)
+    recordPhase("load " + table.name, start)
+    
+    if success:
+        print("Creating index on export primary key...")
+        
+        start = time.time()
+        covering = coveringIndexes and getConnection().server_version >= 110000
+        if covering:
+            # Rows too wide for an index make the covering index fail, so it is tried inside a savepoint and replaced by the plain index if it does
+            runQuery("savepoint export_covering_index")
+            covering = runQuery(stagingIndexQuery(table, covering = True))
+            runQuery("{a} savepoint export_covering_index".format(a = "release" if covering else "rollback to"))
+            if not covering:
+                print("Falling back to a plain index for {t}.".format(t = temporaryTableName(table)))
+        success = covering or runQuery(stagingIndexQuery(table))
+        recordPhase("index " + table.name, start)
+        
+        if success:
+            print("Analyzing temp table...")
+            start = time.time()
+            runQuery("analyze {t}".format(t = temporaryTableName(table)))
+            recordPhase("analyze " + table.name, start)
+            if not table.stagingName == None:
+                saveCachedStagingTable(table, sourceStatistics)
+            getConnection().commit()
+            if covering:
+                # Vacuum can't run inside a transaction, and sets the visibility map that index-only scans rely on
+                print("Vacuuming temp table...")
+                start = time.time()
+                getConnection().autocommit = True
+                try:
+                    runQuery("vacuum {t}".format(t = temporaryTableName(table)))
+                finally:
+                    getConnection().autocommit = False
+                recordPhase("vacuum " + table.name, start)
+            return True
+        
+        else:
+            print("Error creating indexes for temporary table {t}.".format(t = temporaryTableName(table)))
+            return None
+        
+    else:
+        print("Error creating temporary table {t}.".format(t = temporaryTableName(table)))
+        return None
+
+def stagingIndexQuery(table, covering = False, name = default):
+    """
+    Returns the statement that indexes a staging table in the order it is read in (see bufferQuery) - by export primary key, orderBy settings, and unique identifier.
+    
+    Since the tables are loaded in that order too, reads through the index move forward through the table without sorting. Takes the table as a table object, whether to include every exported column in the index so it can be read with an index-only scan as a boolean (default False), and optionally the index name as a string, defaulting to the staging table's name followed by "_primary_index".
+    """
+    # Exported columns that are already part of the key don't need including
+    included = [temporaryColumnName(column) for column in table.columns if column.include == 2 and not temporaryColumnName(column) in [order[0] for order in table.orderBy]]
+    
+    query = "create index {index} on {table} (export_primary asc nulls last{order}, export_id asc){include}"
+    query = query.format(index = temporaryTableName(table) + "_primary_index" if name == default else name, 
+                 table = temporaryTableName(table), 
+                 order = (", " + orderByColumns(table)) if not (table.orderBy == None or len(table.orderBy) == 0) else "", 
+                 include = " include (" + ", ".join(included) + ")" if covering and len(included) > 0 else "")
+    return query
+
+def createPrimaryJoinedTemporaryTable(table = default):
+    """
+    Sets up and then loads data into a new temporary table used later in the export process.
+    
+    Loads the primary table with a single query, filtering out/adding marker columns for included where statements. Takes the primary table as a table object, defaulting to the first table in the tableInfo list.
+    """
+    if table == default:
+        table = tableInfo[0]
+    
+    query = "create {tableType} table {tempTable} as {select}"
+    query = query.format(tableType = stagingTableType, 
+                 tempTable = temporaryTableName(table), 
+                 select = primaryJoinedTemporaryTableSelectQuery(table))
+    
+    return runQuery(query)
+
+def primaryJoinedTemporaryTableSelectQuery(table = default):
+    """
+    Returns the select statement used to load the primary table's temporary table, with the primary key as export_primary followed by the included columns and where markers.
+    
+    Takes the primary table as a table object, defaulting to the first table in the tableInfo list.
+    """
+    if table == default:
+        table = tableInfo[0]
+    sourceColumnNames = [col[0] for col in getAllColumnNamesFromTableName(table.name)]
+    
+    query = "select {tableAlias}.{primaryKeyColumn} as export_primary, {columns} from {table} as {tableAlias}{whereInclude} order by export_primary asc{order}"
+    query = query.format(tableAlias = countKeyColumnAlias(), 
+                 primaryKeyColumn = table.keyColumn.name, 
+                 columns = ", ".join((countKeyColumnAlias() + "." if column.name in sourceColumnNames else "") + column.name.format(alias = countKeyColumnAlias() + ".") for column in table.columns if column.include > 0), 
+                 table = table.name, 
+                 whereInclude = " where " + table.whereInclude.format(alias = countKeyColumnAlias() + ".") if not (table.whereInclude == "" or table.whereInclude == None) else "", 
+                 order = (", " + orderByColumns(table)) if not (table.orderBy == None or len(table.orderBy) == 0) else "")
+    
+    return query
+
+def createSecondaryJoinedTemporaryTable(table, primaryTable = default):
+    """
+    Sets up and then loads data into a new temporary table used later in the export process.
+    
+    Builds the table structure and then fills it with a single set-based insert against the parent's temporary table, limiting entries/ordering per parent key with a window function. Takes the secondary table to load and the primary table as table objects, defaulting the primary table to the first table in the tableInfo list.
+    """
+    if primaryTable == default:
+        primaryTable = tableInfo[0]
+    success = True
     
-    print("Declaring cursor...")
+    print("Setting up table structure...")
     
-    query = "declare cursor_export_keys_{table} cursor for select distinct export_primary, {columns} from {table} order by export_primary asc"
-    query = query.format(table = temporaryTableName(table.parentTable), 
-                 columns = table.parentKeyColumn.name)
+    query = "select {parentTableAlias}.export_primary, {columns} into {tableType} table {tempTable} from {table} as {tableAlias} cross join {parentTable} as {parentTableAlias} limit 0"
+    query = query.format(parentTableAlias = countKeyColumnAlias(0), 
+                 columns = ", ".join(countKeyColumnAlias(1) + "." + column.name for column in table.columns if column.include > 0), 
+                 tableType = stagingTableType, 
+                 tempTable = temporaryTableName(table), 
+                 table = table.name, 
+                 tableAlias = countKeyColumnAlias(1), 
+                 parentTable = temporaryTableName(table.parentTable))
     
     success = runQuery(query) and success
     
-    print("Fetching initial entries from cursor...")
+    print("Adding unique identifier column...")
     
-    query = "fetch forward {size} from cursor_export_keys_{table}"
-    query = query.format(size = fetchSize, 
-                 table = temporaryTableName(table.parentTable))
+    query = "alter table {tempTable} add column export_id serial primary key"
+    query = query.format(tempTable = temporaryTableName(table))
     
     success = runQuery(query) and success
-    keys = cursor.fetchall()
+    
+    if not success:
+        print("Previous query execution failed, halting...")
+        return False
     
     print("Filling table...")
-    bar = LargerDequeBar("Parent Entries", max = maxlen, suffix = "%(index)d/%(max)d - ETA: %(eta_td)s - Elapsed: %(elapsed_td)s        ")
     
-    while not len(keys) == 0:
-        for key in keys:
-            if not success:
-                print("Previous query execution failed, halting...")
-                break
-            bar.next()
-            
-            query = "insert into {tempTable} (export_primary, {columns}) select {primaryKeyValue}, {columns} from {table} where {keyColumn} = {keyValue}{order}{limit}"
-            query = query.format(tempTable = temporaryTableName(table), 
-                         columns = ", ".join(column.name for column in table.columns if column.include > 0), 
-                         primaryKeyValue = key[0], 
-                         table = table.name, 
-                         keyColumn = table.parentKeyColumn.name, 
-                         keyValue = "{quotes}{key}{quotes}".format(key = key[1], quotes = '"' if table.parentKeyColumn.type == "variable character" else ""), 
-                         order = (" order by " + ", ".join(order[0] + " " + ("asc" if order[1] == True else "desc") for order in table.orderBy)) if not (table.orderBy == None or len(table.orderBy) == 0) else "", 
-                         limit = " limit " + str(table.limit) if table.limit > 0 else "")
-            
-            success = runQuery(query) and success
-            
-        query = "fetch forward {size} from cursor_export_keys_{table}"
-        query = query.format(size = fetchSize, 
-                     table = temporaryTableName(table.parentTable))
-        
-        success = runQuery(query) and success
-        keys = cursor.fetchall()
-        
-    bar.finish()
+    # The insert returns its rows to an outer query so the maximum entries per export primary key are counted in the same pass
+    query = "with export_inserted as (insert into {tempTable} (export_primary, {columns}) {select} returning export_primary) select coalesce(sum({alias}.c), 0)::bigint, coalesce(max({alias}.c), 0) from (select count(*) as c from export_inserted group by export_primary) as {alias}"
+    query = query.format(tempTable = temporaryTableName(table), 
+                 columns = ", ".join(column.name for column in table.columns if column.include > 0), 
+                 select = secondaryJoinedTemporaryTableSelectQuery(table), 
+                 alias = countKeyColumnAlias())
+    
+    start = time.time()
+    success = runQuery(query)
+    elapsed = time.time() - start
+    
+    if success:
+        rows, table.maxEntries = getCursor().fetchall()[0]
+        table.maxEntriesCounted = True
+        print("Loaded {r} rows into {t} in {s:.2f} seconds ({rate:.0f} rows/sec).".format(r = rows, t = temporaryTableName(table), s = elapsed, rate = rows / elapsed if elapsed > 0 else 0))
+    
     return success
 
+def secondaryJoinedTemporaryTableSelectQuery(table, parentRelation = default, keepRank = False):
+    """
+    Returns the set-based select statement used to load a secondary table's temporary table.
+    
+    Joins the table to the distinct keys of its parent relation and numbers each parent key's entries with row_number() by orderBy and then the tiebreak columns (see tiebreakColumns), so that orderBy and limit apply per parent key. Rows come out sorted by export primary key, orderBy settings, parent key, and then entry order - the order the temporary table is read in (see bufferQuery), so the unique identifiers follow it and the table is stored in the order it's read. Takes the table as a table object, optionally the name of the parent relation (defaulting to the parent's temporary table), and whether to return the parent key and entry number as the export_parent and export_rank columns instead of sorting the rows (default False).
+    """
+    if parentRelation == default:
+        parentRelation = temporaryTableName(table.parentTable)
+    
+    query = "select {outerAlias}.export_primary, {outerColumns} from (select {parentAlias}.export_primary, {parentAlias}.{parentKeyColumn} as export_parent, {columns}, row_number() over (partition by {parentAlias}.export_primary, {parentAlias}.{parentKeyColumn}{order}) as export_rank from {table} as {tableAlias} inner join (select distinct export_primary, {parentKeyColumn} from {parentRelation}) as {parentAlias} on {tableAlias}.{keyColumn} = {parentAlias}.{parentKeyColumn}) as {outerAlias}{limit}{outerOrder}"
+    query = query.format(outerAlias = countKeyColumnAlias(2), 
+                 outerColumns = ", ".join(countKeyColumnAlias(2) + "." + column.name for column in table.columns if column.include > 0) + (", {alias}.export_parent, {alias}.export_rank".format(alias = countKeyColumnAlias(2)) if keepRank else ""), 
+                 outerOrder = " order by {alias}.export_primary asc, {order}{alias}.export_parent asc, {alias}.export_rank asc".format(alias = countKeyColumnAlias(2), order = orderByColumns(table, countKeyColumnAlias(2) + ".") + ", " if not (table.orderBy == None or len(table.orderBy) == 0) else "") if not keepRank else "", 
+                 parentAlias = countKeyColumnAlias(0), 
+                 parentKeyColumn = table.parentKeyColumn.name, 
+                 columns = ", ".join(countKeyColumnAlias(1) + "." + column.name for column in table.columns if column.include > 0), 
+                 order = " order by " + ", ".join(order for order in (orderByColumns(table, countKeyColumnAlias(1) + "."), tiebreakOrderColumns(table, countKeyColumnAlias(1) + ".")) if len(order) > 0) if len(table.orderBy) > 0 or len(tiebreakColumns(table)) > 0 else "", 
+                 table = table.name, 
+                 tableAlias = countKeyColumnAlias(1), 
+                 parentRelation = parentRelation, 
+                 keyColumn = table.keyColumn.name, 
+                 limit = " where {alias}.export_rank <= {limit}".format(alias = countKeyColumnAlias(2), limit = table.limit) if table.limit > 0 else "")
+    
+    return query
+
 """def createJoinedTemporaryTableQueryConstructor(table, primaryTable, count = 0):
     if table == primaryTable or table.parentTable == None:
-        return "select {ta}.{pc} as export_primary, {c} into temporary table {tempt} from {t} as {ta}{whereInclude} order by export_primary asc{order}".format(pc = table.keyColumn.name, c = ", ".join((countKeyColumnAlias() + "." if column.name in getAllColumnNamesFromTableName(table) else "") + column.name.format(alias = countKeyColumnAlias() + ".") for column in table.columns if column.include > 0), tempt = temporaryTableName(table), t = table.name, ta = countKeyColumnAlias(), whereInclude = " where " + primaryTable.whereInclude.format(alias = countKeyColumnAlias()) if not (primaryTable.whereInclude == "" or primaryTable.whereInclude == None) else "", order = (", " + ", ".join(order[0] + " " + ("asc" if order[1] == True else "desc") for order in table.orderBy)) if not (table.orderBy == None or len(table.orderBy) == 0) else "", alias = countKeyColumnAlias() + ".")
+        return "select {ta}.{pc} as export_primary, {c} into temporary table {tempt} from {t} as {ta}{whereInclude} order by export_primary asc{order}".format(pc = table.keyColumn.name, c = ", ".join((countKeyColumnAlias() + "." if column.name in [col[0] for col in getAllColumnNamesFromTableName(table.name)] else "") + column.name.format(alias = countKeyColumnAlias() + ".") for column in table.columns if column.include > 0), tempt = temporaryTableName(table), t = table.name, ta = countKeyColumnAlias(), whereInclude = " where " + primaryTable.whereInclude.format(alias = countKeyColumnAlias()) if not (primaryTable.whereInclude == "" or primaryTable.whereInclude == None) else "", order = (", " + ", ".join(order[0] + " " + ("asc" if order[1] == True else "desc") for order in table.orderBy)) if not (table.orderBy == None or len(table.orderBy) == 0) else "", alias = countKeyColumnAlias() + ".")
     else:
         return "select {refa}.export_primary as export_primary, {c} into temporary table {tempt} from {t} as {ta} inner join {reft} as {refa} on {ta}.{kc} = {refa}.{refkc} order by export_primary asc{order}".format(refa = countKeyColumnAlias(1), c = ", ".join(countKeyColumnAlias() + "." + column.name for column in table.columns if column.include > 0), tempt = temporaryTableName(table), t = table.name, ta = countKeyColumnAlias(), reft = temporaryTableName(table.parentTable), kc = table.keyColumn.name, refkc = table.parentKeyColumn.name, order = (", " + ", ".join(order[0] + " " + ("asc" if order[1] == True else "desc") for order in table.orderBy)) if not (table.orderBy == None or len(table.orderBy) == 0) else "")"""
 
-def queryNextBuffer(table, size, offset):
+def queryBufferCursor(table, size, lower = None, upper = None):
     """
-    Queries the database for the next batch of the temporary table.
+    Opens a named server-side cursor over the temporary table for a table, sorted by export primary key, orderBy settings, and finally the unique identifier column so the order is fully determined.
     
-    Takes the table object that corresponds to the temporary table, the size of the batch, and the starting position of the batch. Returns a list of tuples, with one tuple corresponding to one row.
+    Takes the table object that corresponds to the temporary table, the number of rows to fetch per round trip, and optionally the inclusive lower and exclusive upper bounds of the export primary keys to read. Returns the cursor, or None if the query fails.
     """
-    success = runQuery("select export_primary, {c} from {t} where export_id >= {o} order by export_primary asc{order} limit {s}".format(c = ", ".join(column.name.format(alias = "") for column in table.columns if column.include == 2), t = temporaryTableName(table), o = offset, order = (", " + ", ".join(order[0] + " " + ("asc" if order[1] == True else "desc") for order in table.orderBy)) if not (table.orderBy == None or len(table.orderBy) == 0) else "", s = size))
-    if success:
-        return cursor.fetchall()
-    else:
+    query = bufferQuery(table, lower, upper)
+    
+    try:
+        bufferCursor = getConnection().cursor(name = "cursor_export_buffer_" + table.name)
+        bufferCursor.itersize = size
+        bufferCursor.execute(query, {"lower": lower, "upper": upper})
+        return bufferCursor
+    except Exception as e:
+        print("\nQuery execution failed for query:\n" + query + "\n" + str(e))
         return None
 
+def bufferQuery(table, lower = None, upper = None):
+    """
+    Returns the query used to read a table's temporary table in export order - by export primary key, orderBy settings, and finally the unique identifier column so the order is fully determined.
+    
+    Takes the table as a table object and optionally the inclusive lower and exclusive upper bounds of the export primary keys to read, which are left as %(lower)s and %(upper)s parameters.
+    """
+    bounds = [condition for condition, value in (("export_primary >= %(lower)s", lower), ("export_primary < %(upper)s", upper)) if not value == None]
+    
+    query = "select export_primary, {columns} from {table}{where} order by export_primary asc{order}, export_id asc"
+    query = query.format(columns = ", ".join(temporaryColumnName(column) for column in table.columns if column.include == 2), 
+                 table = temporaryTableName(table), 
+                 where = " where " + " and ".join(bounds) if len(bounds) > 0 else "", 
+                 order = (", " + orderByColumns(table)) if not (table.orderBy == None or len(table.orderBy) == 0) else "")
+    
+    return query
+
+def orderByColumns(table, alias = ""):
+    """
+    Returns the table's orderBy settings as the body of an SQL order by clause, optionally prefixing each column with an alias (including the period separator).
+    """
+    return ", ".join(alias + order[0] + " " + ("asc" if order[1] == True else "desc") for order in table.orderBy)
+
+def tiebreakColumns(table):
+    """
+    Returns the columns that order a table's entries for the same parent key once its orderBy settings are used up, so every mode puts them (and picks them for a limit) in the same order - the table's primary key if it has one, otherwise every exported column that can be sorted.
+    """
+    columns = [getColumnFromName(name, table.columns) for name in table.primaryKey]
+    if len(columns) == 0 or None in columns:
+        columns = [column for column in table.columns if column.include == 2 and not column.type in ("json", "xml")]
+    return columns
+
+def tiebreakOrderColumns(table, alias = ""):
+    """
+    Returns the table's tiebreak columns (see tiebreakColumns) as the body of an SQL order by clause, optionally prefixing each column with an alias (including the period separator). Text is compared by code point, as python compares it.
+    """
+    return ", ".join(alias + column.name + (" collate \"C\"" if column.type in ("text", "character varying", "character") else "") + " asc" for column in tiebreakColumns(table))
+
+def temporaryColumnName(column):
+    """
+    Takes a column object and returns the name of the corresponding column in a temporary table as a string - the alias for expression columns such as where markers, otherwise the column name.
+    """
+    return column.name.rsplit(" as ", 1)[-1]
+
 def temporaryTableName(table):
     """
-    Takes a table object and returns the name of the corresponding temporary table as a string.
+    Takes a table object and returns the name of the corresponding temporary table as a string - its name in the staging cache while one is in use (see setupStagingCache).
     """
-    return table.name + "_export_temp"
+    if not table.stagingName == None:
+        return table.stagingName
+    return table.name + "_export_temp" + stagingTableSuffix
 
 def updateMaxEntries():
     """
-    Updates the maxEntries variable for each table in the tableInfo list.
+    Updates the maxEntries variable for each table in the tableInfo list that hasn't been counted yet, using one combined query over the source tables (see pivotStatisticsQuery).
     """
-    bar = Bar("Tables", max = len(tableInfo) - 1)
-    for i in range(1, len(tableInfo)):
-        if not tableInfo[i].forceOneToOne:
-            bar.next()
-            tableInfo[i].maxEntries = countMaxEntriesWithKeyColumn(tableInfo[i])
-    for i in range(1, len(tableInfo)):
-        if tableInfo[i].forceOneToOne:
-            bar.next()
-            tableInfo[i].maxEntries = tableInfo[i].parentTable.maxEntries
-    bar.finish()
+    updatePivotMaxEntries()
+
+def loadMaxEntries(filename):
+    """
+    Loads maxEntries values stored by saveMaxEntries for every table whose configuration hasn't changed since, marking them as counted so they aren't queried again.
+    
+    The stored values are only correct while the data they were counted from stays the same - if a table has gained entries past its stored maximum, the export raises WidthException partway through, and run counts the maximum entries again and starts the export over. Takes the name of the file as a string. Returns True if every secondary table was loaded, or False otherwise (including if the file doesn't exist).
+    """
+    try:
+        with open(filename, "r") as file:
+            stored = json.load(file)
+    except (IOError, ValueError):
+        return False
+    
+    loaded = True
+    for table in tableInfo[1:]:
+        configurationHash = tableConfigurationHash(table)
+        if configurationHash in stored:
+            table.maxEntries = stored[configurationHash]
+            table.maxEntriesCounted = True
+        else:
+            loaded = False
+    
+    if loaded:
+        print("Loaded maximum entries for every table from {f}.".format(f = filename))
+    return loaded
+
+def saveMaxEntries(filename):
+    """
+    Stores the counted maxEntries values for each secondary table in a json file, keyed by a hash of the table's configuration (see tableConfigurationHash) and keeping any values already stored for other configurations.
+    
+    Takes the name of the file as a string.
+    """
+    try:
+        with open(filename, "r") as file:
+            stored = json.load(file)
+    except (IOError, ValueError):
+        stored = {}
+    
+    for table in tableInfo[1:]:
+        if table.maxEntriesCounted:
+            stored[tableConfigurationHash(table)] = table.maxEntries
+    
+    with open(filename, "w") as file:
+        json.dump(stored, file, indent = 4, sort_keys = True)
 
 def writeColumnHeaders(file):
     """
     Writes the column headers to the export csv file.
     """
-    bar = Bar("Tables        ", max = len(tableInfo))
+    csv.writer(file, lineterminator = "\n").writerow([name for name, column in exportColumns()])
+
+def openExportFile(filename, mode = "w"):
+    """
+    Opens a file for writing csv export rows to, with newline translation turned off (as the csv module expects) and a large write buffer. Files ending in .gz or .zst are compressed as they are written instead (see CompressedExportFile).
+    
+    Takes the name of the file as a string and optionally the file mode, defaulting to "w" (compressed files can only be written from the start). Returns the open file.
+    """
+    compression = exportCompressionFromFilename(filename)
+    if compression == "zstd" and zstandard == None:
+        raise OutputFormatException("Writing zstd files needs the zstandard module, which can be installed with pip install zstandard.")
+    if not compression == None:
+        return CompressedExportFile(filename, compression, exportCompressionLevel)
+    return open(filename, mode, newline = "", buffering = 1048576)
+
+def exportCompressionFromFilename(filename):
+    """
+    Returns the compression codec matching a file name's extension as a string ("gzip" for .gz and "zstd" for .zst), or None if it doesn't have one.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    for compression in compressionExtensions:
+        if extension == compressionExtensions[compression]:
+            return compression
+    return None
+
+class CompressedExportFile(io.TextIOBase):
+    """
+    Text file that compresses what is written to it with gzip or zstd (using the zstandard module) on a background thread.
+    
+    Writes are gathered into chunks of about chunkSize characters, and each chunk is passed to the compression thread through a queue that holds at most queueSize chunks, so building rows and compressing them overlap without the queue growing when compression is the slower of the two. Any error from the compression thread is raised by the next write or by close.
+    """
+    def __init__(self, filename, compression = "gzip", level = None, chunkSize = 1048576, queueSize = 8):
+        super(CompressedExportFile, self).__init__()
+        self.chunkSize = chunkSize
+        self.pending = []
+        self.pendingSize = 0
+        self.error = None
+        self.thread = None
+        self.raw = open(filename, "wb")
+        if compression == "gzip":
+            self.stream = gzip.GzipFile(filename = os.path.basename(filename)[:-3], mode = "wb", compresslevel = 6 if level == None else level, fileobj = self.raw)
+        else:
+            self.stream = zstandard.ZstdCompressor(level = 3 if level == None else level, threads = -1).stream_writer(self.raw)
+        self.chunks = queue.Queue(maxsize = queueSize)
+        self.thread = threading.Thread(target = self.compressChunks, daemon = True)
+        self.thread.start()
+    def writable(self):
+        return True
+    def write(self, text):
+        self.pending.append(text)
+        self.pendingSize += len(text)
+        if self.pendingSize >= self.chunkSize:
+            self.flush()
+        return len(text)
+    def flush(self):
+        if len(self.pending) > 0:
+            if not self.error == None:
+                raise self.error
+            self.chunks.put("".join(self.pending).encode("utf-8"))
+            self.pending = []
+            self.pendingSize = 0
+    def compressChunks(self):
+        chunk = self.chunks.get()
+        while not chunk == None:
+            if self.error == None:
+                try:
+                    self.stream.write(chunk)
+                except Exception as e:
+                    self.error = e
+            chunk = self.chunks.get()
+    def close(self):
+        if self.closed or self.thread == None:
+            return
+        try:
+            self.flush()
+        finally:
+            self.chunks.put(None)
+            self.thread.join()
+            self.stream.close()
+            self.raw.close()
+            super(CompressedExportFile, self).close()
+        if not self.error == None:
+            raise self.error
+
+def exportColumns(layout = "wide", qualified = False, table = None):
+    """
+    Returns the columns of the export file in order, as a list of tuples each containing the header and the column object the values come from.
+    
+    In the wide layout each table's exported columns are repeated once per entry, numbered when a table can have more than one, and prefixed with the table name for secondary tables if qualified is True (so every header is unique). In the long layout (see longLayoutRows) there are columns for the export primary key, the table name, and the entry's slot, followed by every table's exported columns once, always prefixed with the table name for secondary tables. In the tables layout each table is written to its own file (see assembleBufferedTableRows), so the columns are those of the table given - the export primary key, the entry's slot, and the table's exported columns.
+    """
+    if layout == "tables":
+        return [("export_primary", tableInfo[0].keyColumn), ("export_slot", Column("export_slot", t = "integer"))] + [(column.displayName, column) for column in table.columns if column.include == 2]
+    
+    if layout == "wide":
+        return [((table.name + "." if qualified and not table == tableInfo[0] else "") + column.displayName + (str(i) if table.maxEntries > 1 else ""), column) for table in tableInfo for i in range(table.maxEntries) for column in table.columns if column.include == 2]
+    
+    columns = [("export_primary", tableInfo[0].keyColumn), ("export_table", Column("export_table", t = "text")), ("export_slot", Column("export_slot", t = "integer"))]
     for table in tableInfo:
-        bar.next()
-        for i in range(table.maxEntries):
-            for column in table.columns:
-                if column.include == 2:
-                    file.write(column.displayName + (str(i) if table.maxEntries > 1 else "") + ",")
-    file.seek(file.tell() - 1)
-    file.write("\n")
-    bar.finish()
+        columns.extend(((table.name + "." if not table == tableInfo[0] else "") + column.displayName, column) for column in table.columns if column.include == 2)
+    return columns
+
+def longLayoutRows(rows, bar = None):
+    """
+    Generator function that turns wide export rows into long layout rows, with one row for the primary table's values and one for each entry of each secondary table.
+    
+    Each long row holds the export primary key, the table name, and the entry's slot (counting from 0 in the order it would be written in the wide layout), followed by the entry's values in that table's columns and None in every other table's columns. Slots where every value is None are taken to be padding and left out, which also leaves out real entries whose exported values are all empty. Takes an iterable of (export primary key, list of values) tuples in the wide layout and optionally a progress bar to advance once per primary key. Returns (export primary key, list of values) tuples.
+    """
+    widths = [len([column for column in table.columns if column.include == 2]) for table in tableInfo]
+    totalWidth = sum(widths)
+    
+    for primaryKey, row in rows:
+        if not bar == None:
+            bar.next()
+        position = 0
+        offset = 0
+        for table, width in zip(tableInfo, widths):
+            for slot in range(table.maxEntries):
+                entry = row[position:position + width]
+                position += width
+                if table == tableInfo[0] or any(not value == None for value in entry):
+                    longRow = [primaryKey, table.name, slot] + [None] * totalWidth
+                    longRow[3 + offset:3 + offset + width] = entry
+                    yield (primaryKey, longRow)
+            offset += width
+
+def exportFormatFromFilename(filename):
+    """
+    Returns the output format matching a file name's extension as a string - "parquet" for .parquet, "arrow" for .arrow and .feather, and "csv" for anything else. Compression extensions (see exportCompressionFromFilename) are skipped.
+    """
+    if not exportCompressionFromFilename(filename) == None:
+        filename = os.path.splitext(filename)[0]
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".parquet":
+        return "parquet"
+    if extension in (".arrow", ".feather"):
+        return "arrow"
+    return "csv"
+
+def openExportWriter(filename, outputFormat = "csv", layout = "wide", table = None):
+    """
+    Opens a writer for the export file in the given format. Every writer has writeHeaders and writeRows methods and is closed with a with statement.
+    
+    Takes the name of the file as a string, the output format as a string ("csv", "parquet", or "arrow"), the layout as a string ("wide", "long", or "tables", see exportColumns), and for the tables layout the table the file is for as a table object. Parquet and arrow files need the pyarrow module. Returns the writer.
+    """
+    if not layout in ("wide", "long", "tables"):
+        raise OutputFormatException("Unknown layout \"{l}\".".format(l = layout))
+    if outputFormat == "csv":
+        return CsvExportWriter(filename, layout, table)
+    if outputFormat in ("parquet", "arrow"):
+        return ArrowExportWriter(filename, outputFormat, layout, table = table)
+    raise OutputFormatException("Unknown output format \"{f}\".".format(f = outputFormat))
+
+class CsvExportWriter:
+    """
+    Writes export rows to a csv file (see writeRows). The open file is kept as file. Rows are passed in the wide layout and converted to the long layout if needed, unless converted is True because they are already in the writer's layout.
+    """
+    def __init__(self, filename, layout = "wide", table = None):
+        self.file = openExportFile(filename)
+        self.layout = layout
+        self.table = table
+    def __enter__(self):
+        return self
+    def __exit__(self, *exception):
+        self.file.close()
+    def writeHeaders(self):
+        csv.writer(self.file, lineterminator = "\n").writerow([name for name, column in exportColumns(self.layout, table = self.table)])
+    def writeRows(self, rows, bar = None, converted = False):
+        if self.layout == "long" and not converted:
+            rows = longLayoutRows(rows, bar)
+            bar = None
+        writeRows(self.file, rows, bar)
+
+class ArrowExportWriter:
+    """
+    Writes export rows to a parquet or arrow file with pyarrow, building one row group at a time from the rows as they arrive, with column types taken from the sql column types (see arrowColumnType). Secondary table columns are prefixed with the table name, since column names need to be unique. The file is compressed internally with exportCompression, or snappy for parquet files if that isn't set. Rows are converted to the layout like CsvExportWriter does.
+    """
+    def __init__(self, filename, outputFormat = "parquet", layout = "wide", rowGroupSize = 10000, table = None):
+        if pyarrow == None:
+            raise OutputFormatException("Writing {f} files needs the pyarrow module, which can be installed with pip install pyarrow.".format(f = outputFormat))
+        self.filename = filename
+        self.outputFormat = outputFormat
+        self.layout = layout
+        self.table = table
+        self.rowGroupSize = rowGroupSize
+        self.writer = None
+    def __enter__(self):
+        return self
+    def __exit__(self, *exception):
+        if not self.writer == None:
+            self.writer.close()
+    def writeHeaders(self):
+        columns = exportColumns(self.layout, qualified = True, table = self.table)
+        types = [arrowColumnType(column) for name, column in columns]
+        self.schema = pyarrow.schema([(name, arrowType) for (name, column), (arrowType, converter) in zip(columns, types)])
+        self.converters = [converter for arrowType, converter in types]
+        if self.outputFormat == "parquet":
+            self.writer = pyarrow.parquet.ParquetWriter(self.filename, self.schema, compression = exportCompression or "snappy", compression_level = exportCompressionLevel)
+        else:
+            if exportCompression == "gzip":
+                raise OutputFormatException("Arrow files can't be compressed with gzip, use zstd instead.")
+            self.writer = pyarrow.ipc.new_file(self.filename, self.schema, options = pyarrow.ipc.IpcWriteOptions(compression = exportCompression))
+    def writeRows(self, rows, bar = None, converted = False):
+        if self.layout == "long" and not converted:
+            rows = longLayoutRows(rows, bar)
+            bar = None
+        rowGroup = []
+        for primaryKey, row in rows:
+            if not bar == None:
+                bar.next()
+            rowGroup.append(row)
+            if len(rowGroup) >= self.rowGroupSize:
+                self.writeRowGroup(rowGroup)
+                rowGroup = []
+        if len(rowGroup) > 0:
+            self.writeRowGroup(rowGroup)
+    def writeRowGroup(self, rowGroup):
+        arrays = []
+        for i, (field, converter) in enumerate(zip(self.schema, self.converters)):
+            values = [row[i] for row in rowGroup]
+            if not converter == None:
+                values = [converter(value) if not value == None else None for value in values]
+            arrays.append(pyarrow.array(values, type = field.type))
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema = self.schema))
+
+def arrowColumnType(column):
+    """
+    Returns the arrow type for a column's sql type, along with a function that converts values to fit it (or None if they already do), as a tuple.
+    
+    Numeric columns become doubles since their precision isn't known, and types without a match (as well as unknown types) are written as strings.
+    """
+    if column.type in ("smallint", "integer", "bigint"):
+        return ({"smallint": pyarrow.int16(), "integer": pyarrow.int32(), "bigint": pyarrow.int64()}[column.type], None)
+    if column.type in ("real", "double precision", "numeric"):
+        return (pyarrow.float32() if column.type == "real" else pyarrow.float64(), float)
+    if column.type == "boolean":
+        return (pyarrow.bool_(), None)
+    if column.type == "date":
+        return (pyarrow.date32(), None)
+    if column.type == "timestamp without time zone":
+        return (pyarrow.timestamp("us"), None)
+    if column.type == "timestamp with time zone":
+        return (pyarrow.timestamp("us", tz = "UTC"), None)
+    if column.type in ("text", "character varying", "character"):
+        return (pyarrow.string(), None)
+    return (pyarrow.string(), str)
 
 def queryPrimaryKeys():
     """
@@ -674,12 +3023,12 @@ def queryPrimaryKeys():
 
 def countPrimaryKeys():
     """
-    Counts the total number of included primary keys for the primary table."
+    Counts the total number of included primary keys for the primary table.
     """
-    query = "select count(*) from {t}"
+    query = "select count(*) from {t} as {alias}"
     if not (tableInfo[0].whereInclude == None or tableInfo[0].whereInclude == ""):
         query += " where {w}"
-    runQuery(query.format(t = tableInfo[0].name, w = tableInfo[0].whereInclude))
+    success = runQuery(query.format(t = tableInfo[0].name, alias = countKeyColumnAlias(), w = tableInfo[0].whereInclude.format(alias = countKeyColumnAlias() + ".") if not tableInfo[0].whereInclude == None else ""))
     if success:
         return cursor.fetchall()[0][0]
     else:
@@ -699,4 +3048,34 @@ class PrimaryKeyFetchException(Exception):
     """
     Custom exception thrown when a query fails while trying to retrieve a collection of primary keys.
     """
-    pass
\ No newline at end of file
+    pass
+
+class MemoryBudgetException(Exception):
+    """
+    Custom exception thrown when an export mode expects to need more memory than the budget it was given.
+    """
+    pass
+
+class OutputFormatException(Exception):
+    """
+    Custom exception thrown when an export file can't be written in the output format or layout asked for.
+    """
+    pass
+
+class CohortException(Exception):
+    """
+    Custom exception thrown when cohorts are set up that can't be exported as asked.
+    """
+    pass
+
+class WidthException(Exception):
+    """
+    Custom exception thrown when a primary key has more entries in a table than the table's maxEntries, such as when maximum entries loaded from a width file are out of date.
+    """
+    pass
+
+class DeltaExportException(Exception):
+    """
+    Custom exception thrown when the \"delta\" mode can't be used to update a previous export.
+    """
+    pass